@@ -1,71 +1,88 @@
 from numpy import genfromtxt
+from numpy.lib.stride_tricks import sliding_window_view
 import numpy as np
 import os
 
-if not os.path.exists("/Users/yaoyuan/Documents/neurofluids/output_processed"):
-    os.mkdir("/Users/yaoyuan/Documents/neurofluids/output_processed")
 
-with open("/Users/yaoyuan/Documents/neurofluids/output/data_list.txt", "r") as f:
-    names = f.readlines()
-names = [name.strip() for name in names]
+def load_csv(path):
+    # np.loadtxt has a C parser and is much faster than genfromtxt, but it
+    # cannot fill missing values, so fall back to genfromtxt for such files
+    try:
+        return np.loadtxt(path, delimiter=",")
+    except ValueError:
+        return genfromtxt(path, delimiter=",")
 
-for name in names:
-    print(name)
-    data = genfromtxt(
-        f"/Users/yaoyuan/Documents/neurofluids/output/{name}_data.csv", delimiter=","
-    )
-    print(data.shape)
-    print(data[2][-1])
-    assert data[2][0] == 0.0
-    label = genfromtxt(
-        f"/Users/yaoyuan/Documents/neurofluids/output/{name}_score.csv", delimiter=","
-    )
-    print(label.shape)
 
+def align_epochs(data, label, epoch_len=512):
+    # For second i, the loop version advances a pointer to the first time
+    # stamp >= i, steps back one sample if the previous stamp is closer, and
+    # stops at the first second whose window would run past the data. Here
+    # that is one np.searchsorted plus a gather from a strided window view.
+    time_stamps = data[2]
     len_data = data.shape[1]
     total_seconds = label.shape[1]
-    assert data[2][-1] < total_seconds + 100
-    assert data[2][-1] > total_seconds - 100
-
-    all_epoch_data = []
-    all_epoch_label = []
-
-    pointer = 0
-    for i in range(total_seconds):
-        while data[2][pointer] < i:
-            pointer += 1
-            if pointer + 512 > len_data:
-                break
-        if pointer + 512 > len_data:
-            break
-        # print(i, pointer, data[2][pointer], data[2][pointer-1])
-        if (
-            data[2][pointer] - i > i - data[2][pointer - 1]
-        ):  # if previous time stamp is closer
-            pointer -= 1
-        pointer = max(pointer, 0)
-
-        epoch_data = data[
-            :2, None, pointer : pointer + 512
-        ]  # (2, 1, 512): 2 traces(EMG and EEG); 1 channel; 512 sequence length
-        if np.max(label[:, i]) == 0:
-            epoch_label = -1  # -1 for unknown
-        else:
-            epoch_label = np.argmax(label[:, i])  # 0 for wake, 1 for sws, 2 for REM
-        all_epoch_data.append(epoch_data)
-        all_epoch_label.append(epoch_label)
-
-    all_epoch_data = np.array(all_epoch_data)
-    all_epoch_label = np.array(all_epoch_label)
-
-    print(all_epoch_data.shape)
-    print(all_epoch_label.shape)
-
-    np.save(
-        f"/Users/yaoyuan/Documents/neurofluids/output_processed/{name}_data.npy",
-        all_epoch_data,
-    )  # (N, 2, 1, 512)
-    np.save(
-        f"/Users/yaoyuan/Documents/neurofluids/output_processed/{name}_label.npy",
-        all_epoch_label,
-    )  # (N, 1)
+
+    seconds = np.arange(total_seconds)
+    pointers = np.searchsorted(time_stamps, seconds, side="left")
+    n_epochs = np.count_nonzero(pointers + epoch_len <= len_data)
+    if n_epochs == 0:
+        # also covers recordings shorter than one epoch, which
+        # sliding_window_view rejects; same empty arrays as the loop
+        return np.array([]), np.array([])
+    seconds, pointers = seconds[:n_epochs], pointers[:n_epochs]
+
+    previous = np.maximum(pointers - 1, 0)
+    previous_closer = (time_stamps[pointers] - seconds) > (
+        seconds - time_stamps[previous]
+    )
+    pointers = np.where(previous_closer & (pointers > 0), previous, pointers)
+
+    # [len_data - epoch_len + 1, 2, epoch_len] view, no copy
+    windows = sliding_window_view(data[:2], epoch_len, axis=1).transpose(1, 0, 2)
+    # (N, 2, 1, 512): 2 traces(EMG and EEG); 1 channel; 512 sequence length
+    all_epoch_data = windows[pointers][:, :, None, :]
+
+    epoch_label = label[:, :n_epochs]
+    # -1 for unknown, else 0 for wake, 1 for sws, 2 for REM
+    all_epoch_label = np.where(
+        np.max(epoch_label, axis=0) == 0, -1, np.argmax(epoch_label, axis=0)
+    )
+    return all_epoch_data, all_epoch_label
+
+
+if __name__ == "__main__":
+    if not os.path.exists("/Users/yaoyuan/Documents/neurofluids/output_processed"):
+        os.mkdir("/Users/yaoyuan/Documents/neurofluids/output_processed")
+
+    with open("/Users/yaoyuan/Documents/neurofluids/output/data_list.txt", "r") as f:
+        names = f.readlines()
+    names = [name.strip() for name in names]
+
+    for name in names:
+        print(name)
+        data = load_csv(f"/Users/yaoyuan/Documents/neurofluids/output/{name}_data.csv")
+        print(data.shape)
+        print(data[2][-1])
+        assert data[2][0] == 0.0
+        label = load_csv(
+            f"/Users/yaoyuan/Documents/neurofluids/output/{name}_score.csv"
+        )
+        print(label.shape)
+
+        total_seconds = label.shape[1]
+        assert data[2][-1] < total_seconds + 100
+        assert data[2][-1] > total_seconds - 100
+
+        all_epoch_data, all_epoch_label = align_epochs(data, label)
+
+        print(all_epoch_data.shape)
+        print(all_epoch_label.shape)
+
+        np.save(
+            f"/Users/yaoyuan/Documents/neurofluids/output_processed/{name}_data.npy",
+            all_epoch_data,
+        )  # (N, 2, 1, 512)
+        np.save(
+            f"/Users/yaoyuan/Documents/neurofluids/output_processed/{name}_label.npy",
+            all_epoch_label,
+        )  # (N, 1)
@@ -1,9 +1,24 @@
-from torch.utils.data import DataLoader
-from data_provider.data_loader import Epoch_Loader, Seq_Loader, Item_Loader
+import torch
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    DistributedSampler,
+    RandomSampler,
+    SequentialSampler,
+)
+from data_provider.data_loader import (
+    Epoch_Loader,
+    Seq_Loader,
+    SeqWindow_Loader,
+    Item_Loader,
+)
+from utils.distributed import get_rank, get_world_size, is_distributed
 
 data_dict = {
     "Epoch": Epoch_Loader,
     "Seq": Seq_Loader,
+    "SeqWindow": SeqWindow_Loader,
 }
 
 
@@ -13,7 +28,105 @@ def data_summarize(data_loader):
     print(f"\t Labels batch shape: {label.shape}")
 
 
-def data_generator(args, flag):
+def build_sampler(data_set, shuffle, drop_last, seed=0):
+    """The sampler of a loader, one shard per rank under DDP.
+
+    The train shards are reshuffled each epoch by set_epoch. The val set is
+    split round-robin without padding, so every epoch is scored once.
+    """
+    if not is_distributed():
+        return RandomSampler(data_set) if shuffle else SequentialSampler(data_set)
+    if shuffle:
+        return DistributedSampler(
+            data_set, shuffle=True, seed=seed, drop_last=drop_last
+        )
+    return list(range(get_rank(), len(data_set), get_world_size()))
+
+
+def set_epoch(data_loader, epoch):
+    # reseed the DistributedSampler of a train loader, a no-op otherwise
+    sampler = getattr(data_loader, "loader", data_loader).sampler
+    sampler = getattr(sampler, "sampler", sampler)
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
+
+
+class BatchDataset(Dataset):
+    """A dataset whose items are whole batches.
+
+    dataset[indices] is dataset.get_batch(indices), which gathers the batch
+    from the in-memory (or memory-mapped) tensors in one call. Driven by a
+    BatchSampler in the main process, this replaces per-item __getitem__,
+    worker pickling and collation.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        return self.dataset.get_batch(indices)
+
+
+class DevicePrefetcher:
+    """Iterate a DataLoader with every batch already on the device.
+
+    On CUDA the pinned host-to-device copy of the next batch is issued on a
+    side stream before the current one is handed out, so it overlaps with
+    the compute on the current batch. Labels, the last tensor of a batch,
+    arrive as int64, ready for the loss. On CPU the batches pass through
+    with only the label cast. The trainers' own
+    .to(device, non_blocking=True) and .long() are then no-ops, and without
+    prefetching they still copy asynchronously from pinned memory.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, *batch):
+        # (traces, labels), or (traces, nes, labels) for the NE loaders
+        *inputs, labels = batch
+        return (
+            *(tensor.to(self.device, non_blocking=True) for tensor in inputs),
+            labels.to(self.device, non_blocking=True).long(),
+        )
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            for *inputs, labels in self.loader:
+                yield (*inputs, labels.long())
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+
+        def prefetch():
+            batch = next(batches, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self._to_device(*batch)
+
+        batch = prefetch()
+        while batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(stream)
+            for tensor in batch:
+                # allocated on the side stream, used on the current one
+                tensor.record_stream(current)
+            next_batch = prefetch()
+            yield batch
+            batch = next_batch
+
+
+def data_generator(args, flag, device=None):
     Data = data_dict[args.data]
     batch_size = args.batch_size
 
@@ -26,6 +139,10 @@ def data_generator(args, flag):
         drop_last = True
         isEval = False
 
+    kwargs = {}
+    if args.data == "SeqWindow":
+        kwargs["seq_stride"] = getattr(args, "seq_stride", None)
+
     data_set = Data(
         root_path=args.root_path,
         data_path=args.data_path,
@@ -33,16 +150,34 @@ def data_generator(args, flag):
         fold=args.fold,
         n_sequences=args.n_sequences,
         useNorm=args.useNorm,
+        **kwargs,
     )
 
-    data_loader = DataLoader(
-        data_set,
-        batch_size=batch_size,
-        shuffle=shuffle_flag,
-        num_workers=args.num_workers,
-        drop_last=drop_last,
-        pin_memory=True,
+    sampler = build_sampler(
+        data_set, shuffle_flag, drop_last, seed=getattr(args, "seed", 0)
     )
+    if getattr(args, "batch_gather", False) and hasattr(data_set, "get_batch"):
+        # args.batch_gather: one gather per batch, no workers, see BatchDataset
+        data_loader = DataLoader(
+            BatchDataset(data_set),
+            sampler=BatchSampler(sampler, batch_size, drop_last),
+            batch_size=None,
+            num_workers=0,
+            pin_memory=True,
+        )
+    else:
+        data_loader = DataLoader(
+            data_set,
+            batch_size=batch_size,
+            sampler=sampler,
+            num_workers=args.num_workers,
+            drop_last=drop_last,
+            pin_memory=True,
+        )
+    # args.prefetch: copy batches to device ahead of the model, see
+    # DevicePrefetcher
+    if device is not None and getattr(args, "prefetch", False):
+        data_loader = DevicePrefetcher(data_loader, device)
 
     return data_set, data_loader
 
@@ -1,5 +1,6 @@
 from torch.utils.data import DataLoader
 from data_provider.data_loader import Epoch_Loader_NE, Seq_Loader_NE, Item_Loader
+from data_provider.data_generator import build_sampler, DevicePrefetcher
 
 data_dict = {
     "Epoch": Epoch_Loader_NE,
@@ -13,7 +14,7 @@ def data_summarize(data_loader):
     print(f"\t Labels batch shape: {label.shape}")
 
 
-def data_generator(args, flag):
+def data_generator(args, flag, device=None):
     Data = data_dict[args.data]
     batch_size = args.batch_size
 
@@ -31,18 +32,24 @@ def data_generator(args, flag):
         data_path=args.data_path,
         isEval=isEval,
         fold=args.fold,
-        n_sequcnes=args.n_sequences,
+        n_sequences=args.n_sequences,
         useNorm=args.useNorm,
     )
 
     data_loader = DataLoader(
         data_set,
         batch_size=batch_size,
-        shuffle=shuffle_flag,
+        sampler=build_sampler(
+            data_set, shuffle_flag, drop_last, seed=getattr(args, "seed", 0)
+        ),
         num_workers=args.num_workers,
         drop_last=drop_last,
         pin_memory=True,
     )
+    # args.prefetch: copy batches to device ahead of the model, see
+    # DevicePrefetcher
+    if device is not None and getattr(args, "prefetch", False):
+        data_loader = DevicePrefetcher(data_loader, device)
 
     return data_set, data_loader
 
@@ -53,7 +60,7 @@ def visualize_data_generator(args):
         data_path=args.data_path,
         isEval=True,
         fold=args.fold,
-        n_sequcnes=args.n_sequences,
+        n_sequences=args.n_sequences,
         useNorm=args.useNorm,
     )
 
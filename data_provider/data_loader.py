@@ -7,6 +7,14 @@ import numpy as np
 from sklearn.model_selection import KFold
 from torch.utils.data import Dataset, DataLoader
 
+from data_provider.trace_store import (
+    TraceStore,
+    FOLDS_FILE,
+    open_fold,
+    store_windows,
+    window_offsets,
+)
+
 # from torchvision import transforms, datasets
 # from pathlib import Path
 # from torch.utils import data
@@ -22,6 +30,45 @@ def file2tensor(file_path, norm=False, isLabel=False):
     # return data if not isLabel else data.unsqueeze(1)
 
 
+def trace_stats(data):
+    # per-recording statistics, as applied by file2tensor(norm=True)
+    return torch.stack([torch.mean(data, dim=0), torch.std(data, dim=0)])
+
+
+def normalize_trace(trace, stats):
+    return ((trace - stats[0]) / stats[1]).float()
+
+
+def normalize_batch(traces, stats):
+    # normalize_trace over a gathered batch, stats[i] being the stats of
+    # traces[i]; in place, in the precision normalize_trace computes in
+    mean, std = stats[:, 0], stats[:, 1]
+    while mean.dim() < traces.dim():
+        mean, std = mean.unsqueeze(1), std.unsqueeze(1)
+    traces = traces.to(torch.result_type(traces, stats))
+    return traces.sub_(mean).div_(std).float()
+
+
+def save_split(dst_path, split, fold, traces, labels, stats, rec_ids):
+    # raw traces only; stats[rec_ids[i]] normalizes item i on the fly
+    np.save("{}{}_trace{}.npy".format(dst_path, split, fold), traces)
+    np.save("{}{}_label{}.npy".format(dst_path, split, fold), labels)
+    np.save("{}{}_stats{}.npy".format(dst_path, split, fold), stats)
+    np.save("{}{}_recid{}.npy".format(dst_path, split, fold), rec_ids)
+
+
+def load_split(dst_path, split, fold):
+    def load(name):
+        return torch.from_numpy(
+            np.load("{}{}_{}{}.npy".format(dst_path, split, name, fold))
+        )
+
+    if not os.path.exists("{}{}_stats{}.npy".format(dst_path, split, fold)):
+        # older folds store raw and normalized traces side by side
+        return load("trace"), load("label"), None, None
+    return load("trace"), load("label"), load("stats"), load("recid")
+
+
 def filter_func(data_list, label):
     return list(map(lambda tensor: tensor[torch.where(label[:, 0] >= 0)], data_list))
 
@@ -58,84 +105,97 @@ class Epoch_Loader(Dataset):
             print("Train_idxs: ", train_idxs)
             print("Val_idxs: ", val_idxs)
 
-            train_traces = torch.cat(
-                [file2tensor(trace_files[idx]) for idx in train_idxs], dim=0
-            ).float()
-            train_norm = torch.cat(
-                [file2tensor(trace_files[idx], norm=True) for idx in train_idxs], dim=0
-            ).float()
+            train_traces_list = [file2tensor(trace_files[idx]) for idx in train_idxs]
+            self.train_stats = torch.stack([trace_stats(t) for t in train_traces_list])
+            train_rec_ids = torch.cat(
+                [torch.full((len(t),), i) for i, t in enumerate(train_traces_list)]
+            )
+            train_traces = torch.cat(train_traces_list, dim=0).float()
             train_labels = torch.cat(
                 [file2tensor(label_files[idx], isLabel=True) for idx in train_idxs],
                 dim=0,
             )
 
-            val_traces = torch.cat(
-                [file2tensor(trace_files[idx]) for idx in val_idxs], dim=0
-            ).float()
-            val_norm = torch.cat(
-                [file2tensor(trace_files[idx], norm=True) for idx in val_idxs], dim=0
-            ).float()
+            val_traces_list = [file2tensor(trace_files[idx]) for idx in val_idxs]
+            self.val_stats = torch.stack([trace_stats(t) for t in val_traces_list])
+            val_rec_ids = torch.cat(
+                [torch.full((len(t),), i) for i, t in enumerate(val_traces_list)]
+            )
+            val_traces = torch.cat(val_traces_list, dim=0).float()
             val_labels = torch.cat(
                 [file2tensor(label_files[idx], isLabel=True) for idx in val_idxs], dim=0
             )
 
-            train_traces, train_norm, self.train_labels = filter_func(
-                [train_traces, train_norm, train_labels], train_labels
+            self.train_traces, self.train_rec_ids, self.train_labels = filter_func(
+                [train_traces, train_rec_ids, train_labels], train_labels
             )
-            val_traces, val_norm, self.val_labels = filter_func(
-                [val_traces, val_norm, val_labels], val_labels
+            self.val_traces, self.val_rec_ids, self.val_labels = filter_func(
+                [val_traces, val_rec_ids, val_labels], val_labels
             )
-            # concat the normalized trace to channel dimmension
-            self.train_traces = torch.cat([train_traces, train_norm], dim=2)
-            self.val_traces = torch.cat([val_traces, val_norm], dim=2)
-            # after concat [N, 2, 2, 512]  the thrid dim include pre-normed and normed data
-            np.save(
-                "{}train_trace{}.npy".format(self.dst_path, fold), self.train_traces
+            # only raw traces are stored, normalization happens in __getitem__
+            save_split(
+                self.dst_path,
+                "train",
+                fold,
+                self.train_traces,
+                self.train_labels,
+                self.train_stats,
+                self.train_rec_ids,
             )
-            np.save(
-                "{}train_label{}.npy".format(self.dst_path, fold), self.train_labels
+            save_split(
+                self.dst_path,
+                "val",
+                fold,
+                self.val_traces,
+                self.val_labels,
+                self.val_stats,
+                self.val_rec_ids,
             )
-            np.save("{}val_trace{}.npy".format(self.dst_path, fold), self.val_traces)
-            np.save("{}val_label{}.npy".format(self.dst_path, fold), self.val_labels)
 
         else:
             print(">>>>>>>>>Loading Existing Fold{}<<<<<<<<<<<<<<<<<<<<<<".format(fold))
-            self.train_traces = torch.from_numpy(
-                np.load(
-                    "{}train_trace{}.npy".format(self.dst_path, fold), allow_pickle=True
-                )
-            )
-            self.train_labels = torch.from_numpy(
-                np.load(
-                    "{}train_label{}.npy".format(self.dst_path, fold), allow_pickle=True
-                )
-            )
-            self.val_traces = torch.from_numpy(
-                np.load(
-                    "{}val_trace{}.npy".format(self.dst_path, fold), allow_pickle=True
-                )
-            )
-            self.val_labels = torch.from_numpy(
-                np.load(
-                    "{}val_label{}.npy".format(self.dst_path, fold), allow_pickle=True
-                )
-            )
-
-        self.traces, self.labels = (
-            (self.train_traces, self.train_labels)
+            (
+                self.train_traces,
+                self.train_labels,
+                self.train_stats,
+                self.train_rec_ids,
+            ) = load_split(self.dst_path, "train", fold)
+            (
+                self.val_traces,
+                self.val_labels,
+                self.val_stats,
+                self.val_rec_ids,
+            ) = load_split(self.dst_path, "val", fold)
+
+        self.traces, self.labels, self.stats, self.rec_ids = (
+            (self.train_traces, self.train_labels, self.train_stats, self.train_rec_ids)
             if not isEval
-            else (self.val_traces, self.val_labels)
+            else (self.val_traces, self.val_labels, self.val_stats, self.val_rec_ids)
         )
-        self.traces = self.traces[:, :, :1] if not useNorm else self.traces[:, :, -1:]
+        self.useNorm = useNorm
+        if self.stats is None:
+            self.traces = (
+                self.traces[:, :, :1] if not useNorm else self.traces[:, :, -1:]
+            )
 
     def __len__(self):
         return self.labels.size(0)
 
     def __getitem__(self, idx):
         trace = self.traces[idx]
+        if self.useNorm and self.stats is not None:
+            trace = normalize_trace(trace, self.stats[self.rec_ids[idx]])
         label = self.labels[idx]
         return trace, label
 
+    def get_batch(self, indices):
+        # the items at indices, stacked by one gather, see BatchDataset
+        indices = torch.as_tensor(indices)
+        trace = self.traces[indices]
+        if self.useNorm and self.stats is not None:
+            trace = normalize_batch(trace, self.stats[self.rec_ids[indices]])
+        return trace, self.labels[indices].long()
+
 
 def filter_func_visualize(data_list, label):
     print(label.shape)
@@ -286,29 +346,20 @@ def Seq_filter_func(data_list, label_list):
     )
 
 
-def slice_trace(trace, norm, label, n_sequences):
-    n = len(trace)
-    n_to_crop = n % n_sequences
-    n_new_seq = (n - n_to_crop) // n_sequences
+def slice_tensor(tensor, n_sequences):
+    # the last, partial sequence is replaced by the final n_sequences items
+    n_to_crop = len(tensor) % n_sequences
     if n_to_crop != 0:
-        trace = torch.cat([trace[:-n_to_crop], trace[-n_sequences:]], dim=0)
-        norm = torch.cat([norm[:-n_to_crop], norm[-n_sequences:]], dim=0)
-        label = torch.cat([label[:-n_to_crop], label[-n_sequences:]], dim=0)
-        # trace = trace[:-n_to_crop]
-        # norm = norm[:-n_to_crop]
-        # label = label[:-n_to_crop]
-        n_new_seq += 1
+        tensor = torch.cat([tensor[:-n_to_crop], tensor[-n_sequences:]], dim=0)
+    return tensor.reshape((-1, n_sequences, *tensor.shape[1:]))
 
-    assert (n - n_to_crop) % n_sequences == 0
 
-    trace = trace.reshape(
-        (n_new_seq, n_sequences, trace.shape[1], trace.shape[2], trace.shape[3])
-    )
-    norm = norm.reshape(
-        (n_new_seq, n_sequences, norm.shape[1], norm.shape[2], norm.shape[3])
-    )
-    label = label.reshape((n_new_seq, n_sequences, label.shape[1]))
-    return [trace, norm, label]
+def slice_trace(trace, norm, label, n_sequences):
+    return [
+        slice_tensor(trace, n_sequences),
+        slice_tensor(norm, n_sequences),
+        slice_tensor(label, n_sequences),
+    ]
 
 
 def slice_trace_wNE(trace, ne, norm, norm_ne, label, n_sequences):
@@ -376,6 +427,40 @@ class Seq_Loader(Dataset):
     ):
         self.root_path = root_path
         self.dst_path = "{}n_seq_{}/fold_{}/".format(data_path, n_sequences, fold)
+        self.store = None
+        self.starts = None
+        seq_path = "{}n_seq_{}/".format(data_path, n_sequences)
+        store_path = "{}{}_store{}".format(
+            self.dst_path, "val" if isEval else "train", fold
+        )
+
+        if TraceStore.exists(store_path) or os.path.exists(seq_path + FOLDS_FILE):
+            print(">>>>>>>>>Mapping Existing Fold{}<<<<<<<<<<<<<<<<<<<<<<".format(fold))
+            logging.getLogger("logger").info(
+                f">>>>>>>>>Mapping Existing Fold{fold}<<<<<<<<<<<<<<<<<<<<<<"
+            )
+            if TraceStore.exists(store_path):
+                self.store = TraceStore(store_path)
+                if len(self.store.index["trace_shape"]) == 4:
+                    # older write_data layout, one item per sequence
+                    self.items = np.arange(len(self.store))
+                    self.window = None
+                else:
+                    # per-fold store of write_data, laid out like the shared
+                    # store below
+                    names = [rec["name"] for rec in self.store.recordings]
+                    self.items = store_windows(
+                        self.store, names, n_sequences, augment=not isEval
+                    )
+                    self.window = n_sequences
+            else:
+                # shared store written once for all folds by write_all_folds,
+                # one item per epoch and items are window starts into it
+                self.store, self.items = open_fold(seq_path, fold, n_sequences, isEval)
+                self.window = n_sequences
+            # same channel selection as below, applied per item as a view
+            self.channel = slice(None, 1) if not useNorm else slice(-1, None)
+            return
 
         if not os.path.exists(self.dst_path):
             print(
@@ -396,100 +481,248 @@ class Seq_Loader(Dataset):
             train_idxs, val_idxs = fold_idxs[fold - 1]  # Label of fold start from one
 
             train_traces_list = [file2tensor(trace_files[idx]) for idx in train_idxs]
-            train_norm_list = [
-                file2tensor(trace_files[idx], norm=True) for idx in train_idxs
-            ]
+            self.train_stats = torch.stack([trace_stats(t) for t in train_traces_list])
             train_labels_list = [
                 file2tensor(label_files[idx], isLabel=True) for idx in train_idxs
             ]
 
             train_traces_list = Seq_filter_func(train_traces_list, train_labels_list)
-            train_norm_list = Seq_filter_func(train_norm_list, train_labels_list)
             train_labels_list = Seq_filter_func(train_labels_list, train_labels_list)
-            train_data = Seq_slice_func(
-                train_traces_list, train_norm_list, train_labels_list, n_sequences
+            train_traces_list = [
+                slice_tensor(t, n_sequences) for t in train_traces_list
+            ]
+            self.train_rec_ids = torch.cat(
+                [torch.full((len(t),), i) for i, t in enumerate(train_traces_list)]
+            )
+            self.train_traces = torch.cat(train_traces_list, dim=0).float()
+            self.train_labels = torch.cat(
+                [slice_tensor(t, n_sequences) for t in train_labels_list], dim=0
             )
-            train_traces = torch.cat([i[0] for i in train_data], dim=0).float()
-            train_norm = torch.cat([i[1] for i in train_data], dim=0).float()
-            self.train_labels = torch.cat([i[2] for i in train_data], dim=0)
 
             val_traces_list = [file2tensor(trace_files[idx]) for idx in val_idxs]
-            val_norm_list = [
-                file2tensor(trace_files[idx], norm=True) for idx in val_idxs
-            ]
+            self.val_stats = torch.stack([trace_stats(t) for t in val_traces_list])
             val_labels_list = [
                 file2tensor(label_files[idx], isLabel=True) for idx in val_idxs
             ]
 
             val_traces_list = Seq_filter_func(val_traces_list, val_labels_list)
-            val_norm_list = Seq_filter_func(val_norm_list, val_labels_list)
             val_labels_list = Seq_filter_func(val_labels_list, val_labels_list)
-            val_data = Seq_slice_func(
-                val_traces_list, val_norm_list, val_labels_list, n_sequences
+            val_traces_list = [slice_tensor(t, n_sequences) for t in val_traces_list]
+            self.val_rec_ids = torch.cat(
+                [torch.full((len(t),), i) for i, t in enumerate(val_traces_list)]
+            )
+            self.val_traces = torch.cat(val_traces_list, dim=0).float()
+            self.val_labels = torch.cat(
+                [slice_tensor(t, n_sequences) for t in val_labels_list], dim=0
             )
-            val_traces = torch.cat([i[0] for i in val_data], dim=0).float()
-            val_norm = torch.cat([i[1] for i in val_data], dim=0).float()
-            self.val_labels = torch.cat([i[2] for i in val_data], dim=0)
-
-            # concat the normalized trace to channel dimmension
-            self.train_traces = torch.cat([train_traces, train_norm], dim=3)
-            self.val_traces = torch.cat([val_traces, val_norm], dim=3)
 
-            # after concat -> [N, n_sequence, 2, 2, 512]. the 4th dim include pre-normed and normed data
-            # print(self.dst_path)
-            np.save(
-                "{}train_trace{}.npy".format(self.dst_path, fold), self.train_traces
+            # only raw traces are stored, normalization happens in __getitem__
+            save_split(
+                self.dst_path,
+                "train",
+                fold,
+                self.train_traces,
+                self.train_labels,
+                self.train_stats,
+                self.train_rec_ids,
             )
-            np.save(
-                "{}train_label{}.npy".format(self.dst_path, fold), self.train_labels
+            save_split(
+                self.dst_path,
+                "val",
+                fold,
+                self.val_traces,
+                self.val_labels,
+                self.val_stats,
+                self.val_rec_ids,
             )
-            np.save("{}val_trace{}.npy".format(self.dst_path, fold), self.val_traces)
-            np.save("{}val_label{}.npy".format(self.dst_path, fold), self.val_labels)
 
         else:
             print(">>>>>>>>>Loading Existing Fold{}<<<<<<<<<<<<<<<<<<<<<<".format(fold))
             logging.getLogger("logger").info(
                 f">>>>>>>>>Loading Existing Fold{fold}<<<<<<<<<<<<<<<<<<<<<<"
             )
-            self.train_traces = torch.from_numpy(
-                np.load(
-                    "{}train_trace{}.npy".format(self.dst_path, fold), allow_pickle=True
-                )
+            (
+                self.train_traces,
+                self.train_labels,
+                self.train_stats,
+                self.train_rec_ids,
+            ) = load_split(self.dst_path, "train", fold)
+            (
+                self.val_traces,
+                self.val_labels,
+                self.val_stats,
+                self.val_rec_ids,
+            ) = load_split(self.dst_path, "val", fold)
+
+        self.traces, self.labels, self.stats, self.rec_ids = (
+            (self.train_traces, self.train_labels, self.train_stats, self.train_rec_ids)
+            if not isEval
+            else (self.val_traces, self.val_labels, self.val_stats, self.val_rec_ids)
+        )
+        self.useNorm = useNorm
+        starts_file = "{}{}_starts{}.npy".format(
+            self.dst_path, "val" if isEval else "train", fold
+        )
+        if os.path.exists(starts_file):
+            # flat epochs written by write_data, items are window starts
+            self.starts = torch.from_numpy(np.load(starts_file))
+            self.n_sequences = n_sequences
+        if self.stats is None:
+            channel = slice(None, 1) if not useNorm else slice(-1, None)
+            if self.starts is None:
+                self.traces = self.traces[:, :, :, channel]
+            else:
+                self.traces = self.traces[:, :, channel]
+        # i=0
+
+    def __len__(self):
+        if self.store is not None:
+            return len(self.items)
+        if self.starts is not None:
+            return self.starts.size(0)
+        return self.labels.size(0)
+
+    def __getitem__(self, idx):
+        if self.store is not None:
+            if self.window is None:
+                trace, label = self.store[self.items[idx]]
+            else:
+                trace, label = self.store.window(self.items[idx], self.window)
+            return (
+                torch.from_numpy(trace[:, :, self.channel]),
+                torch.from_numpy(label),
             )
-            self.train_labels = torch.from_numpy(
-                np.load(
-                    "{}train_label{}.npy".format(self.dst_path, fold), allow_pickle=True
-                )
+        if self.starts is not None:
+            start = self.starts[idx]
+            return (
+                self.traces[start : start + self.n_sequences],
+                self.labels[start : start + self.n_sequences],
             )
-            self.val_traces = torch.from_numpy(
-                np.load(
-                    "{}val_trace{}.npy".format(self.dst_path, fold), allow_pickle=True
+        trace = self.traces[idx]
+        if self.useNorm and self.stats is not None:
+            trace = normalize_trace(trace, self.stats[self.rec_ids[idx]])
+        label = self.labels[idx]
+        return trace, label
+
+    def get_batch(self, indices):
+        # the items at indices, stacked by one gather, see BatchDataset
+        if self.store is not None:
+            trace, label = self.store.gather(
+                self.items[indices], self.window, key=(self.channel, slice(None))
+            )
+            return torch.from_numpy(trace), torch.from_numpy(label).long()
+        indices = torch.as_tensor(indices)
+        if self.starts is not None:
+            window = self.starts[indices][:, None] + torch.arange(self.n_sequences)
+            return self.traces[window], self.labels[window].long()
+        trace = self.traces[indices]
+        if self.useNorm and self.stats is not None:
+            trace = normalize_batch(trace, self.stats[self.rec_ids[indices]])
+        return trace, self.labels[indices].long()
+
+
+def window_starts(rec_ids, n_sequences, stride):
+    # start of every window inside each recording, plus the tail window that
+    # slice_tensor adds when the recording is not a multiple of n_sequences
+    _, offsets, counts = np.unique(
+        rec_ids.numpy(), return_index=True, return_counts=True
+    )
+    starts = [np.zeros(0, dtype=np.int64)] + [
+        offset + window_offsets(count, n_sequences, stride)
+        for offset, count in zip(offsets, counts)
+    ]
+    return torch.from_numpy(np.concatenate(starts))
+
+
+class SeqWindow_Loader(Dataset):
+    # Seq_Loader variant for overlapping sequences. Epochs are stored once per
+    # fold as a flat array and every item is just a window start into it, so
+    # memory stays O(total epochs) for any seq_stride. Validation always uses
+    # non-overlapping windows, which match Seq_Loader's.
+    def __init__(
+        self,
+        root_path="raw_data/",
+        data_path="dst_data/seq/",
+        isEval=False,
+        fold=1,
+        n_sequences=1,
+        useNorm=False,
+        seq_stride=None,
+    ):
+        self.root_path = root_path
+        self.dst_path = "{}epochs/fold_{}/".format(data_path, fold)
+
+        if not os.path.exists(self.dst_path):
+            print(
+                ">>>>>>>>Starting Processing and Splitting Raw Data Fold{}<<<<<<<<<<<<<<<<<<<".format(
+                    fold
                 )
             )
-            self.val_labels = torch.from_numpy(
-                np.load(
-                    "{}val_label{}.npy".format(self.dst_path, fold), allow_pickle=True
+            logging.getLogger("logger").info(
+                f">>>>>>>>Starting Processing and Splitting Raw Data Fold{fold}<<<<<<<<<<<<<<<<<<<"
+            )
+            os.makedirs(self.dst_path)
+            trace_files = sorted(glob(self.root_path + "*data.npy"))
+            label_files = sorted(glob(self.root_path + "*label.npy"))
+
+            kf = KFold(n_splits=5, shuffle=True, random_state=42)
+            fold_idxs = list(kf.split(trace_files))
+            train_idxs, val_idxs = fold_idxs[fold - 1]  # Label of fold start from one
+
+            for split, idxs in (("train", train_idxs), ("val", val_idxs)):
+                traces_list = [file2tensor(trace_files[idx]) for idx in idxs]
+                stats = torch.stack([trace_stats(t) for t in traces_list])
+                labels_list = [
+                    file2tensor(label_files[idx], isLabel=True) for idx in idxs
+                ]
+                traces_list = Seq_filter_func(traces_list, labels_list)
+                labels_list = Seq_filter_func(labels_list, labels_list)
+                rec_ids = torch.cat(
+                    [torch.full((len(t),), i) for i, t in enumerate(traces_list)]
+                )
+                save_split(
+                    self.dst_path,
+                    split,
+                    fold,
+                    torch.cat(traces_list, dim=0).float(),
+                    torch.cat(labels_list, dim=0),
+                    stats,
+                    rec_ids,
                 )
+        else:
+            print(">>>>>>>>>Loading Existing Fold{}<<<<<<<<<<<<<<<<<<<<<<".format(fold))
+            logging.getLogger("logger").info(
+                f">>>>>>>>>Loading Existing Fold{fold}<<<<<<<<<<<<<<<<<<<<<<"
             )
 
-        self.traces, self.labels = (
-            (self.train_traces, self.train_labels)
-            if not isEval
-            else (self.val_traces, self.val_labels)
-        )
-        self.traces = (
-            self.traces[:, :, :, :1] if not useNorm else self.traces[:, :, :, -1:]
+        self.traces, self.labels, self.stats, self.rec_ids = load_split(
+            self.dst_path, "val" if isEval else "train", fold
         )
-        # i=0
+        self.n_sequences = n_sequences
+        self.useNorm = useNorm
+        stride = n_sequences if isEval or seq_stride is None else seq_stride
+        self.starts = window_starts(self.rec_ids, n_sequences, stride)
 
     def __len__(self):
-        return self.labels.size(0)
+        return self.starts.size(0)
 
     def __getitem__(self, idx):
-        trace = self.traces[idx]
-        label = self.labels[idx]
+        start = self.starts[idx]
+        trace = self.traces[start : start + self.n_sequences]
+        if self.useNorm:
+            trace = normalize_trace(trace, self.stats[self.rec_ids[start]])
+        label = self.labels[start : start + self.n_sequences]
         return trace, label
 
+    def get_batch(self, indices):
+        # the windows at indices, stacked by one gather, see BatchDataset
+        starts = self.starts[torch.as_tensor(indices)]
+        window = starts[:, None] + torch.arange(self.n_sequences)
+        trace = self.traces[window]
+        if self.useNorm:
+            trace = normalize_batch(trace, self.stats[self.rec_ids[starts]])
+        return trace, self.labels[window].long()
+
 
 def file2tensor_wNE(file_path, ne_file_path, norm=False, isLabel=False):
     data = torch.from_numpy(np.load(file_path))
@@ -0,0 +1,289 @@
+import os
+import re
+import json
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+FOLDS_FILE = "folds.json"
+STORE_FILE = re.compile(r"(traces|labels)_\d{5}\.bin|index\.json(\.tmp)?")
+
+
+class TraceStoreWriter:
+    """Append-only writer for a sharded, memory-mappable trace store.
+
+    The store is a directory of raw fixed-dtype shards (traces_XXXXX.bin,
+    labels_XXXXX.bin) plus index.json, which records the dtype and item shape
+    and, for every recording, the shard and item range it occupies. Each
+    append goes straight to disk, so the dataset never has to fit in memory.
+    overwrite deletes only these files from an existing directory.
+    """
+
+    def __init__(
+        self,
+        path,
+        trace_dtype="float32",
+        label_dtype="int64",
+        shard_bytes=2**30,
+        overwrite=False,
+    ):
+        self.path = path
+        self.shard_bytes = shard_bytes
+        os.makedirs(path, exist_ok=True)
+        if overwrite:
+            for file in os.listdir(path):
+                if STORE_FILE.fullmatch(file):
+                    os.remove(os.path.join(path, file))
+
+        index_file = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {
+                "trace_dtype": np.dtype(trace_dtype).str,
+                "label_dtype": np.dtype(label_dtype).str,
+                "trace_shape": None,
+                "label_shape": None,
+                "shards": [],
+                "recordings": [],
+            }
+        # never append to a shard written by a previous session
+        self._shard_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return any(rec["name"] == name for rec in self.index["recordings"])
+
+    def _new_shard(self):
+        shard_id = len(self.index["shards"])
+        self.index["shards"].append(
+            {
+                "traces": f"traces_{shard_id:05d}.bin",
+                "labels": f"labels_{shard_id:05d}.bin",
+                "n_items": 0,
+            }
+        )
+        # truncate what a crashed session may have written past the last
+        # index.json under the same shard names
+        for key in ("traces", "labels"):
+            open(os.path.join(self.path, self.index["shards"][-1][key]), "wb").close()
+        self._shard_open = True
+        return self.index["shards"][-1]
+
+    def append(self, name, traces, labels, **meta):
+        # meta holds extra JSON-serializable fields for the recording's entry
+        traces = np.ascontiguousarray(traces, dtype=self.index["trace_dtype"])
+        labels = np.ascontiguousarray(labels, dtype=self.index["label_dtype"])
+        assert len(traces) == len(labels)
+        if self.index["trace_shape"] is None:
+            self.index["trace_shape"] = list(traces.shape[1:])
+            self.index["label_shape"] = list(labels.shape[1:])
+        assert list(traces.shape[1:]) == self.index["trace_shape"]
+        assert list(labels.shape[1:]) == self.index["label_shape"]
+
+        shard = self.index["shards"][-1] if self._shard_open else self._new_shard()
+        item_bytes = traces[0].nbytes if len(traces) else 0
+        if shard["n_items"] and (
+            (shard["n_items"] + len(traces)) * item_bytes > self.shard_bytes
+        ):
+            shard = self._new_shard()
+
+        with open(os.path.join(self.path, shard["traces"]), "ab") as f:
+            f.write(traces.tobytes())
+        with open(os.path.join(self.path, shard["labels"]), "ab") as f:
+            f.write(labels.tobytes())
+
+        start = shard["n_items"]
+        shard["n_items"] += len(traces)
+        self.index["recordings"].append(
+            {
+                "name": name,
+                "shard": len(self.index["shards"]) - 1,
+                "start": start,
+                "stop": shard["n_items"],
+                **meta,
+            }
+        )
+        self._write_index()
+
+    def _write_index(self):
+        # atomic replace, so a crash never leaves a torn index behind
+        tmp_file = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_file, os.path.join(self.path, INDEX_FILE))
+
+    def close(self):
+        self._write_index()
+        self._shard_open = False
+
+
+class TraceStore:
+    """Read side of TraceStoreWriter.
+
+    Shards are opened with np.memmap on first access, so indexing returns
+    zero-copy views and DataLoader workers share the page cache instead of
+    receiving pickled copies. The default copy-on-write mode ("c") hands out
+    writable views that torch.from_numpy accepts without copying.
+    """
+
+    def __init__(self, path, mode="c"):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.recordings = self.index["recordings"]
+        self.shard_offsets = np.cumsum(
+            [0] + [shard["n_items"] for shard in self.index["shards"]]
+        )
+        self._shards = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, INDEX_FILE))
+
+    def __getstate__(self):
+        # workers reopen the memmaps rather than unpickling their contents
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        return state
+
+    def _open(self):
+        self._shards = []
+        for shard in self.index["shards"]:
+            if shard["n_items"] == 0:
+                self._shards.append(None)
+                continue
+            traces = np.memmap(
+                os.path.join(self.path, shard["traces"]),
+                dtype=self.index["trace_dtype"],
+                mode=self.mode,
+                shape=(shard["n_items"], *self.index["trace_shape"]),
+            )
+            labels = np.memmap(
+                os.path.join(self.path, shard["labels"]),
+                dtype=self.index["label_dtype"],
+                mode=self.mode,
+                shape=(shard["n_items"], *self.index["label_shape"]),
+            )
+            self._shards.append((traces, labels))
+
+    @property
+    def shards(self):
+        if self._shards is None:
+            self._open()
+        return self._shards
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        shard_id = np.searchsorted(self.shard_offsets, idx, side="right") - 1
+        traces, labels = self.shards[shard_id]
+        offset = idx - self.shard_offsets[shard_id]
+        return traces[offset], labels[offset]
+
+    def window(self, idx, length):
+        # items idx to idx + length as one view; the range must lie inside a
+        # single recording, which never spans two shards
+        shard_id = np.searchsorted(self.shard_offsets, idx, side="right") - 1
+        traces, labels = self.shards[shard_id]
+        offset = idx - self.shard_offsets[shard_id]
+        return traces[offset : offset + length], labels[offset : offset + length]
+
+    def gather(self, idx, length=None, key=()):
+        # traces and labels of items idx, or of the windows of length items
+        # starting at idx, each as one array. key indexes the trailing dims
+        # of every trace (e.g. a channel) within the same copy. One fancy
+        # index per shard; batches that span shards are put back in order of
+        # idx.
+        idx = np.asarray(idx)
+        shard_ids = np.searchsorted(self.shard_offsets, idx, side="right") - 1
+        offsets = idx - self.shard_offsets[shard_ids]
+        if length is not None:
+            offsets = offsets[:, None] + np.arange(length)
+        traces, labels, order = [], [], []
+        for shard_id in np.unique(shard_ids):
+            rows = np.flatnonzero(shard_ids == shard_id)
+            shard_traces, shard_labels = self.shards[shard_id]
+            traces.append(shard_traces[(offsets[rows], Ellipsis) + key])
+            labels.append(shard_labels[offsets[rows]])
+            order.append(rows)
+        if len(order) == 1:
+            return traces[0], labels[0]
+        inverse = np.argsort(np.concatenate(order))
+        return np.concatenate(traces)[inverse], np.concatenate(labels)[inverse]
+
+    def __contains__(self, name):
+        return any(rec["name"] == name for rec in self.recordings)
+
+    def item_indices(self, names):
+        # global item indices of the given recordings, in the given order
+        ranges = {
+            rec["name"]: np.arange(rec["start"], rec["stop"])
+            + self.shard_offsets[rec["shard"]]
+            for rec in self.recordings
+        }
+        return np.concatenate([np.zeros(0, dtype=int)] + [ranges[n] for n in names])
+
+    def recording(self, name):
+        for rec in self.recordings:
+            if rec["name"] == name:
+                traces, labels = self.shards[rec["shard"]]
+                window = slice(rec["start"], rec["stop"])
+                return traces[window], labels[window]
+        raise KeyError(name)
+
+
+def window_offsets(count, n_sequences, stride):
+    # window starts inside a recording of count items, plus a tail window
+    # flush with the end when the last stride does not reach it
+    if count < n_sequences:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.arange(0, count - n_sequences + 1, stride)
+    if starts[-1] != count - n_sequences:
+        starts = np.append(starts, count - n_sequences)
+    return starts
+
+
+def store_windows(store, names, n_sequences, augment=False):
+    # global window starts of the named recordings of a store of flat epoch
+    # runs: non-overlapping windows plus a tail window, and with augment the
+    # REM-upsampled starts recorded with each recording
+    recordings = {rec["name"]: rec for rec in store.recordings}
+    starts = [np.zeros(0, dtype=np.int64)]
+    for name in names:
+        rec = recordings[name]
+        offset = rec["start"] + store.shard_offsets[rec["shard"]]
+        starts.append(
+            offset
+            + window_offsets(rec["stop"] - rec["start"], n_sequences, n_sequences)
+        )
+        if augment:
+            starts.append(
+                offset + np.asarray(rec.get("augment_starts", []), dtype=np.int64)
+            )
+    return np.concatenate(starts)
+
+
+def open_fold(path, fold, n_sequences, isEval=False):
+    """Store and window starts of one split of a write_all_folds dataset.
+
+    Every recording is stored once under path/store as a flat run of epochs;
+    a fold is only the list of recordings in folds.json, and a sample is the
+    global index of its first epoch. The training split additionally gets
+    the REM-upsampled starts recorded with each recording, so augmentation
+    costs one integer per window instead of a copy of it.
+    """
+    with open(os.path.join(path, FOLDS_FILE)) as f:
+        names = json.load(f)[str(fold)]["val" if isEval else "train"]
+    store = TraceStore(os.path.join(path, "store"))
+    return store, store_windows(store, names, n_sequences, augment=not isEval)
@@ -1,11 +1,5 @@
-from sklearn.metrics import (
-    f1_score,
-    accuracy_score,
-    precision_score,
-    recall_score,
-    cohen_kappa_score,
-)
 from data_provider.data_generator import data_generator, visualize_data_generator
+from data_provider.data_generator import set_epoch
 
 # from exp.exp_basic import Exp_Basic
 from models.epoch import (
@@ -45,9 +39,11 @@ from models.seq import (
 
 # from utils.tools import EarlyStopping, adjust_learning_rate, visual, test_params_flop
 from utils.metrics import ProgressMeter
-from utils.metric_tracker import batch_updater, build_tracker
+from utils.metric_tracker import all_reduce_tracker, build_confusion_tracker
 from utils.optimization import load_optimizer, load_scheduler
 from utils.tools import EarlyStopping, load_checkpoint
+from utils.distributed import distributed_model, is_distributed
+from utils.distributed import is_main_process, unwrap_model
 from utils.visualize import visualize_pred, visualize_tsne, visualize_attn
 import matplotlib.patches as mpatches
 
@@ -72,6 +68,8 @@ class Exp_Main(object):
         self.args = args
         self.device = self._acquire_device()
         self.model = self._build_model().to(self.device)
+        if is_distributed():
+            self.model = distributed_model(self.model, self.device)
         self.exp_dir = None
 
     def _acquire_device(self):
@@ -127,7 +125,7 @@ class Exp_Main(object):
         return model
 
     def _get_data(self, flag):
-        data_set, data_loader = data_generator(self.args, flag)
+        data_set, data_loader = data_generator(self.args, flag, self.device)
         return data_set, data_loader
 
     def _get_visualize_data(self):
@@ -151,7 +149,7 @@ class Exp_Main(object):
         return model
 
     def eval(self, val_loader, model, criterion, args):
-        (
+        confusion, (
             Time,
             Loss,
             Acc,
@@ -168,60 +166,46 @@ class Exp_Main(object):
             w_rec,
             s_rec,
             r_rec,
-        ) = build_tracker(isEval=True)
+        ) = build_confusion_tracker(self.device, isEval=True, n_classes=args.c_out)
         progress = ProgressMeter(
             len(val_loader), [Time, Loss, Acc, F1, Precision, Recall], prefix="Test: "
         )
-        all_pred = []
-        all_gt = []
         self.model.eval()
         with torch.no_grad():
             end = time.time()
             for i, (traces, labels) in enumerate(val_loader):
-                traces = traces.to(self.device)
-                labels = labels.to(self.device)
+                traces = traces.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True).long()
 
                 out_dict = model(traces, labels)
                 out = out_dict["out"]
                 label = out_dict["label"]
 
                 loss = criterion(out, label.view(-1))
-                pred = np.argmax(out.detach().cpu(), axis=1)
-                label = label.detach().cpu()
-                all_pred.append(pred)
-                all_gt.append(label)
                 # metric calculation and update
-                Loss.update(loss.data.item())
-                Acc.update(accuracy_score(label, pred))
-                F1.update(f1_score(label, pred, average="macro"))
-                Precision.update(precision_score(label, pred, average="macro"))
-                Recall.update(recall_score(label, pred, average="macro"))
+                Loss.update(loss.detach())
+                confusion.update(label, out.argmax(dim=1))
 
                 Time.update(time.time() - end)
 
                 if i % args.print_freq == 0:
                     progress.display(i + 1)
 
-        all_gt = np.concatenate(all_gt)
-        all_pred = np.concatenate(all_pred)
+        all_reduce_tracker(Loss, confusion)
         progress = ProgressMeter(
             len(val_loader),
             [Time, Loss, Acc, F1, Kappa, Precision, Recall],
             prefix="Test: ",
         )
-        accuracy = accuracy_score(all_gt, all_pred)
-        Acc.reset2update(accuracy)
-        F1.reset2update(f1_score(all_gt, all_pred, average="macro"))
-        Precision.reset2update(precision_score(all_gt, all_pred, average="macro"))
-        Recall.reset2update(recall_score(all_gt, all_pred, average="macro"))
-        Kappa.update(cohen_kappa_score(all_gt, all_pred))
         progress.display_summary()
-        return accuracy
+        return confusion.metrics()["accuracy"]
 
     def train(
         self, train_loader, model, criterion, optimizer, scheduler, epoch, device, args
     ):
-        Time, Loss, Acc, F1, Kappa, Precision, Recall = build_tracker(isEval=False)
+        confusion, (Time, Loss, Acc, F1, Kappa, Precision, Recall) = (
+            build_confusion_tracker(device, isEval=False, n_classes=args.c_out)
+        )
 
         progress = ProgressMeter(
             len(train_loader),
@@ -231,31 +215,23 @@ class Exp_Main(object):
 
         model.train()
         end = time.time()
-        all_gt, all_pred = [], []
         for i, (traces, labels) in enumerate(train_loader):
-            traces = traces.to(device)
-            labels = labels.to(device)
+            traces = traces.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True).long()
 
             out_dict = model(traces, labels)
             out = out_dict["out"]
             label = out_dict["label"]
 
             loss = criterion(out, label.view(-1))
-            pred = np.argmax(out.detach().cpu(), axis=1)
-            label = label.detach().cpu()
-            all_pred.append(pred)
-            all_gt.append(label)
 
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
             scheduler.step()
 
-            Loss.update(loss.data.item())
-            Acc.update(accuracy_score(label, pred))
-            F1.update(f1_score(label, pred, average="macro"))
-            Precision.update(precision_score(label, pred, average="macro"))
-            Recall.update(recall_score(label, pred, average="macro"))
+            Loss.update(loss.detach())
+            confusion.update(label, out.detach().argmax(dim=1))
 
             Time.update(time.time() - end)
             end = time.time()
@@ -263,20 +239,13 @@ class Exp_Main(object):
             if i % args.print_freq == 0:
                 progress.display(i + 1)
 
-        all_gt = np.concatenate(all_gt)
-        all_pred = np.concatenate(all_pred)
+        all_reduce_tracker(Loss, confusion)
 
         progress = ProgressMeter(
             len(train_loader),
             [Time, Loss, Acc, F1, Kappa, Precision, Recall],
             prefix="Train:",
         )
-
-        Acc.reset2update(accuracy_score(all_gt, all_pred))
-        F1.reset2update(f1_score(all_gt, all_pred, average="macro"))
-        Precision.reset2update(precision_score(all_gt, all_pred, average="macro"))
-        Recall.reset2update(recall_score(all_gt, all_pred, average="macro"))
-        Kappa.update(cohen_kappa_score(all_gt, all_pred))
         progress.display_summary()
 
     def run_train_visualize(self, setting, visualize_loader):
@@ -297,8 +266,7 @@ class Exp_Main(object):
     def run_train(self, setting):
         if self.exp_dir is None:
             self.exp_dir = os.path.join(self.args.checkpoints, setting)
-            if not os.path.exists(self.exp_dir):
-                os.makedirs(self.exp_dir)
+            os.makedirs(self.exp_dir, exist_ok=True)
 
         train_data, train_loader = self._get_data(flag="train")
         val_data, val_loader = self._get_data(flag="val")
@@ -315,6 +283,7 @@ class Exp_Main(object):
         )
 
         for epoch in range(self.args.epochs):
+            set_epoch(train_loader, epoch)
             self.train(
                 train_loader,
                 self.model,
@@ -327,7 +296,7 @@ class Exp_Main(object):
             )
             print("\n")
 
-            acc = self.eval(val_loader, self.model, criterion, self.args)
+            acc = self.eval(val_loader, unwrap_model(self.model), criterion, self.args)
             print("\n")
 
             early_stopping(
@@ -343,7 +312,8 @@ class Exp_Main(object):
                 print("Early stopping at epoch {} ...".format(epoch))
                 break
 
-        self.run_train_visualize(setting, visualize_loader)
+        if is_main_process():
+            self.run_train_visualize(setting, visualize_loader)
 
     # def run_infer_visualize(self, setting):
     #     visualize_data, visualize_loader = self._get_visualize_data()
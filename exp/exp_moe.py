@@ -128,7 +128,7 @@ class Exp_MoE(object):
         return model
 
     def _get_data(self, flag):
-        data_set, data_loader = data_generator(self.args, flag)
+        data_set, data_loader = data_generator(self.args, flag, self.device)
         return data_set, data_loader
 
     def _get_visualize_data(self):
@@ -181,8 +181,8 @@ class Exp_MoE(object):
         with torch.no_grad():
             end = time.time()
             for i, (traces, labels) in enumerate(val_loader):
-                traces = traces.to(self.device)
-                labels = labels.to(self.device)
+                traces = traces.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True).long()
 
                 out_dict = model(traces, labels)
                 out = out_dict["out"]
@@ -265,8 +265,8 @@ class Exp_MoE(object):
         end = time.time()
         all_gt, all_pred = [], []
         for i, (traces, labels) in enumerate(train_loader):
-            traces = traces.to(device)
-            labels = labels.to(device)
+            traces = traces.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True).long()
 
             out_dict = model(traces, labels)
             out = out_dict["out"]
@@ -14,18 +14,12 @@ import torch.nn.functional as F
 
 # from torch.optim import lr_scheduler
 # import matplotlib.patches as mpatches
-from sklearn.metrics import (
-    f1_score,
-    accuracy_score,
-    precision_score,
-    recall_score,
-    cohen_kappa_score,
-)
-
 from utils.metrics import ProgressMeter
-from utils.metric_tracker import build_tracker_mome
+from utils.metric_tracker import all_reduce_tracker, build_confusion_tracker_mome
 from utils.optimization import load_optimizer, load_scheduler
-from utils.tools import EarlyStopping, load_checkpoint
+from utils.tools import EarlyStopping, autocast, load_checkpoint, set_rng_state
+from utils.distributed import distributed_model, get_rank, get_world_size
+from utils.distributed import is_distributed, unwrap_model
 from utils.visualize import (
     visualize_pred,
     visualize_pred_seq,
@@ -35,6 +29,7 @@ from utils.visualize import (
 )
 from models.seq import n2nSeqNewMoE2, n2nSeqHMoE
 from data_provider.data_generator import data_generator, visualize_data_generator
+from data_provider.data_generator import set_epoch
 
 warnings.filterwarnings("ignore")
 
@@ -44,6 +39,8 @@ class Exp_MoE(object):
         self.args = args
         self.device = self._acquire_device()
         self.model = self._build_model().to(self.device)
+        if is_distributed():
+            self.model = distributed_model(self.model, self.device)
         self.exp_dir = None
         self.scale = args.scale
 
@@ -97,7 +94,7 @@ class Exp_MoE(object):
         return model
 
     def _get_data(self, flag):
-        data_set, data_loader = data_generator(self.args, flag)
+        data_set, data_loader = data_generator(self.args, flag, self.device)
         return data_set, data_loader
 
     def _get_visualize_data(self):
@@ -122,8 +119,35 @@ class Exp_MoE(object):
         model.load_state_dict(ckpt["state_dict"])
         return model
 
+    def _resume(self, optimizer, scheduler, early_stopping):
+        # restore the state saved after the last finished epoch, including
+        # the RNGs, so the run continues as if it had not been interrupted
+        ckpt = load_checkpoint(self.exp_dir, if_best=False, device=self.device)
+        if ckpt is None:
+            return 0
+        if "rng" not in ckpt:
+            raise ValueError(
+                "checkpoint has no training state to resume from, "
+                "it was written by an older version"
+            )
+        unwrap_model(self.model).load_state_dict(ckpt["state_dict"])
+        optimizer.load_state_dict(ckpt["optimizer"])
+        scheduler.load_state_dict(ckpt["scheduler"])
+        early_stopping.load_state_dict(ckpt["early_stopping"])
+        rng = ckpt["rng"]
+        if isinstance(rng, list):
+            # saved by a DDP run, one state per rank
+            if len(rng) != get_world_size():
+                raise ValueError(
+                    f"checkpoint was written by {len(rng)} processes, "
+                    f"cannot resume with {get_world_size()}"
+                )
+            rng = rng[get_rank()]
+        set_rng_state(rng)
+        return ckpt["epoch"] + 1
+
     def eval(self, val_loader, model, criterion, criterion2, criterion3, args):
-        (
+        (confusion, confusion_eeg, confusion_emg), (
             Time,
             Loss,
             Acc,
@@ -144,29 +168,26 @@ class Exp_MoE(object):
             w_rec,
             s_rec,
             r_rec,
-        ) = build_tracker_mome(isEval=True)
+        ) = build_confusion_tracker_mome(self.device, isEval=True, n_classes=args.c_out)
         progress = ProgressMeter(
             len(val_loader),
             [Time, Loss, Acc, F1, Acc_eeg, F1_eeg, Acc_emg, F1_emg, Precision, Recall],
             prefix="Test: ",
         )
-        all_pred = []
-        all_gt = []
-        all_pred_eeg, all_pred_emg = [], []
         self.model.eval()
         with torch.no_grad():
             end = time.time()
             for i, (traces, labels) in enumerate(val_loader):
-                labels = labels.type(torch.LongTensor)
-                traces = traces.to(self.device)
-                labels = labels.to(self.device)
+                traces = traces.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True).long()
 
-                out_dict = model(traces, labels)
-                out = out_dict["out"]
+                with autocast(self.device, args.precision):
+                    out_dict = model(traces, labels)
+                out = out_dict["out"].float()
                 label = out_dict["label"]
 
-                out_eeg = out_dict["out_eeg"]
-                out_emg = out_dict["out_emg"]
+                out_eeg = out_dict["out_eeg"].float()
+                out_emg = out_dict["out_emg"].float()
 
                 cls_feats = out_dict["cls_feats"]
                 cls_feats_eeg = out_dict["cls_feats_eeg"]
@@ -182,35 +203,18 @@ class Exp_MoE(object):
                 # distill_emg = criterion3(F.log_softmax(out, dim=1), F.softmax(out_emg, dim=1))
                 # loss = loss1 + (distill_eeg + distill_emg) * self.scale
 
-                pred = np.argmax(out.detach().cpu(), axis=1)
-                pred_eeg = np.argmax(out_eeg.detach().cpu(), axis=1)
-                pred_emg = np.argmax(out_emg.detach().cpu(), axis=1)
-
-                label = label.detach().cpu()
-                all_pred.append(pred)
-                all_pred_eeg.append(pred_eeg)
-                all_pred_emg.append(pred_emg)
-                all_gt.append(label)
-                # metric calculation and update
-                Loss.update(loss1.data.item())
-                Acc.update(accuracy_score(label, pred))
-                Acc_eeg.update(accuracy_score(label, pred_eeg))
-                Acc_emg.update(accuracy_score(label, pred_emg))
-                F1.update(f1_score(label, pred, average="macro"))
-                F1_eeg.update(f1_score(label, pred_eeg, average="macro"))
-                F1_emg.update(f1_score(label, pred_emg, average="macro"))
-                Precision.update(precision_score(label, pred, average="macro"))
-                Recall.update(recall_score(label, pred, average="macro"))
+                # metric update, on device; the meters read it at display
+                Loss.update(loss1.detach())
+                confusion.update(label, out.argmax(dim=1))
+                confusion_eeg.update(label, out_eeg.argmax(dim=1))
+                confusion_emg.update(label, out_emg.argmax(dim=1))
 
                 Time.update(time.time() - end)
 
                 if i % args.print_freq == 0:
                     progress.display(i + 1)
 
-        all_gt = np.concatenate(all_gt)
-        all_pred = np.concatenate(all_pred)
-        all_pred_eeg = np.concatenate(all_pred_eeg)
-        all_pred_emg = np.concatenate(all_pred_emg)
+        all_reduce_tracker(Loss, confusion, confusion_eeg, confusion_emg)
         progress = ProgressMeter(
             len(val_loader),
             [
@@ -225,21 +229,14 @@ class Exp_MoE(object):
                 Kappa,
                 Precision,
                 Recall,
+                w_f1,
+                s_f1,
+                r_f1,
             ],
             prefix="Test: ",
         )
-        accuracy = accuracy_score(all_gt, all_pred)
-        Acc.reset2update(accuracy)
-        Acc_eeg.reset2update(accuracy_score(all_gt, all_pred_eeg))
-        Acc_emg.reset2update(accuracy_score(all_gt, all_pred_emg))
-        F1.reset2update(f1_score(all_gt, all_pred, average="macro"))
-        F1_eeg.reset2update(f1_score(all_gt, all_pred_eeg, average="macro"))
-        F1_emg.reset2update(f1_score(all_gt, all_pred_emg, average="macro"))
-        Precision.reset2update(precision_score(all_gt, all_pred, average="macro"))
-        Recall.reset2update(recall_score(all_gt, all_pred, average="macro"))
-        Kappa.update(cohen_kappa_score(all_gt, all_pred))
         progress.display_summary()
-        return accuracy
+        return confusion.metrics()["accuracy"]
 
     def train(
         self,
@@ -254,7 +251,7 @@ class Exp_MoE(object):
         device,
         args,
     ):
-        (
+        (confusion, confusion_eeg, confusion_emg), (
             Time,
             Loss,
             Acc,
@@ -266,7 +263,7 @@ class Exp_MoE(object):
             Kappa,
             Precision,
             Recall,
-        ) = build_tracker_mome(isEval=False)
+        ) = build_confusion_tracker_mome(device, isEval=False, n_classes=args.c_out)
 
         progress = ProgressMeter(
             len(train_loader),
@@ -276,19 +273,18 @@ class Exp_MoE(object):
 
         model.train()
         end = time.time()
-        all_gt, all_pred = [], []
-        all_pred_eeg, all_pred_emg = [], []
         for i, (traces, labels) in enumerate(train_loader):
-            labels = labels.type(torch.LongTensor)
-            traces = traces.to(device)
-            labels = labels.to(device)
+            traces = traces.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True).long()
 
-            out_dict = model(traces, labels)
-            out = out_dict["out"]
+            # losses are computed in fp32 on the upcast logits
+            with autocast(device, args.precision):
+                out_dict = model(traces, labels)
+            out = out_dict["out"].float()
             label = out_dict["label"]
 
-            out_eeg = out_dict["out_eeg"]
-            out_emg = out_dict["out_emg"]
+            out_eeg = out_dict["out_eeg"].float()
+            out_emg = out_dict["out_emg"].float()
 
             cls_feats = out_dict["cls_feats"]
             cls_feats_eeg = out_dict["cls_feats_eeg"]
@@ -310,29 +306,16 @@ class Exp_MoE(object):
             loss = loss1 + (distill_eeg + distill_emg) * self.scale
             # loss = loss1
 
-            pred = np.argmax(out.detach().cpu(), axis=1)
-            pred_eeg = np.argmax(out_eeg.detach().cpu(), axis=1)
-            pred_emg = np.argmax(out_emg.detach().cpu(), axis=1)
-            label = label.detach().cpu()
-            all_pred.append(pred)
-            all_pred_eeg.append(pred_eeg)
-            all_pred_emg.append(pred_emg)
-            all_gt.append(label)
-
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
             scheduler.step()
 
-            Loss.update(loss1.data.item())
-            Acc.update(accuracy_score(label, pred))
-            Acc_eeg.update(accuracy_score(label, pred_eeg))
-            Acc_emg.update(accuracy_score(label, pred_emg))
-            F1.update(f1_score(label, pred, average="macro"))
-            F1_eeg.update(f1_score(label, pred_eeg, average="macro"))
-            F1_emg.update(f1_score(label, pred_emg, average="macro"))
-            Precision.update(precision_score(label, pred, average="macro"))
-            Recall.update(recall_score(label, pred, average="macro"))
+            # metric update, on device; the meters read it at display
+            Loss.update(loss1.detach())
+            confusion.update(label, out.detach().argmax(dim=1))
+            confusion_eeg.update(label, out_eeg.detach().argmax(dim=1))
+            confusion_emg.update(label, out_emg.detach().argmax(dim=1))
 
             Time.update(time.time() - end)
             end = time.time()
@@ -340,11 +323,7 @@ class Exp_MoE(object):
             if i % args.print_freq == 0:
                 progress.display(i + 1)
 
-        all_gt = np.concatenate(all_gt)
-        all_pred = np.concatenate(all_pred)
-        all_pred_eeg = np.concatenate(all_pred_eeg)
-        all_pred_emg = np.concatenate(all_pred_emg)
-
+        all_reduce_tracker(Loss, confusion, confusion_eeg, confusion_emg)
         progress = ProgressMeter(
             len(train_loader),
             [
@@ -362,16 +341,6 @@ class Exp_MoE(object):
             ],
             prefix="Train:",
         )
-
-        Acc.reset2update(accuracy_score(all_gt, all_pred))
-        Acc_eeg.reset2update(accuracy_score(all_gt, all_pred_eeg))
-        Acc_emg.reset2update(accuracy_score(all_gt, all_pred_emg))
-        F1.reset2update(f1_score(all_gt, all_pred, average="macro"))
-        F1_eeg.reset2update(f1_score(all_gt, all_pred_eeg, average="macro"))
-        F1_emg.reset2update(f1_score(all_gt, all_pred_emg, average="macro"))
-        Precision.reset2update(precision_score(all_gt, all_pred, average="macro"))
-        Recall.reset2update(recall_score(all_gt, all_pred, average="macro"))
-        Kappa.update(cohen_kappa_score(all_gt, all_pred))
         progress.display_summary()
         # print(distill_eeg.item(), distill_emg.item())
         # print(distill_eeg.item())
@@ -394,15 +363,16 @@ class Exp_MoE(object):
     def run_train(self, setting):
         if self.exp_dir is None:
             self.exp_dir = os.path.join(self.args.checkpoints, setting)
-            if not os.path.exists(self.exp_dir):
-                os.makedirs(self.exp_dir)
+            os.makedirs(self.exp_dir, exist_ok=True)
 
         train_data, train_loader = self._get_data(flag="train")
         val_data, val_loader = self._get_data(flag="val")
         # visualize_data, visualize_loader = self._get_visualize_data()
 
         train_steps = len(train_loader)
-        early_stopping = EarlyStopping(patience=self.args.patience, verbose=True)
+        early_stopping = EarlyStopping(
+            patience=self.args.patience, verbose=True, async_save=True
+        )
 
         optimizer = load_optimizer(self.args, self.model)
         criterion, criterion2, criterion3 = self._select_criterion()
@@ -411,7 +381,14 @@ class Exp_MoE(object):
             self.args, optimizer=optimizer, train_steps=train_steps
         )
 
-        for epoch in range(self.args.epochs):
+        start_epoch = 0
+        if getattr(self.args, "resume", False):
+            start_epoch = self._resume(optimizer, scheduler, early_stopping)
+
+        for epoch in range(start_epoch, self.args.epochs):
+            if early_stopping.early_stop:
+                break
+            set_epoch(train_loader, epoch)
             self.train(
                 train_loader,
                 self.model,
@@ -428,7 +405,12 @@ class Exp_MoE(object):
             logging.getLogger("logger").info("\n")
 
             acc = self.eval(
-                val_loader, self.model, criterion, criterion2, criterion3, self.args
+                val_loader,
+                unwrap_model(self.model),
+                criterion,
+                criterion2,
+                criterion3,
+                self.args,
             )
             print("\n")
             logging.getLogger("logger").info("\n")
@@ -440,6 +422,7 @@ class Exp_MoE(object):
                 model=self.model,
                 optimizer=optimizer,
                 exp_dir=self.exp_dir,
+                scheduler=scheduler,
             )
 
             if early_stopping.early_stop:
@@ -447,6 +430,7 @@ class Exp_MoE(object):
                 logging.getLogger("logger").info(f"Early stopping at epoch {epoch} ...")
                 break
 
+        early_stopping.wait()
         # self.run_train_visualize(setting, visualize_loader)
 
     def run_eval_visualize(self, setting):
@@ -104,7 +104,7 @@ class Exp_MoE(object):
         return model
 
     def _get_data(self, flag):
-        data_set, data_loader = data_generator(self.args, flag)
+        data_set, data_loader = data_generator(self.args, flag, self.device)
         return data_set, data_loader
 
     def _get_visualize_data(self):
@@ -164,9 +164,8 @@ class Exp_MoE(object):
         with torch.no_grad():
             end = time.time()
             for i, (traces, labels) in enumerate(val_loader):
-                labels = labels.type(torch.LongTensor)
-                traces = traces.to(self.device)
-                labels = labels.to(self.device)
+                traces = traces.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True).long()
 
                 out_dict = model(traces, labels)
                 out = out_dict["out"]
@@ -287,9 +286,8 @@ class Exp_MoE(object):
         all_gt, all_pred = [], []
         all_pred_eeg, all_pred_emg = [], []
         for i, (traces, labels) in enumerate(train_loader):
-            labels = labels.type(torch.LongTensor)
-            traces = traces.to(device)
-            labels = labels.to(device)
+            traces = traces.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True).long()
 
             out_dict = model(traces, labels)
             loss = out_dict["loss"]
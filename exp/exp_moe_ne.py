@@ -1,11 +1,5 @@
-from sklearn.metrics import (
-    f1_score,
-    accuracy_score,
-    precision_score,
-    recall_score,
-    cohen_kappa_score,
-)
 from data_provider.data_generator_ne import data_generator, visualize_data_generator
+from data_provider.data_generator import set_epoch
 
 # from exp.exp_basic import Exp_Basic
 from models.epoch import (
@@ -46,13 +40,11 @@ from models.seq import (
 
 # from utils.tools import EarlyStopping, adjust_learning_rate, visual, test_params_flop
 from utils.metrics import ProgressMeter
-from utils.metric_tracker import (
-    batch_updater,
-    build_tracker_mome,
-    build_tracker_mome_wNE,
-)
+from utils.metric_tracker import all_reduce_tracker, build_confusion_tracker_mome_wNE
 from utils.optimization import load_optimizer, load_scheduler
 from utils.tools import EarlyStopping, load_checkpoint
+from utils.distributed import distributed_model, is_distributed
+from utils.distributed import is_main_process, unwrap_model
 from utils.visualize import (
     visualize_pred,
     visualize_pred_seq,
@@ -84,6 +76,8 @@ class Exp_MoE(object):
         self.args = args
         self.device = self._acquire_device()
         self.model = self._build_model().to(self.device)
+        if is_distributed():
+            self.model = distributed_model(self.model, self.device)
         self.exp_dir = None
         self.scale = args.scale
 
@@ -142,7 +136,7 @@ class Exp_MoE(object):
         return model
 
     def _get_data(self, flag):
-        data_set, data_loader = data_generator(self.args, flag)
+        data_set, data_loader = data_generator(self.args, flag, self.device)
         return data_set, data_loader
 
     def _get_visualize_data(self):
@@ -168,7 +162,7 @@ class Exp_MoE(object):
         return model
 
     def eval(self, val_loader, model, criterion, criterion2, criterion3, args):
-        (
+        (confusion, confusion_eeg, confusion_emg, confusion_ne), (
             Time,
             Loss,
             Acc,
@@ -191,7 +185,9 @@ class Exp_MoE(object):
             w_rec,
             s_rec,
             r_rec,
-        ) = build_tracker_mome_wNE(isEval=True)
+        ) = build_confusion_tracker_mome_wNE(
+            self.device, isEval=True, n_classes=args.c_out
+        )
         progress = ProgressMeter(
             len(val_loader),
             [
@@ -210,16 +206,13 @@ class Exp_MoE(object):
             ],
             prefix="Test: ",
         )
-        all_pred = []
-        all_gt = []
-        all_pred_eeg, all_pred_emg, all_pred_ne = [], [], []
         self.model.eval()
         with torch.no_grad():
             end = time.time()
             for i, (traces, nes, labels) in enumerate(val_loader):
-                traces = traces.to(self.device)
-                nes = nes.to(self.device)
-                labels = labels.to(self.device)
+                traces = traces.to(self.device, non_blocking=True)
+                nes = nes.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True).long()
 
                 out_dict = model(traces, nes, labels)
                 out = out_dict["out"]
@@ -244,40 +237,19 @@ class Exp_MoE(object):
                 # distill_emg = criterion3(F.log_softmax(out, dim=1), F.softmax(out_emg, dim=1))
                 # loss = loss1 + (distill_eeg + distill_emg) * self.scale
 
-                pred = np.argmax(out.detach().cpu(), axis=1)
-                pred_eeg = np.argmax(out_eeg.detach().cpu(), axis=1)
-                pred_emg = np.argmax(out_emg.detach().cpu(), axis=1)
-                pred_ne = np.argmax(out_ne.detach().cpu(), axis=1)
-
-                label = label.detach().cpu()
-                all_pred.append(pred)
-                all_pred_eeg.append(pred_eeg)
-                all_pred_emg.append(pred_emg)
-                all_pred_ne.append(pred_ne)
-                all_gt.append(label)
                 # metric calculation and update
-                Loss.update(loss1.data.item())
-                Acc.update(accuracy_score(label, pred))
-                Acc_eeg.update(accuracy_score(label, pred_eeg))
-                Acc_emg.update(accuracy_score(label, pred_emg))
-                Acc_ne.update(accuracy_score(label, pred_ne))
-                F1.update(f1_score(label, pred, average="macro"))
-                F1_eeg.update(f1_score(label, pred_eeg, average="macro"))
-                F1_emg.update(f1_score(label, pred_emg, average="macro"))
-                F1_ne.update(f1_score(label, pred_ne, average="macro"))
-                Precision.update(precision_score(label, pred, average="macro"))
-                Recall.update(recall_score(label, pred, average="macro"))
+                Loss.update(loss1.detach())
+                confusion.update(label, out.argmax(dim=1))
+                confusion_eeg.update(label, out_eeg.argmax(dim=1))
+                confusion_emg.update(label, out_emg.argmax(dim=1))
+                confusion_ne.update(label, out_ne.argmax(dim=1))
 
                 Time.update(time.time() - end)
 
                 if i % args.print_freq == 0:
                     progress.display(i + 1)
 
-        all_gt = np.concatenate(all_gt)
-        all_pred = np.concatenate(all_pred)
-        all_pred_eeg = np.concatenate(all_pred_eeg)
-        all_pred_emg = np.concatenate(all_pred_emg)
-        all_pred_ne = np.concatenate(all_pred_ne)
+        all_reduce_tracker(Loss, confusion, confusion_eeg, confusion_emg, confusion_ne)
         progress = ProgressMeter(
             len(val_loader),
             [
@@ -297,20 +269,8 @@ class Exp_MoE(object):
             ],
             prefix="Test: ",
         )
-        accuracy = accuracy_score(all_gt, all_pred)
-        Acc.reset2update(accuracy)
-        Acc_eeg.reset2update(accuracy_score(all_gt, all_pred_eeg))
-        Acc_emg.reset2update(accuracy_score(all_gt, all_pred_emg))
-        Acc_ne.reset2update(accuracy_score(all_gt, all_pred_ne))
-        F1.reset2update(f1_score(all_gt, all_pred, average="macro"))
-        F1_eeg.reset2update(f1_score(all_gt, all_pred_eeg, average="macro"))
-        F1_emg.reset2update(f1_score(all_gt, all_pred_emg, average="macro"))
-        F1_ne.reset2update(f1_score(all_gt, all_pred_ne, average="macro"))
-        Precision.reset2update(precision_score(all_gt, all_pred, average="macro"))
-        Recall.reset2update(recall_score(all_gt, all_pred, average="macro"))
-        Kappa.update(cohen_kappa_score(all_gt, all_pred))
         progress.display_summary()
-        return accuracy
+        return confusion.metrics()["accuracy"]
 
     def train(
         self,
@@ -325,7 +285,7 @@ class Exp_MoE(object):
         device,
         args,
     ):
-        (
+        (confusion, confusion_eeg, confusion_emg, confusion_ne), (
             Time,
             Loss,
             Acc,
@@ -339,7 +299,7 @@ class Exp_MoE(object):
             Kappa,
             Precision,
             Recall,
-        ) = build_tracker_mome_wNE(isEval=False)
+        ) = build_confusion_tracker_mome_wNE(device, isEval=False, n_classes=args.c_out)
 
         progress = ProgressMeter(
             len(train_loader),
@@ -362,12 +322,10 @@ class Exp_MoE(object):
 
         model.train()
         end = time.time()
-        all_gt, all_pred = [], []
-        all_pred_eeg, all_pred_emg, all_pred_ne = [], [], []
         for i, (traces, nes, labels) in enumerate(train_loader):
-            traces = traces.to(device)
-            nes = nes.to(device)
-            labels = labels.to(device)
+            traces = traces.to(device, non_blocking=True)
+            nes = nes.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True).long()
 
             out_dict = model(traces, nes, labels)
             out = out_dict["out"]
@@ -399,33 +357,16 @@ class Exp_MoE(object):
             loss = loss1 + (distill_eeg + distill_emg + distill_ne) * self.scale
             # loss = loss1
 
-            pred = np.argmax(out.detach().cpu(), axis=1)
-            pred_eeg = np.argmax(out_eeg.detach().cpu(), axis=1)
-            pred_emg = np.argmax(out_emg.detach().cpu(), axis=1)
-            pred_ne = np.argmax(out_ne.detach().cpu(), axis=1)
-            label = label.detach().cpu()
-            all_pred.append(pred)
-            all_pred_eeg.append(pred_eeg)
-            all_pred_emg.append(pred_emg)
-            all_pred_ne.append(pred_ne)
-            all_gt.append(label)
-
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
             scheduler.step()
 
-            Loss.update(loss1.data.item())
-            Acc.update(accuracy_score(label, pred))
-            Acc_eeg.update(accuracy_score(label, pred_eeg))
-            Acc_emg.update(accuracy_score(label, pred_emg))
-            Acc_ne.update(accuracy_score(label, pred_ne))
-            F1.update(f1_score(label, pred, average="macro"))
-            F1_eeg.update(f1_score(label, pred_eeg, average="macro"))
-            F1_emg.update(f1_score(label, pred_emg, average="macro"))
-            F1_ne.update(f1_score(label, pred_ne, average="macro"))
-            Precision.update(precision_score(label, pred, average="macro"))
-            Recall.update(recall_score(label, pred, average="macro"))
+            Loss.update(loss1.detach())
+            confusion.update(label, out.detach().argmax(dim=1))
+            confusion_eeg.update(label, out_eeg.detach().argmax(dim=1))
+            confusion_emg.update(label, out_emg.detach().argmax(dim=1))
+            confusion_ne.update(label, out_ne.detach().argmax(dim=1))
 
             Time.update(time.time() - end)
             end = time.time()
@@ -433,11 +374,7 @@ class Exp_MoE(object):
             if i % args.print_freq == 0:
                 progress.display(i + 1)
 
-        all_gt = np.concatenate(all_gt)
-        all_pred = np.concatenate(all_pred)
-        all_pred_eeg = np.concatenate(all_pred_eeg)
-        all_pred_emg = np.concatenate(all_pred_emg)
-        all_pred_ne = np.concatenate(all_pred_ne)
+        all_reduce_tracker(Loss, confusion, confusion_eeg, confusion_emg, confusion_ne)
 
         progress = ProgressMeter(
             len(train_loader),
@@ -458,18 +395,6 @@ class Exp_MoE(object):
             ],
             prefix="Train:",
         )
-
-        Acc.reset2update(accuracy_score(all_gt, all_pred))
-        Acc_eeg.reset2update(accuracy_score(all_gt, all_pred_eeg))
-        Acc_emg.reset2update(accuracy_score(all_gt, all_pred_emg))
-        Acc_ne.reset2update(accuracy_score(all_gt, all_pred_ne))
-        F1.reset2update(f1_score(all_gt, all_pred, average="macro"))
-        F1_eeg.reset2update(f1_score(all_gt, all_pred_eeg, average="macro"))
-        F1_emg.reset2update(f1_score(all_gt, all_pred_emg, average="macro"))
-        F1_ne.reset2update(f1_score(all_gt, all_pred_ne, average="macro"))
-        Precision.reset2update(precision_score(all_gt, all_pred, average="macro"))
-        Recall.reset2update(recall_score(all_gt, all_pred, average="macro"))
-        Kappa.update(cohen_kappa_score(all_gt, all_pred))
         progress.display_summary()
         # print(distill_eeg.item(), distill_emg.item())
         # print(distill_eeg.item())
@@ -492,8 +417,7 @@ class Exp_MoE(object):
     def run_train(self, setting):
         if self.exp_dir is None:
             self.exp_dir = os.path.join(self.args.checkpoints, setting)
-            if not os.path.exists(self.exp_dir):
-                os.makedirs(self.exp_dir)
+            os.makedirs(self.exp_dir, exist_ok=True)
 
         train_data, train_loader = self._get_data(flag="train")
         val_data, val_loader = self._get_data(flag="val")
@@ -510,6 +434,7 @@ class Exp_MoE(object):
         )
 
         for epoch in range(self.args.epochs):
+            set_epoch(train_loader, epoch)
             self.train(
                 train_loader,
                 self.model,
@@ -525,7 +450,12 @@ class Exp_MoE(object):
             print("\n")
 
             acc = self.eval(
-                val_loader, self.model, criterion, criterion2, criterion3, self.args
+                val_loader,
+                unwrap_model(self.model),
+                criterion,
+                criterion2,
+                criterion3,
+                self.args,
             )
             print("\n")
 
@@ -542,7 +472,8 @@ class Exp_MoE(object):
                 print("Early stopping at epoch {} ...".format(epoch))
                 break
 
-        self.run_train_visualize(setting, visualize_loader)
+        if is_main_process():
+            self.run_train_visualize(setting, visualize_loader)
 
     def run_eval_visualize(self, setting):
         visualize_data, visualize_loader = self._get_visualize_data()
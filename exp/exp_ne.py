@@ -127,7 +127,7 @@ class Exp_Main(object):
         return model
 
     def _get_data(self, flag):
-        data_set, data_loader = data_generator(self.args, flag)
+        data_set, data_loader = data_generator(self.args, flag, self.device)
         return data_set, data_loader
 
     def _get_visualize_data(self):
@@ -178,9 +178,9 @@ class Exp_Main(object):
         with torch.no_grad():
             end = time.time()
             for i, (traces, nes, labels) in enumerate(val_loader):
-                traces = traces.to(self.device)
-                nes = nes.to(self.device)
-                labels = labels.to(self.device)
+                traces = traces.to(self.device, non_blocking=True)
+                nes = nes.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True).long()
 
                 out_dict = model(traces, nes, labels)
                 out = out_dict["out"]
@@ -234,9 +234,9 @@ class Exp_Main(object):
         end = time.time()
         all_gt, all_pred = [], []
         for i, (traces, nes, labels) in enumerate(train_loader):
-            traces = traces.to(device)
-            nes = nes.to(device)
-            labels = labels.to(device)
+            traces = traces.to(device, non_blocking=True)
+            nes = nes.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True).long()
 
             out_dict = model(traces, nes, labels)
             out = out_dict["out"]
@@ -0,0 +1,119 @@
+import torch
+from torch import nn
+
+from run_inference import build_args, load_model, load_runtime
+
+
+# The model is exported as two graphs, the per-epoch encoder and the
+# sequence stage, so that exported runtimes support the same two-stage
+# inference (encode each epoch once, then score windows of epoch tokens)
+# as the eager model. Both take a dynamic batch size; the encoder also
+# takes any number of epochs. The wrappers are put in eval mode before
+# export, since torch.onnx.export restores their mode afterwards, and a new
+# module is in training mode.
+class EpochEncoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, traces):
+        return self.model.encode_epochs(traces)
+
+
+class SequenceHead(nn.Module):
+    # fused logits; for the CRF model these are the emissions to decode
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, cls_eeg, cls_emg):
+        return self.model.predict_sequence(cls_eeg, cls_emg)
+
+
+def example_inputs(model, args, batch_size=2):
+    traces = torch.randn(batch_size, args.n_sequences, 2, 1, args.seq_len)
+    with torch.no_grad():
+        cls_eeg, cls_emg = model.encode_epochs(traces)
+    return traces, cls_eeg, cls_emg
+
+
+@torch.no_grad()
+def export_torchscript(model, prefix, args=None):
+    args = args or build_args()
+    model.eval()
+    traces, cls_eeg, cls_emg = example_inputs(model, args)
+    torch.jit.trace(EpochEncoder(model).eval(), traces).save(f"{prefix}.encoder.pt")
+    torch.jit.trace(SequenceHead(model).eval(), (cls_eeg, cls_emg)).save(
+        f"{prefix}.sequence.pt"
+    )
+    return f"{prefix}.encoder.pt", f"{prefix}.sequence.pt"
+
+
+@torch.no_grad()
+def export_onnx(model, prefix, args=None, opset_version=17):
+    args = args or build_args()
+    model.eval()
+    traces, cls_eeg, cls_emg = example_inputs(model, args)
+    epochs = {0: "batch", 1: "n_epochs"}
+    torch.onnx.export(
+        EpochEncoder(model).eval(),
+        (traces,),
+        f"{prefix}.encoder.onnx",
+        input_names=["traces"],
+        output_names=["cls_eeg", "cls_emg"],
+        dynamic_axes={"traces": epochs, "cls_eeg": epochs, "cls_emg": epochs},
+        opset_version=opset_version,
+        dynamo=False,
+    )
+    torch.onnx.export(
+        SequenceHead(model).eval(),
+        (cls_eeg, cls_emg),
+        f"{prefix}.sequence.onnx",
+        input_names=["cls_eeg", "cls_emg"],
+        output_names=["logits"],
+        dynamic_axes={
+            "cls_eeg": {0: "batch"},
+            "cls_emg": {0: "batch"},
+            "logits": {0: "batch_x_n_sequences"},
+        },
+        opset_version=opset_version,
+        dynamo=False,
+    )
+    return f"{prefix}.encoder.onnx", f"{prefix}.sequence.onnx"
+
+
+@torch.no_grad()
+def check_parity(model, prefix, backend, batch_sizes=(1, 3, 8), atol=1e-4, args=None):
+    # max abs difference of the exported logits to eager predict
+    args = args or build_args()
+    runtime, _ = load_runtime(prefix, backend)
+    max_diff = 0.0
+    for batch_size in batch_sizes:
+        traces = torch.randn(batch_size, args.n_sequences, 2, 1, args.seq_len)
+        diff = (runtime.predict(traces) - model.predict(traces)).abs().max().item()
+        print(f"{backend}, batch {batch_size}: max abs diff {diff:.2e}")
+        max_diff = max(max_diff, diff)
+    assert max_diff <= atol, f"{backend} export differs from eager by {max_diff}"
+    return max_diff
+
+
+# %%
+if __name__ == "__main__":
+    checkpoint_path = "C:/Users/yzhao/python_projects/sleep_scoring/models/sdreamer/checkpoints/SeqNewMoE2_Seq_ftALL_pl16_ns64_dm128_el2_dff512_eb0_scale0.0_bs64_f1_augment_10.pth.tar"
+    prefix = "C:/Users/yzhao/python_projects/sleep_scoring/models/sdreamer/exported/SeqNewMoE2_f1"
+    crf = False  # export the emissions of n2nSeqNewMoE2_crf instead
+
+    if crf:
+        from models.seq import n2nSeqNewMoE2_crf
+
+        model = n2nSeqNewMoE2_crf.Model(build_args())
+        ckpt = torch.load(checkpoint_path, map_location="cpu")
+        model.load_state_dict(ckpt["state_dict"])
+        model.eval()
+    else:
+        model, _ = load_model(checkpoint_path, "cpu")
+
+    export_torchscript(model, prefix)
+    export_onnx(model, prefix)
+    check_parity(model, prefix, "torchscript")
+    check_parity(model, prefix, "onnx")
@@ -939,7 +939,11 @@ class Attention(nn.Module):
                     self.v_bias,
                 )
             )
-        qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
+        if qkv_bias is None:
+            # calling the module lets a quantized Linear stand in for it
+            qkv = self.qkv(x)
+        else:
+            qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
 
         q, k, v = (
@@ -949,15 +953,18 @@ class Attention(nn.Module):
         )  # make torchscript happy (cannot use tensor as tuple)
 
         q = q * self.scale
-        attn = q.float() @ k.float().transpose(-2, -1)
-
-        if relative_position_bias is not None:
-            attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            mask = mask.bool()
-            attn = attn.masked_fill(~mask[:, None, None, :], float("-inf"))
-        attn = attn.softmax(dim=-1).type_as(x)
+        # scores and softmax stay in fp32 under autocast, which would
+        # otherwise run this matmul in bf16 despite the upcast
+        with torch.autocast(q.device.type, enabled=False):
+            attn = q.float() @ k.float().transpose(-2, -1)
+
+            if relative_position_bias is not None:
+                attn = attn + relative_position_bias.unsqueeze(0)
+
+            if mask is not None:
+                mask = mask.bool()
+                attn = attn.masked_fill(~mask[:, None, None, :], float("-inf"))
+            attn = attn.softmax(dim=-1).type_as(x)
         attn = self.attn_drop(attn)
 
         x = (attn @ v).transpose(1, 2).reshape(B, N, C)
@@ -1010,7 +1017,11 @@ class Attention_Visual(nn.Module):
                     self.v_bias,
                 )
             )
-        qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
+        if qkv_bias is None:
+            # calling the module lets a quantized Linear stand in for it
+            qkv = self.qkv(x)
+        else:
+            qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
 
         q, k, v = (
@@ -1020,15 +1031,18 @@ class Attention_Visual(nn.Module):
         )  # make torchscript happy (cannot use tensor as tuple)
 
         q = q * self.scale
-        attn = q.float() @ k.float().transpose(-2, -1)
-
-        if relative_position_bias is not None:
-            attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            mask = mask.bool()
-            attn = attn.masked_fill(~mask[:, None, None, :], float("-inf"))
-        attn = attn.softmax(dim=-1).type_as(x)
+        # scores and softmax stay in fp32 under autocast, which would
+        # otherwise run this matmul in bf16 despite the upcast
+        with torch.autocast(q.device.type, enabled=False):
+            attn = q.float() @ k.float().transpose(-2, -1)
+
+            if relative_position_bias is not None:
+                attn = attn + relative_position_bias.unsqueeze(0)
+
+            if mask is not None:
+                mask = mask.bool()
+                attn = attn.masked_fill(~mask[:, None, None, :], float("-inf"))
+            attn = attn.softmax(dim=-1).type_as(x)
         attn = self.attn_drop(attn)
 
         x = (attn @ v).transpose(1, 2).reshape(B, N, C)
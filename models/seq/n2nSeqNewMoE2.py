@@ -100,28 +100,43 @@ class Model(nn.Module):
         self.cls_head_eeg = cls_head(inner_dim, c_out)
         self.cls_head_emg = cls_head(inner_dim, c_out)
 
-    def forward(self, x, label):
-        # note: if no context is given, cross-attention defaults to self-attention
-        # x --> [batch, trace, channel, inner_dim]
+    def encode_epochs(self, x):
+        # per-epoch stage: every epoch is encoded on its own, so the CLS
+        # tokens of an epoch do not depend on the window it appears in
+        # x --> [batch, n_seq, trace, channel, seq_len]
         eeg, emg = x[:, :, 0], x[:, :, 1]
 
         eeg, eeg_attn = self.eeg_transformer(eeg)
         emg, emg_attn = self.emg_transformer(emg)
 
-        cls_eeg, cls_emg = eeg[:, :, -1], emg[:, :, -1]
-        # x_our --> [b, n, 2d]
+        # cls_eeg, cls_emg --> [batch, n_seq, inner_dim]
+        return eeg[:, :, -1], emg[:, :, -1]
 
+    def forward(self, x, label):
+        # note: if no context is given, cross-attention defaults to self-attention
+        return self.forward_sequence(*self.encode_epochs(x), label)
+
+    def predict(self, x):
+        # inference only: fused logits [(batch n_seq), num_classes], skipping
+        # the single-modality branches that forward also computes for training
+        return self.predict_sequence(*self.encode_epochs(x))
+
+    def predict_sequence(self, cls_eeg, cls_emg, return_infer=False):
+        # fused logits [(batch n_seq), num_classes]; return_infer also returns
+        # the moe_transformer outputs
         infer = self.moe_transformer.infer(cls_eeg, cls_emg)
-        logits = self.cls_head(
-            infer["cls_feats"]
-        )  # shape [batch_size, n_seq, num_classes]
+        logits = rearrange(self.cls_head(infer["cls_feats"]), "b e d -> (b e) d")
+        return (logits, infer) if return_infer else logits
+
+    def forward_sequence(self, cls_eeg, cls_emg, label=None):
+        # sequence stage: mixes the epoch CLS tokens across the window
+        logits, infer = self.predict_sequence(cls_eeg, cls_emg, return_infer=True)
         infer_eeg = self.moe_transformer.infer_eeg(cls_eeg)
         infer_emg = self.moe_transformer.infer_emg(cls_emg)
 
         logits_eeg = self.cls_head_eeg(infer_eeg["cls_feats"])
         logits_emg = self.cls_head_emg(infer_emg["cls_feats"])
 
-        logits = rearrange(logits, "b e d -> (b e) d")
         logits_eeg = rearrange(logits_eeg, "b e d -> (b e) d")
         logits_emg = rearrange(logits_emg, "b e d -> (b e) d")
         if label is not None:
@@ -116,21 +116,33 @@ class Model(nn.Module):
         self.cls_head_emg = cls_head(inner_dim, c_out)
         self.crf = CRF(c_out, batch_first=True)
 
-    def forward(self, x, label):
-        # note: if no context is given, cross-attention defaults to self-attention
-        # x --> [batch, trace, channel, inner_dim]
+    def encode_epochs(self, x):
+        # per-epoch stage, as in n2nSeqNewMoE2.Model
+        # x --> [batch, n_seq, trace, channel, seq_len]
         eeg, emg = x[:, :, 0], x[:, :, 1]
 
         eeg, eeg_attn = self.eeg_transformer(eeg)
         emg, emg_attn = self.emg_transformer(emg)
 
-        cls_eeg, cls_emg = eeg[:, :, -1], emg[:, :, -1]
-        # x_our --> [b, n, 2d]
+        return eeg[:, :, -1], emg[:, :, -1]
+
+    def predict(self, x):
+        # CRF emissions [(batch n_seq), num_classes]; decode with self.crf
+        return self.predict_sequence(*self.encode_epochs(x))
 
+    def predict_sequence(self, cls_eeg, cls_emg, return_infer=False):
+        # CRF emissions [(batch n_seq), num_classes]; return_infer also
+        # returns the moe_transformer outputs
         infer = self.moe_transformer.infer(cls_eeg, cls_emg)
-        logits = self.cls_head(
-            infer["cls_feats"]
-        )  # shape [batch_size, n_seq, num_classes]
+        logits = rearrange(self.cls_head(infer["cls_feats"]), "b e d -> (b e) d")
+        return (logits, infer) if return_infer else logits
+
+    def forward(self, x, label):
+        # note: if no context is given, cross-attention defaults to self-attention
+        cls_eeg, cls_emg = self.encode_epochs(x)
+        logits, infer = self.predict_sequence(cls_eeg, cls_emg, return_infer=True)
+        # the CRF runs over the emissions as [batch_size, n_seq, num_classes]
+        emissions = rearrange(logits, "(b e) d -> b e d", b=cls_eeg.shape[0])
         infer_eeg = self.moe_transformer.infer_eeg(cls_eeg)
         infer_emg = self.moe_transformer.infer_emg(cls_emg)
 
@@ -139,14 +151,11 @@ class Model(nn.Module):
 
         loss = 0
         if label is not None:
-            loss = -self.crf(logits, torch.squeeze(label, dim=-1), mask=None)
+            loss = -self.crf(emissions, torch.squeeze(label, dim=-1), mask=None)
             label = rearrange(label, "b e d -> (b e) d")
 
-        predictions = torch.FloatTensor(self.crf.decode(logits))
+        predictions = torch.FloatTensor(self.crf.decode(emissions))
         predictions = predictions.flatten()
-        logits = rearrange(
-            logits, "b e d -> (b e) d"
-        )  # shape [batch_size * n_seq, num_classes]
         logits_eeg = rearrange(logits_eeg, "b e d -> (b e) d")
         logits_emg = rearrange(logits_emg, "b e d -> (b e) d")
 
@@ -227,6 +227,25 @@ def argparser():
         metavar="N",
         help="print frequency (default: 10)",
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="bf16 runs the model under autocast",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=False,
+        help="copy the next batch to the GPU while the model runs",
+    )
+    parser.add_argument(
+        "--batch_gather",
+        action="store_true",
+        default=False,
+        help="load each batch with one indexed gather instead of per-item workers",
+    )
 
     args = parser.parse_args()
     return args
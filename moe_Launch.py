@@ -227,6 +227,12 @@ def argparser():
         metavar="N",
         help="print frequency (default: 10)",
     )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=False,
+        help="copy the next batch to the GPU while the model runs",
+    )
 
     args = parser.parse_args()
     return args
@@ -5,6 +5,7 @@ import torch
 from exp.exp_moe2 import Exp_MoE
 import random
 import numpy as np
+from utils.distributed import cleanup_distributed, init_distributed
 
 
 def argparser():
@@ -54,6 +55,12 @@ def argparser():
     parser.add_argument(
         "--n_sequences", type=int, default=16, help="number of input sequences"
     )
+    parser.add_argument(
+        "--seq_stride",
+        type=int,
+        default=None,
+        help="window stride for --data SeqWindow, defaults to n_sequences",
+    )
     parser.add_argument(
         "--useNorm", action="store_false", help="pre normalize data", default=True
     )
@@ -231,6 +238,43 @@ def argparser():
         metavar="N",
         help="print frequency (default: 10)",
     )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="bf16 runs the model under autocast",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=False,
+        help="copy the next batch to the GPU while the model runs",
+    )
+    parser.add_argument(
+        "--batch_gather",
+        action="store_true",
+        default=False,
+        help="load each batch with one indexed gather instead of per-item workers",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="continue training from ckpt.pth.tar in the checkpoint directory",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        default=False,
+        help="DistributedDataParallel with one process per GPU, launched by torchrun",
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default=None,
+        help="process group backend, nccl on GPUs and gloo on CPU by default",
+    )
 
     args = parser.parse_args()
     return args
@@ -252,6 +296,8 @@ def main():
     seed_everything(args.seed)
 
     args.use_gpu = True if torch.cuda.is_available() and args.use_gpu else False
+    if args.distributed:
+        init_distributed(args)
 
     print("Args in experiment:")
     print(args)
@@ -280,6 +326,8 @@ def main():
 
         torch.cuda.empty_cache()
 
+    cleanup_distributed()
+
 
 if __name__ == "__main__":
     main()
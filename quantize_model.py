@@ -0,0 +1,142 @@
+import io
+import os
+import json
+import time
+
+import numpy as np
+import torch
+from scipy.io import loadmat
+from sklearn.metrics import accuracy_score, cohen_kappa_score
+
+from run_inference import load_model, normalize_recording, score_epochs
+from run_inference import sliding_windows
+from utils.preprocessing import trim_missing_labels
+from utils.quantization import linear_names, quantize_linear
+
+
+def calibration_windows(mat_files, args, windows_per_file=8):
+    # non-overlapping windows, evenly spread over each calibration recording
+    windows = []
+    for mat_file in mat_files:
+        epochs = normalize_recording(loadmat(mat_file)).float()
+        view, starts = sliding_windows(epochs, args.n_sequences, args.n_sequences)
+        pick = np.linspace(0, len(starts) - 1, windows_per_file).round().astype(int)
+        windows.append(view[starts[np.unique(pick)]])
+    return torch.cat(windows)
+
+
+@torch.no_grad()
+def predict_probs(model, windows, batch_size=8):
+    return torch.cat(
+        [
+            torch.softmax(model.predict(windows[i : i + batch_size]), dim=1)
+            for i in range(0, len(windows), batch_size)
+        ]
+    )
+
+
+def calibrate(model, windows, tolerance=0.01):
+    """Names of the nn.Linear layers that are safe to quantize.
+
+    Each layer is quantized on its own and run over the calibration windows.
+    Layers whose mean absolute change of the class probabilities exceeds
+    tolerance stay in fp32.
+    """
+    reference = predict_probs(model, windows)
+    errors = {}
+    for name in linear_names(model):
+        probs = predict_probs(quantize_linear(model, [name]), windows)
+        errors[name] = (probs - reference).abs().mean().item()
+    keep_fp32 = [name for name, error in errors.items() if error > tolerance]
+    for name in keep_fp32:
+        print(f"keeping {name} in fp32 (error {errors[name]:.4f})")
+    return [name for name in errors if name not in keep_fp32], errors
+
+
+def quantize_checkpoint(
+    checkpoint_path, quantized_path, calibration_files, tolerance=0.01
+):
+    model, args = load_model(checkpoint_path, "cpu")
+    windows = calibration_windows(calibration_files, args)
+    module_names, _ = calibrate(model, windows, tolerance)
+    qmodel = quantize_linear(model, module_names)
+    torch.save(
+        {"state_dict": qmodel.state_dict(), "quantized": module_names}, quantized_path
+    )
+    return model, qmodel, args
+
+
+def read_labels(mat):
+    sleep_scores = trim_missing_labels(mat["sleep_scores"].flatten(), trim="b")
+    return sleep_scores
+
+
+def evaluate(model, args, mat_files, batch_size=32):
+    # per-epoch predictions and labels over the given recordings
+    all_pred, all_label = [], []
+    for mat_file in mat_files:
+        mat = loadmat(mat_file)
+        epochs = normalize_recording(mat).float()
+        pred, _ = score_epochs(model, epochs, args, batch_size).result()
+        labels = read_labels(mat)
+        n = min(len(pred), len(labels))
+        all_pred.append(pred[:n])
+        all_label.append(labels[:n])
+    return np.concatenate(all_pred), np.concatenate(all_label)
+
+
+def model_size(model):
+    # bytes of the serialized state dict
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+@torch.no_grad()
+def throughput(model, args, batch_size=8, repeats=3):
+    # epochs per second of model.predict on one batch of random windows
+    x = torch.randn(batch_size, args.n_sequences, 2, 1, args.seq_len)
+    model.predict(x)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.predict(x)
+    return repeats * batch_size * args.n_sequences / (time.perf_counter() - start)
+
+
+def compare(model, qmodel, args, mat_files):
+    pred, labels = evaluate(model, args, mat_files)
+    qpred, _ = evaluate(qmodel, args, mat_files)
+    valid = np.isin(labels, [0, 1, 2])
+    report = {}
+    for name, m, p in (("fp32", model, pred), ("int8", qmodel, qpred)):
+        report[name] = {
+            "accuracy": accuracy_score(labels[valid], p[valid]),
+            "kappa": cohen_kappa_score(labels[valid], p[valid]),
+            "size_mb": model_size(m) / 2**20,
+            "epochs_per_s": throughput(m, args),
+        }
+    report["agreement"] = float(np.mean(pred == qpred))
+    return report
+
+
+# %%
+if __name__ == "__main__":
+    checkpoint_path = "C:/Users/yzhao/python_projects/sleep_scoring/models/sdreamer/checkpoints/SeqNewMoE2_Seq_ftALL_pl16_ns64_dm128_el2_dff512_eb0_scale0.0_bs64_f1_augment_10.pth.tar"
+    quantized_path = checkpoint_path.replace(".pth.tar", "_int8.pth.tar")
+    data_path = "C:/Users/yzhao/python_projects/time_series/data"  # the .mat files
+    # folds.json written by write_all_folds; fold must match the checkpoint
+    folds_file = (
+        "C:/Users/yzhao/python_projects/time_series/sdreamer_data/n_seq_64/folds.json"
+    )
+    fold = 1
+
+    with open(folds_file) as f:
+        split = json.load(f)[str(fold)]
+    calibration_files = [os.path.join(data_path, file) for file in split["train"][:3]]
+    heldout_files = [os.path.join(data_path, file) for file in split["val"]]
+
+    model, qmodel, args = quantize_checkpoint(
+        checkpoint_path, quantized_path, calibration_files
+    )
+    report = compare(model, qmodel, args, heldout_files)
+    print(json.dumps(report, indent=1))
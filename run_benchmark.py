@@ -0,0 +1,218 @@
+import time
+import argparse
+from fractions import Fraction
+
+import numpy as np
+import torch
+from scipy import signal
+
+from utils.preprocessing import resample, _poly_filter
+from utils.tools import autocast
+
+
+def timeit(func, repeats=3):
+    # best of `repeats` wall-clock runs, in seconds
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_resampling(hours=1.0, eeg_freq=1000.0, segment_size=512, repeats=3):
+    # synthetic EEG and EMG of the given duration and sampling rate
+    down, up = (
+        Fraction(eeg_freq / segment_size).limit_denominator(100).as_integer_ratio()
+    )
+    n = int(hours * 3600 * eeg_freq)
+    x = np.random.randn(2, n).astype(np.float32)
+
+    def per_channel():
+        # the previous path: one resample_poly call, and filter design, each
+        for channel in x:
+            signal.resample_poly(channel, up, down)
+
+    def stacked():
+        resample(x, up, down)
+
+    def stacked_torch():
+        resample(x, up, down, backend="torch")
+
+    design = timeit(lambda: _poly_filter.__wrapped__(up, down, x.dtype), repeats)
+    print(f"{hours}h at {eeg_freq} Hz -> {segment_size} Hz (up={up}, down={down})")
+    print(f"filter design: {design * 1e3:.2f} ms")
+    reference = np.stack([signal.resample_poly(channel, up, down) for channel in x])
+    for name, func in [
+        ("per-channel resample_poly", per_channel),
+        ("stacked, cached filter", stacked),
+        ("stacked, torch", stacked_torch),
+    ]:
+        print(f"{name}: {timeit(func, repeats):.3f} s")
+    print(
+        "torch max abs diff: "
+        f"{np.abs(resample(x, up, down, backend='torch') - reference).max():.2e}"
+    )
+
+
+def build_model(checkpoint_path=None):
+    # the inference model, with random weights when no checkpoint is given
+    from run_inference import build_args, load_model
+    from models.seq import n2nSeqNewMoE2
+
+    if checkpoint_path is not None:
+        return load_model(checkpoint_path, "cpu")[0]
+    return n2nSeqNewMoE2.Model(build_args()).eval()
+
+
+@torch.no_grad()
+def bench_inference(batch_size=32, checkpoint_path=None, repeats=3):
+    # CPU throughput of the full forward against the fused-only predict
+    model = build_model(checkpoint_path)
+    x = torch.randn(batch_size, 64, 2, 1, 512)
+
+    out = model(x, label=None)["out"]
+    assert torch.equal(out, model.predict(x))
+    print(f"batch of {batch_size} x 64 epochs, {torch.get_num_threads()} threads")
+    for name, func in [
+        ("forward", lambda: model(x, label=None)),
+        ("predict", lambda: model.predict(x)),
+    ]:
+        elapsed = timeit(func, repeats)
+        print(f"{name}: {elapsed:.3f} s, {batch_size * 64 / elapsed:.0f} epochs/s")
+
+    # the sequence stage alone, which is all that runs on cached embeddings
+    cls_eeg, cls_emg = model.encode_epochs(x)
+    for name, func in [
+        ("forward_sequence", lambda: model.forward_sequence(cls_eeg, cls_emg)),
+        ("predict_sequence", lambda: model.predict_sequence(cls_eeg, cls_emg)),
+    ]:
+        elapsed = timeit(func, repeats)
+        print(f"{name}: {elapsed:.3f} s, {batch_size * 64 / elapsed:.0f} epochs/s")
+
+
+def saved_activation_bytes(func):
+    # bytes of the tensors autograd saves for backward while func runs, the
+    # part of training memory that mixed precision shrinks
+    total = 0
+
+    def pack(tensor):
+        nonlocal total
+        total += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        func()
+    return total
+
+
+def precision_parity(checkpoint_path, recordings):
+    # fp32 against bf16 infer on real recordings, with the labels if present
+    from sklearn.metrics import accuracy_score, cohen_kappa_score
+    from scipy.io import loadmat
+    from run_inference import infer, list_recordings
+    from utils.preprocessing import trim_missing_labels
+
+    preds = {"fp32": [], "bf16": []}
+    labels = []
+    for mat_file in list_recordings(recordings):
+        data = loadmat(mat_file)
+        for precision in preds:
+            preds[precision].append(
+                infer(data, checkpoint_path, precision=precision)[0]
+            )
+        if "sleep_scores" in data:
+            scores = trim_missing_labels(data["sleep_scores"].flatten(), trim="b")
+        else:
+            scores = np.full(len(preds["fp32"][-1]), -1)
+        labels.append(np.resize(scores, len(preds["fp32"][-1])))
+    preds = {precision: np.concatenate(pred) for precision, pred in preds.items()}
+    labels = np.concatenate(labels)
+    print(f"fp32/bf16 agreement: {np.mean(preds['fp32'] == preds['bf16']):.4f}")
+    valid = np.isin(labels, [0, 1, 2])
+    if valid.any():
+        for precision, pred in preds.items():
+            print(
+                f"{precision}: accuracy {accuracy_score(labels[valid], pred[valid]):.4f}"
+                f", kappa {cohen_kappa_score(labels[valid], pred[valid]):.4f}"
+            )
+
+
+def bench_precision(batch_size=64, checkpoint_path=None, recordings=None, repeats=3):
+    # fp32 against bf16 autocast for predict and a training step on the
+    # [batch_size, 64, 2, 1, 512] training shape
+    model = build_model(checkpoint_path)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = model.to(device)
+    x = torch.randn(batch_size, 64, 2, 1, 512, device=device)
+    label = torch.randint(0, 3, (batch_size, 64, 1), device=device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    print(f"batch of {batch_size} x 64 epochs on {device}")
+
+    with torch.no_grad():
+        reference = torch.softmax(model.predict(x), dim=1)
+        with autocast(device, "bf16"):
+            probs = torch.softmax(model.predict(x).float(), dim=1)
+    print(
+        f"bf16 predict: max abs prob diff {(probs - reference).abs().max():.2e}, "
+        f"argmax agreement {(probs.argmax(1) == reference.argmax(1)).float().mean():.4f}"
+    )
+
+    def train_step(precision):
+        with autocast(device, precision):
+            out = model(x, label)["out"]
+        loss = torch.nn.functional.cross_entropy(out.float(), label.view(-1))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for precision in ["fp32", "bf16"]:
+        model.eval()
+        with torch.no_grad(), autocast(device, precision):
+            elapsed = timeit(lambda: model.predict(x), repeats)
+        print(
+            f"{precision} predict: {elapsed:.3f} s, "
+            f"{batch_size * 64 / elapsed:.0f} epochs/s"
+        )
+        model.train()
+        if device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        elapsed = timeit(lambda: train_step(precision), repeats)
+        with autocast(device, precision):
+            activations = saved_activation_bytes(lambda: model(x, label)["out"])
+        print(
+            f"{precision} train step: {elapsed:.3f} s, "
+            f"saved activations {activations / 2**20:.0f} MiB"
+            + (
+                f", peak memory {torch.cuda.max_memory_allocated() / 2**20:.0f} MiB"
+                if device == "cuda"
+                else ""
+            )
+        )
+    if recordings is not None:
+        precision_parity(checkpoint_path, recordings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sDREAMER benchmarks")
+    parser.add_argument("benchmark", choices=["resampling", "inference", "precision"])
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--eeg_freq", type=float, default=1000.0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument(
+        "--recordings", type=str, default=None, help="directory of .mat files"
+    )
+    args = parser.parse_args()
+
+    if args.benchmark == "resampling":
+        bench_resampling(args.hours, args.eeg_freq, repeats=args.repeats)
+    elif args.benchmark == "inference":
+        bench_inference(args.batch_size, args.checkpoint, repeats=args.repeats)
+    elif args.benchmark == "precision":
+        if args.recordings is not None and args.checkpoint is None:
+            parser.error("--recordings needs --checkpoint")
+        bench_precision(
+            args.batch_size, args.checkpoint, args.recordings, repeats=args.repeats
+        )
@@ -5,55 +5,29 @@ Created on Fri May 17 12:17:16 2024
 @author: yzhao
 """
 
+import os
 import argparse
+import warnings
+from glob import glob
+from collections import OrderedDict
 
 import torch
 from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 import numpy as np
 
-from models.seq import n2nSeqNewMoE2
-from utils.preprocessing import reshape_sleep_data
+from utils.preprocessing import CHUNK_SECONDS, open_mat, reshape_sleep_data
+from utils.tools import autocast
+from data_provider.trace_store import TraceStoreWriter, window_offsets
 
 
-class SequenceDataset(Dataset):
-    def __init__(self, normalized_sleep_data):
-        self.traces = normalized_sleep_data
-
-    def __len__(self):
-        return self.traces.shape[0]
-
-    def __getitem__(self, idx):
-        trace = self.traces[idx]
-        return trace
-
-
-def make_dataset(data: dict, n_sequences: int = 64):
-    eeg, emg = reshape_sleep_data(data, has_labels=False)
+def normalize_recording(data: dict):
+    eeg, emg = reshape_sleep_data(data, has_labels=False, chunk_seconds=CHUNK_SECONDS)
     sleep_data = np.stack((eeg, emg), axis=1)
     sleep_data = torch.from_numpy(sleep_data)
     sleep_data = torch.unsqueeze(sleep_data, dim=2)  # shape [n_seconds, 2, 1, seq_len]
     mean, std = torch.mean(sleep_data, dim=0), torch.std(sleep_data, dim=0)
-    normalized_data = (sleep_data - mean) / std
-
-    n_seconds = normalized_data.shape[0]
-    n_to_crop = n_seconds % n_sequences
-    if n_to_crop != 0:
-        normalized_data = torch.cat(
-            [normalized_data[:-n_to_crop], normalized_data[-n_sequences:]], dim=0
-        )
-
-    normalized_data = normalized_data.reshape(
-        (
-            -1,
-            n_sequences,
-            normalized_data.shape[1],
-            normalized_data.shape[2],
-            normalized_data.shape[3],
-        )
-    )
-    dataset = SequenceDataset(normalized_data)
-    return dataset, n_seconds, n_to_crop
+    return (sleep_data - mean) / std
 
 
 # %%
@@ -91,7 +65,7 @@ config = dict(
 
 def build_args(**kwargs):
     parser = argparse.ArgumentParser(description="Transformer family for sleep scoring")
-    args = parser.parse_args()
+    args = parser.parse_args([])
     parser_dict = vars(args)
 
     for k, v in config.items():
@@ -101,75 +75,602 @@ def build_args(**kwargs):
     return args
 
 
-# %%
-def infer(data, checkpoint_path, batch_size=32):
-    args = build_args()
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+def load_model(checkpoint_path, device, **kwargs):
+    # imported here so that the exported runtimes never import einops/timm
+    from models.seq import n2nSeqNewMoE2
+
+    args = build_args(**kwargs)
     model = n2nSeqNewMoE2.Model(args)
-    model = model.to(device)
 
-    ckpt = torch.load(checkpoint_path, map_location=device)
+    ckpt = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    if "quantized" in ckpt:
+        # int8 checkpoint written by quantize_model.py, CPU only
+        from utils.quantization import quantize_linear
+
+        model = quantize_linear(model.eval(), ckpt["quantized"])
+        device = "cpu"
+    model = model.to(device)
     model.load_state_dict(ckpt["state_dict"])
+    model.eval()
+    return model, args
 
-    n_sequences = config["n_sequences"]
-    dataset, n_seconds, n_to_crop = make_dataset(data)
-    data_loader = DataLoader(
-        dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        num_workers=0,
-        drop_last=False,
-        pin_memory=True,
-    )
 
-    model.eval()
-    with torch.no_grad():
-        all_pred = []
-        all_prob = []
-
-        with tqdm(total=n_seconds, unit=" seconds of signal") as pbar:
-            for batch, traces in enumerate(data_loader, 1):
-                traces = traces.to(device)  # [batch_size, 64, 2, 1, 512]
-                out_dict = model(traces, label=None)
-                out = out_dict["out"]
-
-                prob = torch.max(torch.softmax(out, dim=1), dim=1).values
-                all_prob.append(prob.detach().cpu())
-
-                pred = np.argmax(out.detach().cpu(), axis=1)
-                # pred = out_dict["predictions"]
-                all_pred.append(pred)
-
-                pbar.update(batch_size * n_sequences)
-            pbar.set_postfix({"Number of batches": batch})
-
-        if n_to_crop != 0:
-            all_pred[-1] = torch.cat(
-                (
-                    all_pred[-1][: -args.n_sequences],
-                    all_pred[-1][-args.n_sequences :][-n_to_crop:],
-                )
+class TorchScriptRuntime:
+    # the two graphs written by export_model.export_torchscript, with the
+    # encode_epochs / predict_sequence / predict interface of the model
+    def __init__(self, prefix):
+        self.encoder = torch.jit.load(f"{prefix}.encoder.pt", map_location="cpu")
+        self.sequence = torch.jit.load(f"{prefix}.sequence.pt", map_location="cpu")
+
+    @torch.no_grad()
+    def encode_epochs(self, x):
+        return self.encoder(x.float())
+
+    @torch.no_grad()
+    def predict_sequence(self, cls_eeg, cls_emg):
+        return self.sequence(cls_eeg, cls_emg)
+
+    def predict(self, x):
+        return self.predict_sequence(*self.encode_epochs(x))
+
+
+class OnnxRuntime(TorchScriptRuntime):
+    # the graphs written by export_model.export_onnx, run with onnxruntime
+    def __init__(self, prefix, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.encoder = ort.InferenceSession(
+            f"{prefix}.encoder.onnx", options, providers=providers
+        )
+        self.sequence = ort.InferenceSession(
+            f"{prefix}.sequence.onnx", options, providers=providers
+        )
+
+    def encode_epochs(self, x):
+        cls_eeg, cls_emg = self.encoder.run(None, {"traces": x.float().numpy()})
+        return torch.from_numpy(cls_eeg), torch.from_numpy(cls_emg)
+
+    def predict_sequence(self, cls_eeg, cls_emg):
+        inputs = {"cls_eeg": cls_eeg.numpy(), "cls_emg": cls_emg.numpy()}
+        return torch.from_numpy(self.sequence.run(None, inputs)[0])
+
+
+def load_runtime(path, backend="eager", device=None, num_threads=None):
+    """Model, or exported graphs, behind encode_epochs/predict_sequence/predict.
+
+    backend="eager" loads the checkpoint at path into n2nSeqNewMoE2.Model;
+    "torchscript" and "onnx" load the graphs export_model wrote with prefix
+    path and always run on CPU. num_threads caps the intra-op threads.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if backend == "eager":
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        return load_model(path, device)
+    if backend == "torchscript":
+        return TorchScriptRuntime(path), build_args()
+    if backend == "onnx":
+        return OnnxRuntime(path, num_threads), build_args()
+    raise ValueError(f"unknown backend {backend}")
+
+
+class EpochEmbeddingCache:
+    """LRU cache of per-epoch encoder outputs, keyed by (recording, epoch).
+
+    Model.encode_epochs encodes each epoch independently of the window it
+    sits in, so with overlapping windows or streaming an epoch only has to be
+    encoded once; the sequence stage then runs on cached CLS tokens. At most
+    max_epochs epochs are kept, least recently used first out.
+    """
+
+    def __init__(self, model, max_epochs=2**16, batch_epochs=2048, device=None):
+        if device is None:  # exported runtimes always run on CPU
+            device = (
+                next(model.parameters()).device
+                if isinstance(model, torch.nn.Module)
+                else "cpu"
             )
-            all_prob[-1] = torch.cat(
-                (
-                    all_prob[-1][: -args.n_sequences],
-                    all_prob[-1][-args.n_sequences :][-n_to_crop:],
-                )
+        self.model = model
+        self.device = device
+        self.max_epochs = max_epochs
+        self.batch_epochs = batch_epochs
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    @torch.no_grad()
+    def encode(self, recording, epoch_indices, epochs):
+        # cls_eeg, cls_emg of shape [len(epoch_indices), inner_dim]; epochs[i]
+        # is epoch i of the recording ([2, 1, seq_len]) and only read on a miss
+        epoch_indices = [int(i) for i in epoch_indices]
+        found = {}
+        for i in dict.fromkeys(epoch_indices):
+            if (recording, i) in self.entries:
+                self.entries.move_to_end((recording, i))
+                found[i] = self.entries[(recording, i)]
+        missing = [i for i in dict.fromkeys(epoch_indices) if i not in found]
+        self.hits += len(found)
+        self.misses += len(missing)
+
+        for start in range(0, len(missing), self.batch_epochs):
+            chunk = missing[start : start + self.batch_epochs]
+            batch = torch.stack([torch.as_tensor(epochs[i]) for i in chunk])
+            cls_eeg, cls_emg = self.model.encode_epochs(batch[None].to(self.device))
+            for j, i in enumerate(chunk):
+                found[i] = (cls_eeg[0, j], cls_emg[0, j])
+                self.entries[(recording, i)] = found[i]
+        while len(self.entries) > self.max_epochs:
+            self.entries.popitem(last=False)
+
+        return (
+            torch.stack([found[i][0] for i in epoch_indices]),
+            torch.stack([found[i][1] for i in epoch_indices]),
+        )
+
+    @torch.no_grad()
+    def forward(self, recording, epoch_indices, epochs):
+        # model output for windows of epoch indices, shape [batch, n_seq]
+        epoch_indices = torch.as_tensor(epoch_indices)
+        cls_eeg, cls_emg = self.encode(recording, epoch_indices.reshape(-1), epochs)
+        shape = (*epoch_indices.shape, -1)
+        return self.model.forward_sequence(
+            cls_eeg.reshape(shape), cls_emg.reshape(shape)
+        )
+
+    @torch.no_grad()
+    def predict(self, recording, epoch_indices, epochs):
+        # fused logits only, as Model.predict, shape [(batch n_seq), num_classes]
+        epoch_indices = torch.as_tensor(epoch_indices)
+        cls_eeg, cls_emg = self.encode(recording, epoch_indices.reshape(-1), epochs)
+        shape = (*epoch_indices.shape, -1)
+        return self.model.predict_sequence(
+            cls_eeg.reshape(shape), cls_emg.reshape(shape)
+        )
+
+    def clear(self, recording=None):
+        if recording is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key[0] == recording]:
+            del self.entries[key]
+
+
+def check_length(n_epochs, n_sequences):
+    # a recording needs at least one full window of epochs to be scored
+    if n_epochs < n_sequences:
+        raise ValueError(
+            f"recording has {n_epochs} epochs, fewer than n_sequences={n_sequences}"
+        )
+
+
+def sliding_windows(epochs, n_sequences, stride):
+    # windows[start] is the n_sequences items from start on, as a strided
+    # view of epochs ([n, ...]), so no window is copied until a batch is
+    # gathered. starts steps by stride and ends with a window flush with the
+    # end.
+    windows = epochs.unfold(0, n_sequences, 1)
+    windows = windows.permute(0, windows.dim() - 1, *range(1, windows.dim() - 1))
+    starts = torch.from_numpy(window_offsets(len(epochs), n_sequences, stride))
+    return windows, starts
+
+
+class WindowVoter:
+    """Fuse per-epoch class probabilities over overlapping windows.
+
+    fusion="mean" averages the probabilities of every window that covers an
+    epoch; fusion="logprob" averages their log-probabilities, a normalized
+    geometric mean that lets a confident window outvote uncertain ones.
+    """
+
+    def __init__(self, n_epochs, n_classes, n_sequences, fusion="mean"):
+        assert fusion in ("mean", "logprob")
+        self.fusion = fusion
+        self.n_sequences = n_sequences
+        self.total = torch.zeros(n_epochs, n_classes)
+        self.count = torch.zeros(n_epochs)
+
+    def add(self, starts, out):
+        # out --> [(len(starts) n_seq), num_classes] logits of these windows
+        if self.fusion == "mean":
+            values = torch.softmax(out.float(), dim=1)
+        else:
+            values = torch.log_softmax(out.float(), dim=1)
+        idx = (starts[:, None] + torch.arange(self.n_sequences)).reshape(-1)
+        self.total.index_add_(0, idx, values.cpu())
+        self.count.index_add_(0, idx, torch.ones(len(idx)))
+
+    def probs(self):
+        mean = self.total / self.count[:, None]
+        return mean if self.fusion == "mean" else torch.softmax(mean, dim=1)
+
+    def result(self, full_probs=False):
+        # all_pred, all_prob as returned by infer; with full_probs, all_prob
+        # is the [n_epochs, n_classes] distribution instead of its maximum
+        probs = self.probs()
+        prob, pred = torch.max(probs, dim=1)
+        return pred.numpy(), (probs if full_probs else prob).numpy()
+
+
+@torch.no_grad()
+def encode_recording(model, epochs, batch_epochs, device):
+    # per-epoch CLS tokens of a whole recording, each epoch encoded once
+    cls_eeg, cls_emg = [], []
+    for start in range(0, len(epochs), batch_epochs):
+        batch = epochs[start : start + batch_epochs][None].to(device)
+        eeg, emg = model.encode_epochs(batch)
+        cls_eeg.append(eeg[0])
+        cls_emg.append(emg[0])
+    return torch.cat(cls_eeg), torch.cat(cls_emg)
+
+
+@torch.no_grad()
+def score_epochs(
+    model, epochs, args, batch_size=32, stride=None, fusion="mean", device="cpu"
+):
+    # WindowVoter over the windows of one recording's normalized epochs.
+    # Epochs are encoded once and only the sequence stage runs per window,
+    # so a smaller stride adds n_sequences / stride sequence-stage passes
+    # per epoch.
+    n_sequences = args.n_sequences
+    check_length(len(epochs), n_sequences)
+    cls_eeg, cls_emg = encode_recording(model, epochs, batch_size * n_sequences, device)
+    eeg_windows, starts = sliding_windows(cls_eeg, n_sequences, stride or n_sequences)
+    emg_windows, _ = sliding_windows(cls_emg, n_sequences, stride or n_sequences)
+    voter = WindowVoter(len(epochs), args.c_out, n_sequences, fusion)
+
+    batch = 0
+    with tqdm(total=len(starts), unit=" windows") as pbar:
+        for batch, first in enumerate(range(0, len(starts), batch_size), 1):
+            batch_starts = starts[first : first + batch_size]
+            out = model.predict_sequence(
+                eeg_windows[batch_starts], emg_windows[batch_starts]
             )
+            voter.add(batch_starts, out)
+            pbar.update(len(batch_starts))
+        pbar.set_postfix({"Number of batches": batch})
+    return voter
 
-        all_pred = np.concatenate(all_pred)
-        all_prob = np.concatenate(all_prob)
 
-    return all_pred, all_prob
+# %%
+def infer(
+    data,
+    checkpoint_path,
+    batch_size=32,
+    stride=None,
+    fusion="mean",
+    backend="eager",
+    num_threads=None,
+    full_probs=False,
+    precision="fp32",
+):
+    # Each window of n_sequences epochs is scored in full and every epoch
+    # gets the fused probabilities of the windows covering it. stride=None
+    # uses non-overlapping windows (plus one flush with the end). See
+    # load_runtime for backend and num_threads. full_probs returns the
+    # probabilities of all classes, [n_epochs, c_out], as all_prob.
+    # precision="bf16" runs the eager model under bf16 autocast.
+    device = "cuda" if torch.cuda.is_available() and backend == "eager" else "cpu"
+    model, args = load_runtime(checkpoint_path, backend, device, num_threads)
+    if backend == "eager":
+        device = next(model.parameters()).device  # int8 checkpoints stay on CPU
+    epochs = normalize_recording(data).float()
+    with autocast(device, precision):
+        voter = score_epochs(model, epochs, args, batch_size, stride, fusion, device)
+    return voter.result(full_probs)
+
+
+def list_recordings(recordings):
+    # a directory of .mat files, or a list of .mat paths / loaded mat dicts
+    if isinstance(recordings, str):
+        return sorted(glob(os.path.join(recordings, "*.mat")))
+    return list(recordings)
+
+
+class RecordingDataset(Dataset):
+    # one item per recording: its normalized epochs and window starts, so
+    # DataLoader workers can preprocess the next recordings while the model
+    # runs
+    def __init__(self, recordings, n_sequences=64, stride=64):
+        self.recordings = recordings
+        self.n_sequences = n_sequences
+        self.stride = stride
+
+    def __len__(self):
+        return len(self.recordings)
+
+    def __getitem__(self, idx):
+        data = self.recordings[idx]
+        if isinstance(data, str):
+            with open_mat(data) as mat:
+                epochs = normalize_recording(mat).float()
+        else:
+            epochs = normalize_recording(data).float()
+        starts = window_offsets(len(epochs), self.n_sequences, self.stride)
+        return idx, epochs, torch.from_numpy(starts)
+
+
+class InferenceEngine:
+    """Score many recordings with one warm model.
+
+    The checkpoint is loaded once. Each recording's epochs are encoded once,
+    then windows of epoch tokens from consecutive recordings are packed into
+    full batches for the sequence stage, and the predictions are scattered
+    back to their recordings, so a short recording never runs a mostly empty
+    batch.
+    Each recording gives the same all_pred, all_prob as infer with the same
+    stride, fusion and full_probs.
+    """
+
+    def __init__(
+        self,
+        checkpoint_path,
+        batch_size=32,
+        num_workers=0,
+        device=None,
+        stride=None,
+        fusion="mean",
+        backend="eager",
+        num_threads=None,
+        full_probs=False,
+        precision="fp32",
+    ):
+        if device is None:
+            device = (
+                "cuda" if torch.cuda.is_available() and backend == "eager" else "cpu"
+            )
+        self.device = device
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.model, self.args = load_runtime(
+            checkpoint_path, backend, device, num_threads
+        )
+        if backend == "eager":
+            self.device = next(self.model.parameters()).device
+        self.n_sequences = self.args.n_sequences
+        self.stride = stride or self.n_sequences
+        self.fusion = fusion
+        self.full_probs = full_probs
+        self.precision = precision
+
+    def run(self, recordings):
+        """Yield (name, all_pred, all_prob) per recording, in input order.
+
+        name is the .mat path, or the position for an already loaded mat dict.
+        Recordings shorter than n_sequences epochs are skipped with a warning.
+        """
+        recordings = list_recordings(recordings)
+        loader = DataLoader(
+            RecordingDataset(recordings, self.n_sequences, self.stride),
+            batch_size=None,
+            shuffle=False,
+            num_workers=self.num_workers,
+        )
+        pending = []  # (recording index, first start, starts) not yet run
+        results = {}  # recording index -> [token windows, voter, windows left]
+        # voter is None for a skipped recording
+        next_idx = 0
+
+        @torch.no_grad()
+        def run_batch(size):
+            eeg, emg, segments = [], [], []
+            while size > 0:
+                idx, first, starts = pending[0]
+                take = min(size, len(starts) - first)
+                batch_starts = starts[first : first + take]
+                eeg_windows, emg_windows = results[idx][0]
+                eeg.append(eeg_windows[batch_starts])
+                emg.append(emg_windows[batch_starts])
+                segments.append((idx, batch_starts))
+                if first + take == len(starts):
+                    pending.pop(0)
+                else:
+                    pending[0] = (idx, first + take, starts)
+                size -= take
+
+            with autocast(self.device, self.precision):
+                out = self.model.predict_sequence(torch.cat(eeg), torch.cat(emg))
+            offset = 0
+            for idx, batch_starts in segments:
+                n_out = len(batch_starts) * self.n_sequences
+                results[idx][1].add(batch_starts, out[offset : offset + n_out])
+                results[idx][2] -= len(batch_starts)
+                offset += n_out
+
+        def n_pending():
+            return sum(len(starts) - first for _, first, starts in pending)
+
+        def finished():
+            nonlocal next_idx
+            while next_idx in results and results[next_idx][2] == 0:
+                _, voter, _ = results.pop(next_idx)
+                name = recordings[next_idx]
+                if not isinstance(name, str):
+                    name = next_idx  # loaded mat dicts are named by position
+                if voter is not None:
+                    yield (name, *voter.result(self.full_probs))
+                next_idx += 1
+
+        for idx, epochs, starts in loader:
+            try:
+                check_length(len(epochs), self.n_sequences)
+            except ValueError as error:
+                name = recordings[idx] if isinstance(recordings[idx], str) else idx
+                warnings.warn(f"skipping recording {name}: {error}")
+                results[idx] = [None, None, 0]
+                yield from finished()
+                continue
+            with autocast(self.device, self.precision):
+                cls_eeg, cls_emg = encode_recording(
+                    self.model, epochs, self.batch_size * self.n_sequences, self.device
+                )
+            windows = (
+                sliding_windows(cls_eeg, self.n_sequences, self.stride)[0],
+                sliding_windows(cls_emg, self.n_sequences, self.stride)[0],
+            )
+            voter = WindowVoter(
+                len(epochs), self.args.c_out, self.n_sequences, self.fusion
+            )
+            results[idx] = [windows, voter, len(starts)]
+            pending.append((idx, 0, starts))
+            while n_pending() >= self.batch_size:
+                run_batch(self.batch_size)
+                yield from finished()
+        while pending:
+            run_batch(min(self.batch_size, n_pending()))
+            yield from finished()
+        yield from finished()
+
+    def infer(self, recordings):
+        """{name: (all_pred, all_prob)} for a directory or list of recordings."""
+        return {
+            recording: (pred, prob)
+            for recording, pred, prob in tqdm(
+                self.run(recordings),
+                unit=" recordings",
+                total=len(list_recordings(recordings)),
+            )
+        }
+
+
+def read_manifest(manifest):
+    # .mat paths, one per line; blank lines and lines starting with # are
+    # skipped, and relative paths are taken from the manifest's directory.
+    # A directory stands for all the .mat files in it.
+    if os.path.isdir(manifest):
+        return list_recordings(manifest)
+    root = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        lines = [line.strip() for line in f]
+    return [
+        os.path.join(root, line) for line in lines if line and not line.startswith("#")
+    ]
+
+
+def recording_name(mat_file):
+    return os.path.splitext(os.path.basename(mat_file))[0]
+
+
+def output_path(out_dir, name):
+    return os.path.join(out_dir, f"{name}.npz")
+
+
+def save_prediction(path, all_pred, all_prob):
+    # written under a temporary name and then renamed, so that a crash never
+    # leaves a partial file that a resumed run would take as done
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, pred=all_pred, prob=all_prob)
+    os.replace(tmp_path, path)
+
+
+def run_manifest(
+    manifest, out_dir, checkpoint_path, overwrite=False, output_format="npz", **kwargs
+):
+    """Score every recording of a manifest into out_dir.
+
+    output_format="npz" writes out_dir/<name>.npz with pred and the
+    probability of the predicted class per epoch. output_format="store"
+    writes one TraceStore for the whole manifest. It holds the float16
+    probabilities of all classes as the traces and the int8 predictions as
+    the labels, epoch i of a recording being item i of its entry in
+    index.json. Each recording is appended as soon as it is scored, so
+    nothing is collected in memory. Read it with TraceStore(out_dir) and
+    recording(name) -> (probs, pred).
+
+    Recordings that already have an output are skipped unless overwrite is
+    set, so rerunning the same command after a crash resumes where it
+    stopped. kwargs go to InferenceEngine; with num_workers > 0, reading,
+    resampling and normalization run in that many worker processes while
+    the model scores the recordings before them.
+    """
+    recordings = read_manifest(manifest)
+    names = [recording_name(mat_file) for mat_file in recordings]
+    if len(set(names)) < len(names):
+        raise ValueError("recordings in the manifest must have distinct file names")
+
+    if output_format == "store":
+        writer = TraceStoreWriter(
+            out_dir, trace_dtype="float16", label_dtype="int8", overwrite=overwrite
+        )
+        done = [name in writer for name in names]
+        kwargs["full_probs"] = True
+    elif output_format == "npz":
+        writer = None
+        os.makedirs(out_dir, exist_ok=True)
+        done = [
+            not overwrite and os.path.exists(output_path(out_dir, name))
+            for name in names
+        ]
+    else:
+        raise ValueError(f"unknown output format {output_format}")
+
+    todo = {
+        mat_file: name
+        for mat_file, name, is_done in zip(recordings, names, done)
+        if not is_done
+    }
+    if len(todo) < len(recordings):
+        print(f"skipping {len(recordings) - len(todo)} recordings already scored")
+    if not todo:
+        return
+
+    engine = InferenceEngine(checkpoint_path, **kwargs)
+    for mat_file, all_pred, all_prob in tqdm(
+        engine.run(list(todo)), unit=" recordings", total=len(todo)
+    ):
+        if writer is None:
+            save_prediction(output_path(out_dir, todo[mat_file]), all_pred, all_prob)
+        else:
+            writer.append(
+                todo[mat_file], all_prob, all_pred, source=os.path.abspath(mat_file)
+            )
+    if writer is not None:
+        writer.close()
 
 
 # %%
 if __name__ == "__main__":
-    from scipy.io import loadmat
+    parser = argparse.ArgumentParser(description="Score .mat recordings with sDREAMER")
+    parser.add_argument("checkpoint", help="checkpoint, or export prefix")
+    parser.add_argument("manifest", help="file of .mat paths, or a directory")
+    parser.add_argument("out_dir", help="output directory")
+    parser.add_argument(
+        "--format",
+        choices=["npz", "store"],
+        default="npz",
+        help="<name>.npz per recording, or one store of all class probabilities",
+    )
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument(
+        "--num_workers", type=int, default=2, help="preprocessing processes"
+    )
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--stride", type=int, default=None)
+    parser.add_argument("--fusion", choices=["mean", "logprob"], default="mean")
+    parser.add_argument(
+        "--backend", choices=["eager", "torchscript", "onnx"], default="eager"
+    )
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32")
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args()
 
-    checkpoint_path = "C:/Users/yzhao/python_projects/sleep_scoring/models/sdreamer/checkpoints/SeqNewMoE2_Seq_ftALL_pl16_ns64_dm128_el2_dff512_eb0_scale0.0_bs64_f1_augment_10.pth.tar"
-    mat_file = (
-        "C:/Users/yzhao/python_projects/sleep_scoring/user_test_files/sal_588.mat"
+    run_manifest(
+        args.manifest,
+        args.out_dir,
+        args.checkpoint,
+        overwrite=args.overwrite,
+        output_format=args.format,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        device=args.device,
+        stride=args.stride,
+        fusion=args.fusion,
+        backend=args.backend,
+        num_threads=args.num_threads,
+        precision=args.precision,
     )
-    data = loadmat(mat_file)
-    all_pred, all_prob = infer(data, checkpoint_path)
@@ -0,0 +1,205 @@
+import math
+import time
+from fractions import Fraction
+
+import numpy as np
+import torch
+
+from run_inference import load_model, EpochEmbeddingCache
+from utils.preprocessing import _resample_window
+
+
+class RunningStats:
+    # running per-position mean and std over epochs (Welford), the streaming
+    # counterpart of the mean/std over the whole recording in
+    # normalize_recording
+    def __init__(self, shape, eps=1e-6):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.eps = eps
+
+    def update(self, epoch):
+        self.n += 1
+        delta = epoch - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (epoch - self.mean)
+
+    @property
+    def std(self):
+        if self.n < 2:
+            return np.ones_like(self.m2)
+        # unbiased, like torch.std
+        return np.maximum(np.sqrt(self.m2 / (self.n - 1)), self.eps)
+
+
+class EpochStream:
+    """Cut incoming EEG/EMG samples into 1-second epochs of segment_size.
+
+    The epochs are those reshape_sleep_data would produce on the whole
+    recording. When resampling is needed, an epoch is emitted once enough
+    input has arrived for the filter to see its full context, which is a
+    few dozen input samples past the end of the second.
+    """
+
+    def __init__(self, eeg_freq, segment_size=512):
+        self.eeg_freq = eeg_freq
+        self.segment_size = segment_size
+        self.needs_resampling = (
+            math.ceil(eeg_freq) != segment_size and math.floor(eeg_freq) != segment_size
+        )
+        if self.needs_resampling:
+            self.down, self.up = (
+                Fraction(eeg_freq / segment_size)
+                .limit_denominator(100)
+                .as_integer_ratio()
+            )
+            half_len = 10 * max(self.up, self.down)
+            self.pad = math.ceil(half_len / (self.up * self.down)) + 1
+        self.buffer = np.zeros((2, 0), dtype=np.float32)
+        self.offset = 0  # absolute index of buffer[:, 0]
+        self.received = 0
+        self.next_epoch = 0
+
+    def _first_needed(self, t):
+        # first input sample that epoch t depends on
+        if self.needs_resampling:
+            return max(0, (t * self.segment_size // self.up - self.pad) * self.down)
+        return math.ceil(t * self.eeg_freq)
+
+    def _last_needed(self, t):
+        # input samples that must have arrived before epoch t is final
+        if self.needs_resampling:
+            stop = (t + 1) * self.segment_size
+            return (-(-stop // self.up) + self.pad) * self.down
+        return math.ceil(t * self.eeg_freq) + self.segment_size
+
+    def _read(self, start, stop):
+        return self.buffer[:, start - self.offset : stop - self.offset]
+
+    def push(self, eeg, emg):
+        """Add a chunk of samples and return the epochs it completes."""
+        self.buffer = np.concatenate(
+            [self.buffer, np.stack([eeg, emg]).astype(np.float32)], axis=1
+        )
+        self.received += len(eeg)
+        return self._drain(final=False)
+
+    def flush(self):
+        """Return the remaining complete seconds at the end of the recording."""
+        return self._drain(final=True)
+
+    def _drain(self, final):
+        epochs = []
+        while self.next_epoch < math.floor(self.received / self.eeg_freq):
+            t = self.next_epoch
+            if not final and self._last_needed(t) > self.received:
+                break
+            if self.needs_resampling:
+                epoch = _resample_window(
+                    self._read,
+                    self.received,
+                    t * self.segment_size,
+                    (t + 1) * self.segment_size,
+                    self.up,
+                    self.down,
+                    self.pad,
+                )
+            else:
+                start = math.ceil(t * self.eeg_freq)
+                epoch = self._read(start, start + self.segment_size)
+            epochs.append(epoch[:, np.newaxis, :])  # [2, 1, segment_size]
+            self.next_epoch += 1
+
+            # drop samples no later epoch needs
+            drop = self._first_needed(self.next_epoch) - self.offset
+            if drop > 0:
+                self.buffer = self.buffer[:, drop:]
+                self.offset += drop
+        return epochs
+
+
+class StreamingScorer:
+    """Score a live recording one epoch at a time.
+
+    push() takes raw EEG/EMG chunks (e.g. 1 second each) and returns one
+    (epoch index, label, probability) per completed epoch. The epoch is
+    normalized with the running statistics at its arrival and scored as the
+    last position of a rolling n_sequences-epoch context, zero-padded at the
+    start of the recording, so every label is emitted as soon as its second
+    is complete. Epoch embeddings are cached, so each step encodes only the
+    new epoch and reruns the sequence stage.
+    """
+
+    def __init__(self, checkpoint_path, eeg_freq, device=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.model, self.args = load_model(checkpoint_path, device)
+        self.n_sequences = self.args.n_sequences
+        self.stream = EpochStream(eeg_freq, self.args.seq_len)
+        self.stats = RunningStats((2, 1, self.args.seq_len))
+        self.context = {-1: np.zeros((2, 1, self.args.seq_len), dtype=np.float32)}
+        self.cache = EpochEmbeddingCache(self.model, max_epochs=self.n_sequences + 1)
+        self.n_scored = 0
+        self.latencies = []  # seconds from chunk arrival to label, per epoch
+
+    @torch.no_grad()
+    def _score(self, epoch, arrival):
+        t = self.n_scored
+        self.stats.update(epoch)
+        self.context[t] = ((epoch - self.stats.mean) / self.stats.std).astype(
+            np.float32
+        )
+        if t >= self.n_sequences:
+            del self.context[t - self.n_sequences]
+        # -1 is the all-zero epoch padding the first windows
+        window = [max(i, -1) for i in range(t - self.n_sequences + 1, t + 1)]
+        out = self.cache.predict(None, [window], self.context)[-1]
+        prob, pred = torch.max(torch.softmax(out, dim=0), dim=0)
+
+        self.latencies.append(time.perf_counter() - arrival)
+        self.n_scored += 1
+        return t, pred.item(), prob.item()
+
+    def push(self, eeg, emg):
+        arrival = time.perf_counter()
+        return [self._score(epoch, arrival) for epoch in self.stream.push(eeg, emg)]
+
+    def flush(self):
+        arrival = time.perf_counter()
+        return [self._score(epoch, arrival) for epoch in self.stream.flush()]
+
+    def latency_summary(self):
+        latencies = np.array(self.latencies) * 1e3
+        return {
+            "epochs": len(latencies),
+            "median_ms": float(np.median(latencies)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "max_ms": float(np.max(latencies)),
+        }
+
+
+# %%
+if __name__ == "__main__":
+    from scipy.io import loadmat
+
+    # replay a recording in 1-second chunks as if it were live
+    checkpoint_path = "C:/Users/yzhao/python_projects/sleep_scoring/models/sdreamer/checkpoints/SeqNewMoE2_Seq_ftALL_pl16_ns64_dm128_el2_dff512_eb0_scale0.0_bs64_f1_augment_10.pth.tar"
+    mat_file = (
+        "C:/Users/yzhao/python_projects/sleep_scoring/user_test_files/sal_588.mat"
+    )
+    data = loadmat(mat_file)
+    eeg, emg = data["eeg"].flatten(), data["emg"].flatten()
+    eeg_freq = data["eeg_frequency"].item()
+
+    scorer = StreamingScorer(checkpoint_path, eeg_freq)
+    chunk = math.ceil(eeg_freq)
+    all_pred = []
+    for start in range(0, eeg.size, chunk):
+        for epoch, pred, prob in scorer.push(
+            eeg[start : start + chunk], emg[start : start + chunk]
+        ):
+            all_pred.append(pred)
+    all_pred.extend(pred for _, pred, _ in scorer.flush())
+    print(scorer.latency_summary())
@@ -16,6 +16,8 @@ import numpy as np
 from pytorch_lightning import seed_everything
 
 from exp.exp_moe2 import Exp_MoE
+from utils.distributed import cleanup_distributed, init_distributed
+from utils.distributed import is_main_process
 
 
 # hyperparameters
@@ -94,6 +96,11 @@ config = dict(
     use_multi_gpu=False,
     test_flop=False,
     print_freq=50,
+    precision="fp32",  # "bf16" for mixed precision
+    prefetch=True,  # copy the next batch to the GPU while the model runs
+    batch_gather=False,  # one indexed gather per batch instead of per-item workers
+    resume=False,  # continue from ckpt.pth.tar in the checkpoint directory
+    distributed=False,  # DDP, run with torchrun --nproc_per_node=<n> run_train.py
     # output_path=output_path,
     # ne_patch_len=ne_patch_len,
     # des=des_name,
@@ -117,6 +124,8 @@ if __name__ == "__main__":
     args.checkpoints = checkpoints
     args.des_name = des_name
     args.use_gpu = True if torch.cuda.is_available() and args.use_gpu else False
+    if args.distributed:
+        init_distributed(args)
 
     random.seed(args.seed)
     os.environ["PYTHONHASHSEED"] = str(args.seed)
@@ -155,10 +164,12 @@ if __name__ == "__main__":
 
         logger = logging.getLogger("logger")
         logging.getLogger().setLevel(logging.DEBUG)
-        file_handler = logging.FileHandler(
-            filename=os.path.join(checkpoints, f"{setting}.log"), mode="w"
-        )
-        logger.addHandler(file_handler)
+        if is_main_process():
+            file_handler = logging.FileHandler(
+                filename=os.path.join(checkpoints, f"{setting}.log"),
+                mode="a" if args.resume else "w",
+            )
+            logger.addHandler(file_handler)
 
         logging.getLogger("logger").info("Args in experiment:\n")
         logging.getLogger("logger").info(args)
@@ -176,3 +187,5 @@ if __name__ == "__main__":
         for handler in handlers:
             logger.removeHandler(handler)
             handler.close()
+
+    cleanup_distributed()
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from data_management import align_epochs
+
+
+def align_epochs_loop(data, label, epoch_len=512):
+    # the original per-second pointer loop of data_management.py
+    len_data = data.shape[1]
+    total_seconds = label.shape[1]
+
+    all_epoch_data = []
+    all_epoch_label = []
+
+    pointer = 0
+    for i in range(total_seconds):
+        while data[2][pointer] < i:
+            pointer += 1
+            if pointer + epoch_len > len_data:
+                break
+        if pointer + epoch_len > len_data:
+            break
+        if data[2][pointer] - i > i - data[2][pointer - 1]:
+            pointer -= 1
+        pointer = max(pointer, 0)
+
+        epoch_data = data[:2, None, pointer : pointer + epoch_len]
+        if np.max(label[:, i]) == 0:
+            epoch_label = -1
+        else:
+            epoch_label = np.argmax(label[:, i])
+        all_epoch_data.append(epoch_data)
+        all_epoch_label.append(epoch_label)
+
+    return np.array(all_epoch_data), np.array(all_epoch_label)
+
+
+def make_recording(rng, seconds, freq=512.0, jitter=0.3, n_gaps=0):
+    # EEG, EMG and sorted time stamps at about freq Hz, with jittered sample
+    # times and optional gaps of up to a few seconds
+    steps = np.full(int(seconds * freq), 1.0 / freq)
+    steps *= 1 + rng.uniform(-jitter, jitter, steps.size)
+    for idx in rng.choice(steps.size, n_gaps, replace=False):
+        steps[idx] += rng.uniform(0.5, 3.0)
+    time_stamps = np.concatenate([[0.0], np.cumsum(steps)[:-1]])
+    data = np.stack([rng.standard_normal(steps.size), rng.standard_normal(steps.size)])
+    data = np.concatenate([data, time_stamps[None]])
+    # one-hot scores, with some unscored (all-zero) seconds
+    label = np.eye(3)[rng.integers(0, 3, seconds)].T
+    label[:, rng.random(seconds) < 0.1] = 0
+    return data, label
+
+
+def assert_same(data, label):
+    expected_data, expected_label = align_epochs_loop(data, label)
+    all_epoch_data, all_epoch_label = align_epochs(data, label)
+    assert all_epoch_data.shape == expected_data.shape
+    assert all_epoch_label.shape == expected_label.shape
+    np.testing.assert_array_equal(all_epoch_data, expected_data)
+    np.testing.assert_array_equal(all_epoch_label, expected_label)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_jittered_time_stamps(seed):
+    rng = np.random.default_rng(seed)
+    data, label = make_recording(rng, seconds=int(rng.integers(5, 40)))
+    assert_same(data, label)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_gapped_time_stamps(seed):
+    rng = np.random.default_rng(100 + seed)
+    data, label = make_recording(rng, seconds=int(rng.integers(10, 40)), n_gaps=3)
+    assert_same(data, label)
+
+
+def test_irregular_sampling_rate():
+    rng = np.random.default_rng(7)
+    data, label = make_recording(rng, seconds=20, freq=1017.3, jitter=0.05)
+    assert_same(data, label)
+
+
+def test_recording_shorter_than_one_epoch():
+    rng = np.random.default_rng(0)
+    data, label = make_recording(rng, seconds=3)
+    data = data[:, :300]
+    assert_same(data, label)
+    assert align_epochs(data, label)[0].shape == (0,)
+
+
+def test_no_scored_seconds():
+    rng = np.random.default_rng(0)
+    data, label = make_recording(rng, seconds=5)
+    assert_same(data, label[:, :0])
+
+
+def test_no_epochs_fit():
+    # the first second already lies too close to the end of the data
+    rng = np.random.default_rng(0)
+    data, label = make_recording(rng, seconds=2, freq=200.0)
+    assert_same(data, label)
+    assert align_epochs(data, label)[1].shape == (0,)
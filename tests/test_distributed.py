@@ -0,0 +1,64 @@
+import socket
+
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import SequentialSampler
+
+from data_provider.data_generator import build_sampler
+from utils.distributed import all_gather_array, get_world_size
+
+WORLD_SIZE = 2
+N_ITEMS = 11  # not a multiple of WORLD_SIZE
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_ranks(rank, port):
+    dist.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=WORLD_SIZE,
+    )
+    try:
+        data_set = list(range(N_ITEMS))
+
+        # train shards: disjoint, and reshuffled by set_epoch
+        sampler = build_sampler(data_set, shuffle=True, drop_last=True)
+        shards = []
+        for epoch in range(2):
+            sampler.set_epoch(epoch)
+            shard = np.array(list(sampler))
+            everything = all_gather_array(shard)
+            assert len(everything) == WORLD_SIZE * (N_ITEMS // WORLD_SIZE)
+            assert len(np.unique(everything)) == len(everything)
+            shards.append(shard)
+        assert not np.array_equal(*shards)
+
+        # val shards: every item exactly once, without padding, and the
+        # gathered predictions line up with the gathered labels
+        sampler = build_sampler(data_set, shuffle=False, drop_last=False)
+        indices = np.array(list(sampler))
+        labels = all_gather_array(indices * 10)
+        everything = all_gather_array(indices)
+        assert get_world_size() == WORLD_SIZE
+        np.testing.assert_array_equal(np.sort(everything), np.arange(N_ITEMS))
+        np.testing.assert_array_equal(labels, everything * 10)
+    finally:
+        dist.destroy_process_group()
+
+
+def test_gloo_sharding_and_gather():
+    mp.spawn(run_ranks, args=(free_port(),), nprocs=WORLD_SIZE)
+
+
+def test_gather_without_process_group():
+    array = np.arange(5)
+    assert all_gather_array(array) is array
+    sampler = build_sampler(list(range(5)), shuffle=False, drop_last=False)
+    assert isinstance(sampler, SequentialSampler)
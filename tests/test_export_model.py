@@ -0,0 +1,31 @@
+import pytest
+import torch
+
+from export_model import check_parity, export_onnx, export_torchscript
+from models.seq import n2nSeqNewMoE2
+from run_inference import build_args
+
+
+@pytest.fixture(scope="module")
+def small_model():
+    torch.manual_seed(0)
+    args = build_args(
+        n_sequences=8, d_model=32, n_heads=2, e_layers=1, seq_layers=1, d_ff=64
+    )
+    return n2nSeqNewMoE2.Model(args).eval(), args
+
+
+def test_torchscript_parity(small_model, tmp_path):
+    model, args = small_model
+    prefix = str(tmp_path / "model")
+    export_torchscript(model, prefix, args)
+    check_parity(model, prefix, "torchscript", batch_sizes=(1, 3, 8), args=args)
+
+
+def test_onnx_parity(small_model, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    model, args = small_model
+    prefix = str(tmp_path / "model")
+    export_onnx(model, prefix, args)
+    check_parity(model, prefix, "onnx", batch_sizes=(1, 3, 8), args=args)
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from utils.preprocessing import reshape_sleep_data
+
+
+def make_mat(rng, seconds, freq):
+    n = int(seconds * freq)
+    return {
+        "eeg": rng.standard_normal((1, n)),
+        "emg": rng.standard_normal((1, n)),
+        "eeg_frequency": np.array([[freq]]),
+        "sleep_scores": rng.integers(0, 3, (1, seconds)).astype(float),
+    }
+
+
+@pytest.mark.parametrize("freq", [512.0, 1000.0, 1017.3])
+@pytest.mark.parametrize("standardize", [False, True])
+def test_chunked_matches_whole_signal(freq, standardize):
+    mat = make_mat(np.random.default_rng(0), 50, freq)
+    expected = reshape_sleep_data(mat, standardize=standardize)
+    chunked = reshape_sleep_data(mat, standardize=standardize, chunk_seconds=7)
+    for expected_array, array in zip(expected, chunked):
+        assert array.shape == expected_array.shape
+        np.testing.assert_allclose(array, expected_array, rtol=0, atol=1e-12)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from data_provider.trace_store import TraceStore, TraceStoreWriter
+
+
+def make_recording(rng, n_items):
+    return rng.standard_normal((n_items, 2, 8)), rng.integers(0, 3, (n_items, 1))
+
+
+def test_append_and_read_back(tmp_path):
+    rng = np.random.default_rng(0)
+    recordings = {name: make_recording(rng, n) for name, n in [("a", 5), ("b", 7)]}
+    with TraceStoreWriter(tmp_path, shard_bytes=64 * 8) as writer:
+        for name, (traces, labels) in recordings.items():
+            writer.append(name, traces, labels)
+
+    store = TraceStore(tmp_path)
+    assert len(store.index["shards"]) == 2
+    for name, (traces, labels) in recordings.items():
+        stored_traces, stored_labels = store.recording(name)
+        np.testing.assert_array_equal(stored_traces, traces.astype(np.float32))
+        np.testing.assert_array_equal(stored_labels, labels)
+
+
+def test_resume_after_crash_before_index(tmp_path):
+    # a session that dies after writing a new shard but before index.json
+    # must not leave bytes that a later session's recording is read from
+    rng = np.random.default_rng(1)
+    first, lost, second = (make_recording(rng, n) for n in (4, 6, 3))
+    with TraceStoreWriter(tmp_path) as writer:
+        writer.append("first", *first)
+
+    writer = TraceStoreWriter(tmp_path)
+
+    def crash():
+        raise RuntimeError("crash")
+
+    writer._write_index = crash
+    with pytest.raises(RuntimeError):
+        writer.append("lost", *lost)
+
+    with TraceStoreWriter(tmp_path) as writer:
+        assert "lost" not in writer
+        writer.append("second", *second)
+
+    store = TraceStore(tmp_path)
+    for name, (traces, labels) in [("first", first), ("second", second)]:
+        stored_traces, stored_labels = store.recording(name)
+        np.testing.assert_array_equal(stored_traces, traces.astype(np.float32))
+        np.testing.assert_array_equal(stored_labels, labels)
@@ -5,6 +5,7 @@ import torch
 from exp.exp_main import Exp_Main
 import random
 import numpy as np
+from utils.distributed import cleanup_distributed, init_distributed
 
 
 def argparser():
@@ -224,6 +225,24 @@ def argparser():
         metavar="N",
         help="print frequency (default: 10)",
     )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        default=False,
+        help="copy the next batch to the GPU while the model runs",
+    )
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        default=False,
+        help="DistributedDataParallel with one process per GPU, launched by torchrun",
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default=None,
+        help="process group backend, nccl on GPUs and gloo on CPU by default",
+    )
 
     args = parser.parse_args()
     return args
@@ -245,6 +264,8 @@ def main():
     seed_everything(args.seed)
 
     args.use_gpu = True if torch.cuda.is_available() and args.use_gpu else False
+    if args.distributed:
+        init_distributed(args)
 
     print("Args in experiment:")
     print(args)
@@ -273,6 +294,8 @@ def main():
 
         torch.cuda.empty_cache()
 
+    cleanup_distributed()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+# bump whenever load_data/reshape_sleep_data change what they produce
+CACHE_VERSION = 2
+
+
+def file_digest(file_path, block_size=2**20):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PreprocessCache:
+    """Content-addressed cache of load_data outputs.
+
+    Entries are keyed by the sha256 of the .mat file plus the preprocessing
+    parameters and CACHE_VERSION, so renaming a file or moving it between
+    folds still hits, while editing it or changing a parameter misses. Each
+    entry is one .npz file. Once the directory grows beyond max_bytes, the
+    least recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=50 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, mat_file, **params):
+        params["version"] = CACHE_VERSION
+        params["digest"] = file_digest(mat_file)
+        payload = json.dumps(params, sort_keys=True).encode()
+        return hashlib.sha256(payload).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                data, labels = entry["data"], entry["labels"]
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:  # never written, or evicted by another worker
+            return None
+        return data, labels
+
+    def put(self, key, data, labels):
+        tmp_path = self._path(key) + f".{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, data=data, labels=labels)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if not file.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file))
+            except FileNotFoundError:  # removed by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, file))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,109 @@
+import io
+import os
+import builtins
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(args):
+    """Join the process group set up by torchrun.
+
+    Reads RANK, WORLD_SIZE and LOCAL_RANK from the environment, uses NCCL on
+    GPUs and gloo on CPU unless args.dist_backend is given, and points
+    args.gpu at the local GPU. Only rank 0 prints.
+    """
+    args.rank = int(os.environ["RANK"])
+    args.world_size = int(os.environ["WORLD_SIZE"])
+    args.local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    backend = getattr(args, "dist_backend", None) or (
+        "nccl" if args.use_gpu else "gloo"
+    )
+    if args.use_gpu:
+        # one process per GPU replaces nn.DataParallel
+        args.gpu = args.local_rank
+        args.use_multi_gpu = False
+        torch.cuda.set_device(args.gpu)
+    dist.init_process_group(backend=backend)
+    setup_for_distributed(is_main_process())
+
+
+def setup_for_distributed(is_main):
+    # print(..., force=True) still prints on every rank
+    builtin_print = builtins.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop("force", False)
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+def distributed_model(model, device):
+    # the model is already on device; DDP broadcasts rank 0's weights
+    device = torch.device(device)
+    return DistributedDataParallel(
+        model, device_ids=[device] if device.type == "cuda" else None
+    )
+
+
+def unwrap_model(model):
+    if isinstance(model, (torch.nn.DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def reduce_device():
+    # NCCL reduces CUDA tensors, gloo CPU tensors
+    if dist.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def all_gather_array(array):
+    """Concatenate an array over all ranks along the first axis, in rank order."""
+    if not is_distributed():
+        return array
+    arrays = [None] * get_world_size()
+    dist.all_gather_object(arrays, np.asarray(array))
+    return np.concatenate(arrays)
+
+
+def all_gather_state(state):
+    """[state of rank 0, state of rank 1, ...] for a state dict, e.g. RNGs.
+
+    The state goes through torch.save, as dist.all_gather_object fails to
+    unpickle tensors here.
+    """
+    if not is_distributed():
+        return [state]
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    states = [None] * get_world_size()
+    dist.all_gather_object(states, buffer.getvalue())
+    return [torch.load(io.BytesIO(state)) for state in states]
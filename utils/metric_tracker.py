@@ -1,4 +1,4 @@
-from utils.metrics import AverageMeter
+from utils.metrics import AverageMeter, ConfusionMatrix, ConfusionMeter
 
 
 def batch_updater(metric_list, meter_list, batch_size):
@@ -169,6 +169,78 @@ def build_tracker_mome(isEval=False):
     )
 
 
+def _confusion_tracker(device, modalities, isEval, n_classes):
+    confusions = [ConfusionMatrix(n_classes, device) for _ in modalities]
+    time, loss = batch_tracker(["Time", "Loss"], [":6.3f", ":.4e"])
+    meters = [time, loss]
+    for suffix, confusion in zip(modalities, confusions):
+        meters += [
+            ConfusionMeter(f"Acc{suffix}", confusion, "accuracy", ":6.3f"),
+            ConfusionMeter(f"F1{suffix}", confusion, "f1", ":6.3f"),
+        ]
+    meters += [
+        ConfusionMeter("Kappa", confusions[0], "kappa", ":6.3f"),
+        ConfusionMeter("Precision", confusions[0], "precision", ":6.3f"),
+        ConfusionMeter("Recall", confusions[0], "recall", ":6.3f"),
+    ]
+    if isEval:
+        for metric, prefix in [
+            ("class_f1", "F1"),
+            ("class_precision", "Prec"),
+            ("class_recall", "Recall"),
+        ]:
+            meters += [
+                ConfusionMeter(f"{name}-{prefix}", confusions[0], metric, ":6.3f", cls)
+                for cls, name in enumerate(["W", "S", "R"])
+            ]
+    return tuple(confusions), tuple(meters)
+
+
+def build_confusion_tracker(device, isEval=False, n_classes=3):
+    """build_tracker with the metrics read from a confusion matrix.
+
+    Returns the ConfusionMatrix to update every batch and the meters of
+    build_tracker, in the same order. Time and Loss are AverageMeters;
+    every other meter is a ConfusionMeter.
+    """
+    (confusion,), meters = _confusion_tracker(device, [""], isEval, n_classes)
+    return confusion, meters
+
+
+def build_confusion_tracker_mome(device, isEval=False, n_classes=3):
+    """build_confusion_tracker for build_tracker_mome.
+
+    Returns the (fused, eeg, emg) ConfusionMatrix objects and the meters of
+    build_tracker_mome, in the same order.
+    """
+    modalities = ["", "_eeg", "_emg"]
+    return _confusion_tracker(device, modalities, isEval, n_classes)
+
+
+def build_confusion_tracker_mome_wNE(device, isEval=False, n_classes=3):
+    """build_confusion_tracker for build_tracker_mome_wNE.
+
+    Returns the (fused, eeg, emg, ne) ConfusionMatrix objects and the meters
+    of build_tracker_mome_wNE, in the same order.
+    """
+    modalities = ["", "_eeg", "_emg", "_ne"]
+    return _confusion_tracker(device, modalities, isEval, n_classes)
+
+
+def all_reduce_tracker(loss, *confusions):
+    """Sum the loss meter and the confusion matrices over all ranks.
+
+    Under DDP each rank trains on its shard of the training set and, with
+    the model unwrapped, evaluates its shard of the validation set without
+    DDP's collectives; this is the one collective that makes the summary
+    and the returned metrics cover the whole set, identically on every
+    rank. A no-op without a process group.
+    """
+    loss.all_reduce()
+    for confusion in confusions:
+        confusion.all_reduce()
+
+
 def build_tracker_mome_wNE(isEval=False):
     metrics = [
         "Time",
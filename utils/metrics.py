@@ -4,12 +4,15 @@ import logging
 
 import torch
 import numpy as np
+import torch.distributed as dist
 from enum import Enum
 import matplotlib.pyplot as plt
 
 # from torch.autograd import Variable
 from sklearn.metrics import cohen_kappa_score
 
+from utils.distributed import is_distributed, reduce_device
+
 
 def accuracy(label, pred):
     label = np.concatenate(label)
@@ -189,6 +192,83 @@ def confusion_matrix(output, label, n_classes, batch_size, print_conf_mat=False)
     )
 
 
+class ConfusionMatrix:
+    """Streaming confusion matrix, counts[label, pred], kept on the device.
+
+    update() counts a batch with one fixed-size index_add_ (a bincount
+    whose output size needs no host sync) and keeps the batch and running
+    totals. Metrics are only computed, on the host, when they are read.
+    """
+
+    def __init__(self, n_classes=3, device="cpu"):
+        self.n_classes = n_classes
+        self.total = torch.zeros(n_classes, n_classes, dtype=torch.long, device=device)
+        self.batch = torch.zeros_like(self.total)
+
+    def reset(self):
+        self.total.zero_()
+        self.batch.zero_()
+
+    def update(self, label, pred):
+        # labels outside [0, n_classes), e.g. -1 for unknown, are not counted
+        n = self.n_classes
+        label = label.reshape(-1).to(self.total.device)
+        pred = pred.reshape(-1).to(self.total.device)
+        valid = (label >= 0) & (label < n)
+        idx = torch.where(valid, label * n + pred, n * n)
+        counts = torch.zeros(n * n + 1, dtype=torch.long, device=self.total.device)
+        counts.index_add_(0, idx, torch.ones_like(idx))
+        self.batch = counts[: n * n].view(n, n)
+        self.total += self.batch
+
+    def all_reduce(self):
+        # sum the running totals over all ranks; batch stays per rank
+        if not is_distributed():
+            return
+        total = self.total.to(reduce_device())
+        dist.all_reduce(total, dist.ReduceOp.SUM, async_op=False)
+        self.total = total.to(self.total.device)
+
+    def metrics(self):
+        return confusion_metrics(self.total)
+
+
+def confusion_metrics(cm):
+    """Metrics of a [label, pred] confusion matrix.
+
+    Macro averages are over the classes that occur as a label or a
+    prediction, and undefined ratios are 0, as in sklearn.metrics.
+    """
+    cm = cm.detach().cpu().double()
+    n = cm.sum()
+    tp, n_label, n_pred = cm.diag(), cm.sum(dim=1), cm.sum(dim=0)
+    present = (n_label + n_pred) > 0
+
+    def ratio(a, b):
+        return torch.where(b > 0, a / b.clamp(min=1), torch.zeros_like(a))
+
+    precision = ratio(tp, n_pred)
+    recall = ratio(tp, n_label)
+    f1 = ratio(2 * tp, n_label + n_pred)
+    accuracy = (tp.sum() / n).item() if n > 0 else 0.0
+    expected = (n_label * n_pred).sum() / n**2 if n > 0 else torch.tensor(0.0)
+    kappa = ((accuracy - expected) / (1 - expected)).item()
+
+    def macro(values):
+        return values[present].mean().item() if present.any() else 0.0
+
+    return {
+        "accuracy": accuracy,
+        "f1": macro(f1),
+        "precision": macro(precision),
+        "recall": macro(recall),
+        "kappa": kappa,
+        "class_f1": f1.tolist(),
+        "class_precision": precision.tolist(),
+        "class_recall": recall.tolist(),
+    }
+
+
 class Summary(Enum):
     NONE = 0
     AVERAGE = 1
@@ -225,14 +305,15 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
     def all_reduce(self):
-        if torch.cuda.is_available():
-            device = torch.device("cuda")
-        elif torch.backends.mps.is_available():
-            device = torch.device("mps")
-        else:
-            device = torch.device("cpu")
-        total = torch.tensor([self.sum, self.count], dtype=torch.float32, device=device)
-        # dist.all_reduce(total, dist.ReduceOp.SUM, async_op=False)
+        # sum and count over all ranks, a no-op without a process group
+        if not is_distributed():
+            return
+        total = torch.tensor(
+            [float(self.sum), float(self.count)],
+            dtype=torch.float64,
+            device=reduce_device(),
+        )
+        dist.all_reduce(total, dist.ReduceOp.SUM, async_op=False)
         self.sum, self.count = total.tolist()
         self.avg = self.sum / self.count
 
@@ -256,6 +337,40 @@ class AverageMeter(object):
         return fmtstr.format(**self.__dict__)
 
 
+class ConfusionMeter(object):
+    """A metric of a ConfusionMatrix, displayed like an AverageMeter.
+
+    val is the metric of the last batch and avg that of all batches so far.
+    Both are computed from the counts only when the meter is printed.
+    """
+
+    def __init__(self, name, confusion, metric, fmt=":f", cls=None):
+        self.name = name
+        self.confusion = confusion
+        self.metric = metric
+        self.fmt = fmt
+        self.cls = cls
+
+    def _value(self, cm):
+        value = confusion_metrics(cm)[self.metric]
+        return value if self.cls is None else value[self.cls]
+
+    @property
+    def val(self):
+        return self._value(self.confusion.batch)
+
+    @property
+    def avg(self):
+        return self._value(self.confusion.total)
+
+    def __str__(self):
+        fmtstr = "{name} {val" + self.fmt + "} ({avg" + self.fmt + "})"
+        return fmtstr.format(name=self.name, val=self.val, avg=self.avg)
+
+    def summary(self):
+        return "{name} {avg:.5f}".format(name=self.name, avg=self.avg)
+
+
 class ProgressMeter(object):
     def __init__(self, num_batches, meters, prefix=""):
         self.batch_fmtstr = self._get_batch_fmtstr(num_batches)
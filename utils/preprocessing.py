@@ -6,7 +6,9 @@ Created on Mon Apr 22 11:25:38 2024
 """
 
 import math
+from contextlib import contextmanager
 from fractions import Fraction
+from functools import lru_cache
 
 import numpy as np
 from scipy import stats
@@ -33,7 +35,238 @@ def trim_missing_labels(filt, trim="b"):
     return filt[first:last]
 
 
-def reshape_sleep_data(mat, segment_size=512, standardize=False, has_labels=True):
+# seconds of signal read and resampled at a time by the chunked loaders
+CHUNK_SECONDS = 3600
+
+
+@contextmanager
+def open_mat(mat_file, **kwargs):
+    # MATLAB v7.3 files are HDF5. h5py only reads the slices that are asked
+    # for, so iter_sleep_data never holds the whole signal in memory. Older
+    # files are read by loadmat, with kwargs such as variable_names.
+    try:
+        mat = loadmat(mat_file, **kwargs)
+    except NotImplementedError:
+        mat = None
+    if mat is not None:
+        yield mat
+        return
+
+    import h5py
+
+    with h5py.File(mat_file, "r") as mat:
+        yield mat
+
+
+def _signal_reader(arr):
+    # [1, n] arrays from loadmat, or [n, 1] datasets from v7.3 files
+    if isinstance(arr, np.ndarray):
+        arr = arr.reshape(-1)
+        return arr.size, lambda start, stop: arr[start:stop]
+    if arr.shape[0] == 1:
+        return arr.shape[1], lambda start, stop: arr[0, start:stop]
+    return arr.shape[0], lambda start, stop: arr[start:stop, 0]
+
+
+def _chunked_mean_std(read, size, chunk_len):
+    # population mean/std (as in stats.zscore), merging per-chunk moments
+    n, mean, m2 = 0, 0.0, 0.0
+    for start in range(0, size, chunk_len):
+        chunk = np.asarray(read(start, start + chunk_len), dtype=np.float64)
+        chunk_n = chunk.size
+        chunk_mean = chunk.mean()
+        delta = chunk_mean - mean
+        m2 += np.sum((chunk - chunk_mean) ** 2) + delta**2 * n * chunk_n / (n + chunk_n)
+        n += chunk_n
+        mean += delta * chunk_n / n
+    return mean, np.sqrt(m2 / n)
+
+
+def _standardized_reader(read, mean, std):
+    def read_standardized(start, stop):
+        chunk = np.asarray(read(start, stop))
+        return ((chunk - mean) / std).astype(chunk.dtype, copy=False)
+
+    return read_standardized
+
+
+@lru_cache(maxsize=None)
+def _poly_filter(up, down, dtype):
+    # the anti-aliasing filter resample_poly designs by default, built once per
+    # rate pair; resample_poly copies the window before scaling it
+    max_rate = max(up, down)
+    h = signal.firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+    h = h.astype(dtype)
+    h.flags.writeable = False
+    return h
+
+
+@lru_cache(maxsize=None)
+def _polyphase_matrix(up, down, dtype):
+    # Output sample q of resample_poly is sum_i h[q * down + half_len - i * up]
+    # * x[i]. For q = j * up + p, the inputs involved all lie in the window
+    # x[j * down + r_min : j * down + r_min + width], so one [width, up] matrix
+    # maps every window to its `up` consecutive output samples.
+    h = _poly_filter(up, down, dtype) * up
+    half_len = (len(h) - 1) // 2
+    a = np.arange(up) * down + half_len
+    r_lo, r_hi = -(-(a - 2 * half_len) // up), a // up
+    r_min = r_lo[0]
+    width = r_hi[-1] - r_min + 1
+    r = r_min + np.arange(width)[:, np.newaxis]
+    taps = a - r * up
+    valid = (r >= r_lo) & (r <= r_hi)
+    matrix = np.where(valid, h[np.clip(taps, 0, len(h) - 1)], 0).astype(dtype)
+    return matrix, -r_min
+
+
+def _resample_torch(x, up, down, block=2**16):
+    # resample_poly through torch: a strided unfold of the signal times the
+    # polyphase matrix, one GEMM per block of `block` windows
+    import torch
+
+    matrix, pad = _polyphase_matrix(up, down, x.dtype)
+    width = matrix.shape[0]
+    n_in = x.shape[-1]
+    n_out = -(-n_in * up // down)
+    n_windows = -(-n_out // up)
+    signal_2d = torch.from_numpy(np.ascontiguousarray(x)).reshape(-1, n_in)
+    right = max(0, (n_windows - 1) * down + width - pad - n_in)
+    signal_2d = torch.nn.functional.pad(signal_2d, (pad, right))
+    windows = signal_2d.unfold(-1, width, down)
+    matrix = torch.from_numpy(matrix)
+
+    y = torch.empty(signal_2d.shape[0], n_windows, up, dtype=signal_2d.dtype)
+    for start in range(0, n_windows, block):
+        torch.matmul(
+            windows[:, start : start + block], matrix, out=y[:, start : start + block]
+        )
+    return y.reshape(*x.shape[:-1], n_windows * up)[..., :n_out].numpy()
+
+
+def resample(x, up, down, backend="scipy"):
+    # resample_poly(x, up, down) along the last axis with a cached filter.
+    # backend="torch" runs the same filter as a matrix product in torch, which
+    # uses all intra-op threads; it agrees with scipy up to float rounding.
+    x = np.asarray(x)
+    if up == down:
+        return x.copy()
+    dtype = x.dtype if x.dtype.kind == "f" else np.dtype(np.float64)
+    if backend == "torch":
+        return _resample_torch(x.astype(dtype, copy=False), up, down)
+    return signal.resample_poly(
+        x, up, down, axis=-1, window=_poly_filter(up, down, dtype)
+    )
+
+
+def _stacked_reader(readers):
+    # read equally long channels together as one [n_channels, n] array
+    def read_stacked(start, stop):
+        return np.stack([np.asarray(read(start, stop)) for _, read in readers])
+
+    return read_stacked
+
+
+def _resample_window(read, size, start, stop, up, down, pad, backend="scipy"):
+    # Samples [start, stop) of resample_poly(x, up, down) over the full signal.
+    # The input window starts on a multiple of `down` samples, which maps onto
+    # an exact output sample, and carries `pad` such blocks of context on each
+    # side so the FIR filter sees what it would see on the whole signal.
+    in_start = max(0, (start // up - pad) * down)
+    in_stop = min(size, (-(-stop // up) + pad) * down)
+    resampled = resample(read(in_start, in_stop), up, down, backend=backend)
+    offset = start - in_start // down * up
+    return resampled[..., offset : offset + stop - start]
+
+
+def iter_sleep_data(
+    mat,
+    segment_size=512,
+    standardize=False,
+    chunk_seconds=CHUNK_SECONDS,
+    backend="scipy",
+):
+    """Yield (eeg, emg) blocks of shape [n_seconds, segment_size].
+
+    Streaming counterpart of reshape_sleep_data. The signal is read and
+    resampled chunk_seconds at a time, so peak memory does not grow with the
+    length of the recording. Concatenating the blocks gives the arrays
+    returned by reshape_sleep_data.
+    """
+    readers = [_signal_reader(mat["eeg"]), _signal_reader(mat["emg"])]
+    eeg_freq = np.asarray(mat["eeg_frequency"]).item()
+    eeg_size = readers[0][0]
+
+    # clip the last non-full second and take the shorter duration of the two
+    end_time = math.floor(eeg_size / eeg_freq)
+
+    if standardize:
+        chunk_len = math.ceil(chunk_seconds * eeg_freq)
+        readers = [
+            (
+                size,
+                _standardized_reader(read, *_chunked_mean_std(read, size, chunk_len)),
+            )
+            for size, read in readers
+        ]
+
+    needs_resampling = (
+        math.ceil(eeg_freq) != segment_size and math.floor(eeg_freq) != segment_size
+    )
+    if needs_resampling:
+        down, up = (
+            Fraction(eeg_freq / segment_size).limit_denominator(100).as_integer_ratio()
+        )
+        print(f"file has sampling frequency of {eeg_freq}.")
+        half_len = 10 * max(up, down)  # filter half length used by resample_poly
+        pad = math.ceil(half_len / (up * down)) + 1
+
+    segment_array = np.arange(segment_size)
+    for t_start in range(0, end_time, chunk_seconds):
+        t_stop = min(t_start + chunk_seconds, end_time)
+        if needs_resampling:
+            # after resampling each second is exactly segment_size samples
+            start, stop = t_start * segment_size, t_stop * segment_size
+            if readers[0][0] == readers[1][0]:
+                blocks = _resample_window(
+                    _stacked_reader(readers),
+                    eeg_size,
+                    start,
+                    stop,
+                    up,
+                    down,
+                    pad,
+                    backend,
+                )
+            else:
+                blocks = [
+                    _resample_window(read, size, start, stop, up, down, pad, backend)
+                    for size, read in readers
+                ]
+            yield tuple(block.reshape(-1, segment_size) for block in blocks)
+        else:
+            start_indices = np.ceil(np.arange(t_start, t_stop) * eeg_freq).astype(int)
+            indices = start_indices[:, np.newaxis] - start_indices[0] + segment_array
+            stop = start_indices[-1] + segment_size
+            yield tuple(
+                np.asarray(read(start_indices[0], stop))[indices]
+                for size, read in readers
+            )
+
+
+def reshape_sleep_data(
+    mat,
+    segment_size=512,
+    standardize=False,
+    has_labels=True,
+    chunk_seconds=None,
+    backend="scipy",
+):
+    if chunk_seconds is not None:
+        return _reshape_sleep_data_chunked(
+            mat, segment_size, standardize, has_labels, chunk_seconds, backend
+        )
+
     eeg = mat["eeg"].flatten()
     emg = mat["emg"].flatten()
 
@@ -52,8 +285,11 @@ def reshape_sleep_data(mat, segment_size=512, standardize=False, has_labels=True
             Fraction(eeg_freq / segment_size).limit_denominator(100).as_integer_ratio()
         )
         print(f"file has sampling frequency of {eeg_freq}.")
-        eeg = signal.resample_poly(eeg, up, down)
-        emg = signal.resample_poly(emg, up, down)
+        if eeg.size == emg.size and eeg.dtype == emg.dtype:
+            eeg, emg = resample(np.stack([eeg, emg]), up, down, backend=backend)
+        else:
+            eeg = resample(eeg, up, down, backend=backend)
+            emg = resample(emg, up, down, backend=backend)
         eeg_freq = segment_size
 
     time_sec = np.arange(end_time)
@@ -77,6 +313,38 @@ def reshape_sleep_data(mat, segment_size=512, standardize=False, has_labels=True
     return eeg_reshaped, emg_reshaped
 
 
+def _reshape_sleep_data_chunked(
+    mat, segment_size, standardize, has_labels, chunk_seconds, backend
+):
+    # fill preallocated outputs block by block instead of resampling and
+    # gathering the whole signal at once
+    eeg_size, _ = _signal_reader(mat["eeg"])
+    end_time = math.floor(eeg_size / np.asarray(mat["eeg_frequency"]).item())
+    eeg_reshaped, emg_reshaped = None, None
+    t_start = 0
+    for eeg_block, emg_block in iter_sleep_data(
+        mat,
+        segment_size,
+        standardize=standardize,
+        chunk_seconds=chunk_seconds,
+        backend=backend,
+    ):
+        if eeg_reshaped is None:
+            eeg_reshaped = np.empty((end_time, segment_size), dtype=eeg_block.dtype)
+            emg_reshaped = np.empty((end_time, segment_size), dtype=emg_block.dtype)
+        t_stop = t_start + len(eeg_block)
+        eeg_reshaped[t_start:t_stop] = eeg_block
+        emg_reshaped[t_start:t_stop] = emg_block
+        t_start = t_stop
+
+    if has_labels:
+        sleep_scores = np.asarray(mat["sleep_scores"]).flatten()
+        sleep_scores = trim_missing_labels(sleep_scores, trim="b")
+        return eeg_reshaped, emg_reshaped, sleep_scores
+
+    return eeg_reshaped, emg_reshaped
+
+
 if __name__ == "__main__":
     path = "C:/Users/yzhao/python_projects/sleep_scoring/user_test_files/"
     mat_file = path + "sal_588.mat"
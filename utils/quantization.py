@@ -0,0 +1,18 @@
+import torch
+from torch import nn
+
+
+def linear_names(model):
+    return [name for name, m in model.named_modules() if isinstance(m, nn.Linear)]
+
+
+def quantize_linear(model, module_names=None):
+    # dynamic int8 quantization (int8 weights, activations quantized per
+    # batch at run time) of the given nn.Linear modules, or of all of them.
+    # Returns a quantized copy; quantized models run on CPU only.
+    if module_names is None:
+        module_names = linear_names(model)
+    qconfig = torch.ao.quantization.default_dynamic_qconfig
+    return torch.ao.quantization.quantize_dynamic(
+        model.cpu(), {name: qconfig for name in module_names}, dtype=torch.qint8
+    )
@@ -1,16 +1,26 @@
 import os
+import random
 import shutil
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import torch
 
+from utils.distributed import all_gather_state, is_distributed, is_main_process
+from utils.distributed import unwrap_model
+
 
 def save_checkpoint(state, is_best, exp_dir, filename="ckpt.pth.tar"):
+    # written to a temporary file and renamed, so a run killed mid-write
+    # keeps the previous checkpoint
     ckpt_name = os.path.join(exp_dir, filename)
-    torch.save(state, ckpt_name)
+    torch.save(state, ckpt_name + ".tmp")
+    os.replace(ckpt_name + ".tmp", ckpt_name)
     if is_best:
         best_name = os.path.join(exp_dir, "model_best.pth.tar")
-        shutil.copyfile(ckpt_name, best_name)
+        shutil.copyfile(ckpt_name, best_name + ".tmp")
+        os.replace(best_name + ".tmp", best_name)
         print("=> saving new best Acc model =========>")
         logging.getLogger("logger").info("=> saving new best Acc model =========>")
 
@@ -42,16 +52,107 @@ def load_checkpoint(
         return None
 
 
+def cpu_copy(state):
+    # a CPU copy of every tensor in a nested state dict, so it can be saved
+    # while training keeps updating the originals in place
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, cpu_copy(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(v) for v in state)
+    return state
+
+
+class CheckpointWriter:
+    """Run save_checkpoint on a background thread.
+
+    save() takes a CPU copy of the state and returns while torch.save and
+    the copy to model_best run in the background. A save waits for the
+    previous one, so at most one write is in flight, and errors of a write
+    are raised by the next save() or wait().
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, state, is_best, exp_dir, filename="ckpt.pth.tar"):
+        state = cpu_copy(state)
+        self.wait()
+        self.pending = self.executor.submit(
+            save_checkpoint, state, is_best, exp_dir, filename
+        )
+
+    def wait(self):
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            pending.result()
+
+
+def get_rng_state():
+    # python, numpy, torch and CUDA generators; the torch generator also
+    # seeds the shuffling of the train loader at the start of each epoch
+    name, keys, pos, has_gauss, gauss = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": (name, torch.from_numpy(keys.copy()), pos, has_gauss, gauss),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    name, keys, pos, has_gauss, gauss = state["numpy"]
+    np.random.set_state((name, keys.cpu().numpy(), pos, has_gauss, gauss))
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def autocast(device, precision="fp32"):
+    # bf16 autocast on CPU or CUDA for precision="bf16" (bf16 keeps the
+    # fp32 exponent range, so no loss scaling is needed), a no-op for fp32
+    if precision not in ("fp32", "bf16"):
+        raise ValueError(f"unknown precision {precision}")
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=torch.bfloat16,
+        enabled=precision == "bf16",
+    )
+
+
 class EarlyStopping:
-    def __init__(self, patience=30, verbose=False, delta=0):
+    def __init__(self, patience=30, verbose=False, delta=0, async_save=False):
         self.patience = patience
         self.verbose = verbose
         self.counter = 0
         self.best_acc = 0.0
         self.early_stop = False
         self.delta = delta
+        self.writer = CheckpointWriter() if async_save else None
 
-    def __call__(self, args, epoch, acc, model, optimizer, exp_dir):
+    def state_dict(self):
+        return {
+            "counter": self.counter,
+            "best_acc": self.best_acc,
+            "early_stop": self.early_stop,
+        }
+
+    def load_state_dict(self, state):
+        self.counter = state["counter"]
+        self.best_acc = state["best_acc"]
+        self.early_stop = state["early_stop"]
+
+    def wait(self):
+        # block until the last checkpoint is on disk
+        if self.writer is not None:
+            self.writer.wait()
+
+    def __call__(self, args, epoch, acc, model, optimizer, exp_dir, scheduler=None):
         is_best = acc > self.best_acc + self.delta
 
         if not is_best:
@@ -66,19 +167,26 @@ class EarlyStopping:
             self.best_acc = acc
             self.counter = 0
         self.best_acc = max(acc, self.best_acc)
-        save_checkpoint(
-            {
-                "epoch": epoch,
-                "model": args.model,
-                "state_dict": (
-                    model.state_dict()
-                    if not isinstance(model, torch.nn.DataParallel)
-                    else model.module.state_dict()
-                ),
-                "best_acc": self.best_acc,
-                "optimizer": optimizer.state_dict(),
-            },
-            is_best,
-            exp_dir,
-            filename="ckpt.pth.tar",
-        )
+        rng = get_rng_state() if scheduler is not None else None
+        if is_distributed() and rng is not None:
+            # one RNG state per rank, in rank order
+            rng = all_gather_state(rng)
+        if not is_main_process():
+            # under DDP only rank 0 writes, every rank keeps the counters
+            return
+        state = {
+            "epoch": epoch,
+            "model": args.model,
+            "state_dict": unwrap_model(model).state_dict(),
+            "best_acc": self.best_acc,
+            "optimizer": optimizer.state_dict(),
+        }
+        if scheduler is not None:
+            # everything run_train needs to resume after this epoch
+            state["scheduler"] = scheduler.state_dict()
+            state["early_stopping"] = self.state_dict()
+            state["rng"] = rng
+        if self.writer is not None:
+            self.writer.save(state, is_best, exp_dir, filename="ckpt.pth.tar")
+        else:
+            save_checkpoint(state, is_best, exp_dir, filename="ckpt.pth.tar")
@@ -6,37 +6,28 @@ Created on Sat Jun 29 22:38:40 2024
 """
 
 import os
+import json
+import time
+import multiprocessing
 
 import numpy as np
-from scipy.io import loadmat
 from sklearn.model_selection import KFold
 
-from utils.preprocessing import reshape_sleep_data
+from utils.preprocessing import (
+    CHUNK_SECONDS,
+    open_mat,
+    reshape_sleep_data,
+    trim_missing_labels,
+)
+from utils.cache import PreprocessCache
+from data_provider.trace_store import TraceStoreWriter, FOLDS_FILE, window_offsets
 
 
-def slice_data(data, sleep_scores, seq_len):
-    n = len(data)
-    n_to_crop = n % seq_len
-    n_new_seq = (n - n_to_crop) // seq_len
-    if n_to_crop != 0:
-        data = np.concatenate([data[:-n_to_crop], data[-seq_len:]], axis=0)
-        sleep_scores = np.concatenate(
-            [sleep_scores[:-n_to_crop], sleep_scores[-seq_len:]], axis=0
+def load_data(mat_file, segment_size=512):
+    with open_mat(mat_file) as mat:
+        eeg, emg, sleep_scores = reshape_sleep_data(
+            mat, segment_size=segment_size, chunk_seconds=CHUNK_SECONDS
         )
-        n_new_seq += 1
-
-    assert (n - n_to_crop) % seq_len == 0
-
-    data = data.reshape(
-        (n_new_seq, seq_len, data.shape[1], data.shape[2], data.shape[3])
-    )
-    sleep_scores = sleep_scores.reshape((n_new_seq, seq_len, sleep_scores.shape[1]))
-    return [data, sleep_scores]
-
-
-def prepare_data(mat_file, seq_len=64, augment=False, upsampling_scale=10):
-    mat = loadmat(mat_file)
-    eeg, emg, sleep_scores = reshape_sleep_data(mat)
     sleep_scores_len = len(sleep_scores)
     eeg_len = len(eeg)
 
@@ -50,35 +41,130 @@ def prepare_data(mat_file, seq_len=64, augment=False, upsampling_scale=10):
     eeg_standardized = (eeg - np.mean(eeg)) / np.std(eeg)
     emg_standardized = (emg - np.mean(emg)) / np.std(emg)
 
-    sleep_scores_reshaped = sleep_scores[:, np.newaxis]
     eeg_reshaped = eeg_standardized[:, np.newaxis, :]
     emg_reshaped = emg_standardized[:, np.newaxis, :]
     data = np.stack((eeg_reshaped, emg_reshaped), axis=1)
-    sliced_data, sliced_sleep_scores = slice_data(data, sleep_scores_reshaped, seq_len)
+    return data, sleep_scores
+
+
+def augment_starts(sleep_scores, seq_len=64, upsampling_scale=10):
+    # starts of extra windows shortly before each transition into REM
+    transition_indices = np.flatnonzero(np.diff(sleep_scores))
+    REM_transition_indices = transition_indices[sleep_scores[transition_indices] == 2]
+    REM_sampling_start_inds = [np.zeros(0, dtype=int)]
+    for transition_ind in REM_transition_indices:
+        REM_sampling_range = np.arange(
+            max(0, transition_ind - seq_len + 2),
+            min(transition_ind + 1, len(sleep_scores) - seq_len),
+        )
+        REM_sampling_start_inds.append(
+            np.random.choice(REM_sampling_range, size=upsampling_scale, replace=False)
+        )
+    return np.concatenate(REM_sampling_start_inds)
+
+
+def load_cached(mat_file, cache, segment_size=512):
+    # load_data through the cache. Only the deterministic standardized epochs
+    # are cached, keyed with every load_data parameter spelled out, so that
+    # slicing and the random REM upsampling are redone on every call.
+    key = cache.key(mat_file, segment_size=segment_size)
+    cached = cache.get(key)
+    if cached is None:
+        cached = load_data(mat_file, segment_size=segment_size)
+        cache.put(key, *cached)
+    return cached
+
+
+def screen_data(mat_file):
+    # only the labels are needed to screen a file, so skip reading the signal
+    with open_mat(mat_file, variable_names=["sleep_scores"]) as mat:
+        sleep_scores = np.asarray(mat["sleep_scores"]).flatten()
+    sleep_scores = trim_missing_labels(sleep_scores, trim="b")
+    return not (np.isnan(sleep_scores).any() or np.any(sleep_scores == -1))
 
+
+def _prepare_job(job):
+    # standardized epochs of one file and its REM upsampling window starts
+    file, mat_file, seq_len, augment, upsampling_scale, cache = job
+    start = time.time()
+    if cache is None:
+        data, sleep_scores = load_data(mat_file)
+    else:
+        data, sleep_scores = load_cached(mat_file, cache)
+    starts = np.zeros(0, dtype=int)
     if augment:
-        transition_indices = np.flatnonzero(np.diff(sleep_scores))
-        REM_transition_indices = transition_indices[
-            sleep_scores[transition_indices] == 2
-        ]
-        for transition_ind in REM_transition_indices:
-            REM_sampling_range = np.arange(
-                max(0, transition_ind - seq_len + 2),
-                min(transition_ind + 1, sleep_scores_len - seq_len),
-            )
-            REM_sampling_start_inds = np.random.choice(
-                REM_sampling_range, size=upsampling_scale, replace=False
-            )
-            REM_sampling_start_inds = np.expand_dims(REM_sampling_start_inds, axis=-1)
-            REM_sampling_range = REM_sampling_start_inds + np.arange(seq_len)
-            augmented_sample = data[REM_sampling_range]
-            augmented_sleep_scores = sleep_scores_reshaped[REM_sampling_range]
-            sliced_data = np.concatenate([sliced_data, augmented_sample], axis=0)
-            sliced_sleep_scores = np.concatenate(
-                [sliced_sleep_scores, augmented_sleep_scores], axis=0
-            )
+        starts = augment_starts(
+            sleep_scores, seq_len=seq_len, upsampling_scale=upsampling_scale
+        )
+    return file, data, sleep_scores[:, np.newaxis], starts, time.time() - start
+
+
+def _jobs(data_path, files, seq_len, augment, upsampling_scale, cache):
+    return [
+        (file, os.path.join(data_path, file), seq_len, augment, upsampling_scale, cache)
+        for file in files
+    ]
+
+
+def _imap(func, jobs, pool):
+    return map(func, jobs) if pool is None else pool.imap(func, jobs)
+
 
-    return sliced_data, sliced_sleep_scores
+def _make_pool(num_workers):
+    # num_workers > 0 fans the files out over a process pool. Each worker
+    # reseeds numpy so that REM augmentation differs between workers.
+    if num_workers > 0:
+        return multiprocessing.Pool(num_workers, initializer=np.random.seed)
+    return None
+
+
+def _screen_files(data_path, on_hold_list, pool):
+    candidates = sorted(
+        file
+        for file in os.listdir(data_path)
+        if file.endswith(".mat") and file not in on_hold_list
+    )
+    screened = _imap(
+        screen_data, [os.path.join(data_path, file) for file in candidates], pool
+    )
+    return [file for file, valid in zip(candidates, screened) if valid]
+
+
+def _save_split(results, save_path, split, fold, use_store, seq_len):
+    # every file is written once as a flat run of epochs; windows, including
+    # the REM-upsampled ones, are only start indices into it
+    file_list = []
+    if use_store:
+        # append file by file to memory-mapped shards instead of one big array
+        with TraceStoreWriter(
+            os.path.join(save_path, f"{split}_store{fold}"), overwrite=True
+        ) as store:
+            for file, data, sleep_scores, starts, elapsed in results:
+                print(f"{file} ({elapsed:.1f}s)")
+                store.append(file, data, sleep_scores, augment_starts=starts.tolist())
+                file_list.append(file)
+        return file_list
+
+    data = []
+    labels = []
+    window_starts = []
+    offset = 0
+    for file, epochs, sleep_scores, starts, elapsed in results:
+        print(f"{file} ({elapsed:.1f}s)")
+        data.append(epochs)
+        labels.append(sleep_scores)
+        window_starts.append(offset + window_offsets(len(epochs), seq_len, seq_len))
+        window_starts.append(offset + starts)
+        offset += len(epochs)
+        file_list.append(file)
+
+    data = np.concatenate(data, axis=0)
+    labels = np.concatenate(labels, axis=0)
+    window_starts = np.concatenate(window_starts)
+    np.save(os.path.join(save_path, f"{split}_trace{fold}.npy"), data)
+    np.save(os.path.join(save_path, f"{split}_label{fold}.npy"), labels)
+    np.save(os.path.join(save_path, f"{split}_starts{fold}.npy"), window_starts)
+    return file_list
 
 
 def write_data(
@@ -89,71 +175,109 @@ def write_data(
     seq_len=64,
     augment=False,
     upsampling_scale=10,
+    use_store=False,
+    num_workers=0,
+    cache_dir=None,
+    cache_bytes=50 * 2**30,
 ):
-    mat_list = []
-    for file in os.listdir(data_path):
-        if not file.endswith(".mat") or file in on_hold_list:
-            continue
-
-        mat_file = os.path.join(data_path, file)
-        mat = loadmat(mat_file)
-        eeg, emg, sleep_scores = reshape_sleep_data(mat)
-        if np.isnan(sleep_scores).any() or np.any(sleep_scores == -1):
-            continue
-
-        mat_list.append(file)
-
-    mat_list = sorted(mat_list)
-    kf = KFold(n_splits=5, shuffle=True, random_state=42)
-    fold_indices = list(kf.split(mat_list))
-    train_indices, val_indices = fold_indices[fold - 1]  # Label of fold start from one
-
-    train_data = []
-    train_labels = []
-    val_data = []
-    val_labels = []
-    train_file_list = []
-    val_file_list = []
-    for train_ind in train_indices:
-        train_file_name = mat_list[train_ind]
-        print(train_file_name)
-        train_file_list.append(train_file_name)
-        train_mat_file = os.path.join(data_path, train_file_name)
-        sliced_data, sliced_sleep_scores = prepare_data(
-            train_mat_file,
-            seq_len=seq_len,
-            augment=augment,
-            upsampling_scale=upsampling_scale,
+    pool = _make_pool(num_workers)
+    try:
+        mat_list = _screen_files(data_path, on_hold_list, pool)
+        kf = KFold(n_splits=5, shuffle=True, random_state=42)
+        fold_indices = list(kf.split(mat_list))
+        train_indices, val_indices = fold_indices[fold - 1]  # fold starts from one
+
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+
+        # with a cache_dir, files already preprocessed with the same settings
+        # (for any fold) are loaded from the cache instead of recomputed
+        cache = None if cache_dir is None else PreprocessCache(cache_dir, cache_bytes)
+        train_jobs = _jobs(
+            data_path,
+            [mat_list[ind] for ind in train_indices],
+            seq_len,
+            augment,
+            upsampling_scale,
+            cache,
+        )
+        val_jobs = _jobs(
+            data_path,
+            [mat_list[ind] for ind in val_indices],
+            seq_len,
+            False,
+            upsampling_scale,
+            cache,
+        )
+        train_file_list = _save_split(
+            _imap(_prepare_job, train_jobs, pool),
+            save_path,
+            "train",
+            fold,
+            use_store,
+            seq_len,
         )
-        train_data.append(sliced_data)
-        train_labels.append(sliced_sleep_scores)
-
-    train_data = np.concatenate(train_data, axis=0)
-    train_labels = np.concatenate(train_labels, axis=0)
-
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    np.save(os.path.join(save_path, f"train_trace{fold}.npy"), train_data)
-    np.save(os.path.join(save_path, f"train_label{fold}.npy"), train_labels)
-    print("saved train.")
-
-    for val_ind in val_indices:
-        val_file_name = mat_list[val_ind]
-        print(val_file_name)
-        val_file_list.append(val_file_name)
-        val_mat_file = os.path.join(data_path, val_file_name)
-        sliced_data, sliced_sleep_scores = prepare_data(val_mat_file)
-        val_data.append(sliced_data)
-        val_labels.append(sliced_sleep_scores)
-
-    val_data = np.concatenate(val_data, axis=0)
-    val_labels = np.concatenate(val_labels, axis=0)
-    np.save(os.path.join(save_path, f"val_trace{fold}.npy"), val_data)
-    np.save(os.path.join(save_path, f"val_label{fold}.npy"), val_labels)
+        print("saved train.")
+        val_file_list = _save_split(
+            _imap(_prepare_job, val_jobs, pool),
+            save_path,
+            "val",
+            fold,
+            use_store,
+            seq_len,
+        )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     return train_file_list, val_file_list
 
 
+def write_all_folds(
+    data_path,
+    save_path,
+    on_hold_list=[],
+    n_splits=5,
+    seq_len=64,
+    augment=False,
+    upsampling_scale=10,
+    num_workers=0,
+):
+    # Preprocess every file once into a single trace store of epochs and
+    # record the K-fold split as lists of file names in folds.json. Seq_Loader
+    # then builds the windows of a fold from the shared store. REM upsampling
+    # is kept as extra window starts per recording, not as copied windows.
+    pool = _make_pool(num_workers)
+    try:
+        mat_list = _screen_files(data_path, on_hold_list, pool)
+        jobs = _jobs(data_path, mat_list, seq_len, augment, upsampling_scale, None)
+        with TraceStoreWriter(
+            os.path.join(save_path, "store"), overwrite=True
+        ) as store:
+            for file, data, sleep_scores, starts, elapsed in _imap(
+                _prepare_job, jobs, pool
+            ):
+                print(f"{file} ({elapsed:.1f}s)")
+                store.append(file, data, sleep_scores, augment_starts=starts.tolist())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    kf = KFold(n_splits=n_splits, shuffle=True, random_state=42)
+    folds = {
+        str(fold): {
+            "train": [mat_list[ind] for ind in train_indices],
+            "val": [mat_list[ind] for ind in val_indices],
+        }
+        for fold, (train_indices, val_indices) in enumerate(kf.split(mat_list), 1)
+    }
+    with open(os.path.join(save_path, FOLDS_FILE), "w") as f:
+        json.dump(folds, f, indent=1)
+    return folds
+
+
 # %%
 if __name__ == "__main__":
     seq_len = 64  # don't change